@@ -24,9 +24,36 @@ Inspired by John Wiegley's Ledger:
 import argparse
 import sys
 import dateutil.parser
-from collections import defaultdict, namedtuple
+import datetime
+from collections import defaultdict, namedtuple, OrderedDict
+from itertools import groupby
 import xlwt
 import os
+import re
+import bisect
+import cPickle
+import heapq
+import hashlib
+import sqlite3
+import tempfile
+import csv
+import json
+import subprocess
+import fnmatch
+import multiprocessing
+import shlex
+from StringIO import StringIO
+import io
+import gzip
+import bz2
+try:
+    import lzma
+except ImportError:
+    ## Python 2 needs the backports.lzma package to read xz files.
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 # {{{ Deal with columns of text
 
@@ -103,13 +130,21 @@ def ljust_column(seq_of_seq_of_strings, column):
 
 # {{{ Units / Currencies
 
-### XXX: This code isn't good for anything besides AUD at the moment.
-### Maybe not even good for AUD. Should really be using a the decimal
-### module for this.
+### XXX: Should really be using a the decimal module for this.
+
+### Amounts are in AUD ('$10') unless they name another commodity,
+### e.g. shares or a foreign currency ('10 BHP', '100 USD'). All
+### quantities are kept in hundredths of a unit.
 
 DEFAULT_UNITS = 'AUD'
 
-def parse_amount(amount_string):
+COMMODITY_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_.]*$")
+
+def is_commodity(units_string):
+    "Could units_string name a commodity?"
+    return COMMODITY_PATTERN.match(units_string) is not None
+
+def parse_amount(amount_string, units=DEFAULT_UNITS):
     "Convert amount_string to a unit/currency and signed quantity."
 
     # Special case for no unit/ccy
@@ -118,16 +153,16 @@ def parse_amount(amount_string):
 
     quantity = int(round(float(amount_string.translate(None, "$,")) * 100.0))
 
-    return {'units': 'AUD',
+    return {'units': units,
             'quantity': quantity}
 
-def parse_amount_adjusting_sign(account_string, amount_string):
+def parse_amount_adjusting_sign(account_string, amount_string, units=DEFAULT_UNITS):
     "Parse amount_string, adjust sign depending on account_string."
 
     quantity = int(round(float(amount_string.translate(None, "$,")) * 100.0))
     quantity *= sign_account(account_string)
 
-    return {'units': 'AUD',
+    return {'units': units,
             'quantity': quantity}
 
 def format_amount(amount):
@@ -145,8 +180,18 @@ def format_amount(amount):
             return "${0:,.2f}".format(quantity/100.0)
         else:
             return "-${0:,.2f}".format(-quantity/100.0)
-    #else:
-    raise Exception('Unknown unit in format_amount:', units)
+    return "{0:,.2f} {1}".format(quantity/100.0, units)
+
+def amount_at_price(amount, price):
+    "Return value of amount at price, the value of one whole unit of amount's commodity."
+    return {'units': price['units'],
+            'quantity': int(round(amount['quantity'] * price['quantity'] / 100.0))}
+
+def posting_value(posting):
+    "Return amount posting balances against: its amount, or the amount at its price if it has one."
+    if posting.has_key('price'):
+        return amount_at_price(posting['amount'], posting['price'])
+    return posting['amount']
 
 def extract_single_unit_amount(amounts):
     "Given a set of amounts, make sure there is exactly one currency/unit present and return that amount."
@@ -181,6 +226,12 @@ def format_nil_or_single_unit_amount(amounts):
     "Given a set of amounts, make sure there is zero or one currency/unit present and return that amount."
     return format_amount(extract_nil_or_single_unit_amount(amounts))
 
+def format_amounts(amounts):
+    "Format units -> amount dictionary as a string, listing each unit/ccy in turn."
+    if len(amounts) == 0:
+        return "-"
+    return ", ".join(format_amount(amounts[units]) for units in sorted(amounts.keys()))
+
 def difference_nil_or_single_unit_amount(amount1, amount2):
     "Return amount1 - amount 2 with units of same ccy."
     if amount1 == {}:
@@ -195,6 +246,108 @@ def difference_nil_or_single_unit_amount(amount1, amount2):
 
 # }}}
 
+# {{{ Commodity prices
+
+## A price file has lines like ledger's price directives:
+##
+##   P 2013-06-28 BHP $29.87
+##
+## giving the value of one unit of a commodity from that date on.
+## Prices paid in the journal ('10 BHP @ $45.20') count too, but a
+## price file's entry for the same date takes precedence. Each
+## commodity's prices are kept sorted by date, so the price on any
+## date is found by bisection.
+
+PriceHistory = namedtuple('PriceHistory', ['dates', 'prices'])  # sorted dates, and price amount from each date
+
+def parse_price_line(line_number, line):
+    "Return (date, commodity, price amount) from price directive line."
+    split = line.split()
+    if len(split) <> 4 or split[0] <> "P":
+        raise ParseError(line_number, "Invalid price:\n  %s\nIt should look like this:\n  P <date> <commodity> <price>"
+                         % line.strip())
+    if not is_valid_date(split[1]):
+        raise ParseError(line_number, "Invalid date: '%s'." % split[1])
+    if not is_commodity(split[2]):
+        raise ParseError(line_number, "Invalid commodity: '%s'." % split[2])
+    price = _parse_line_amount(line_number, split[2], split[3].translate(None, "$"), False)
+    return (reformat_date(split[1]), split[2], price)
+
+def read_prices(lines):
+    "Return list of (date, commodity, price amount) from price file lines, skipping blank lines and comments."
+    result = []
+    line_number = 0
+    for line in lines:
+        line_number += 1
+        if line.strip() == "" or line.strip().startswith(("#", ";")):
+            continue
+        result.append(parse_price_line(line_number, line))
+    return result
+
+def transaction_prices(transactions):
+    "Return list of (date, commodity, price amount) paid in transactions."
+    return [(transaction['date'], posting['amount']['units'], posting['price'])
+            for transaction in transactions for posting in transaction['postings'] if posting.has_key('price')]
+
+def build_price_index(prices):
+    """Return dictionary of commodity -> PriceHistory from (date, commodity, price amount) list.
+
+    Of prices for a commodity on the same date, the last one wins."""
+    by_commodity = defaultdict(list)
+    for (date, commodity, price) in prices:
+        by_commodity[commodity].append((date, price))
+    index = {}
+    for (commodity, commodity_prices) in by_commodity.items():
+        ## Sorting is stable, so equal dates stay in the order given.
+        commodity_prices.sort(key=lambda entry: entry[0])
+        index[commodity] = PriceHistory(dates=[date for (date, _) in commodity_prices],
+                                        prices=[price for (_, price) in commodity_prices])
+    return index
+
+def price_as_at(price_index, commodity, date):
+    "Return price of commodity on date (or latest price if date is None), or None if there isn't one yet."
+    history = price_index.get(commodity)
+    if history is None:
+        return None
+    if date is None:
+        position = len(history.dates)
+    else:
+        position = bisect.bisect_right(history.dates, date)
+    if position == 0:
+        return None
+    return history.prices[position - 1]
+
+def market_value(quantities, price_index, date):
+    """Return units -> quantity dictionary holding the value on date of units -> quantity dictionary quantities.
+
+    Amounts already in AUD keep their value. Exits if a commodity has
+    no price on date."""
+    value = {}
+    for (units, quantity) in quantities.items():
+        if units <> DEFAULT_UNITS:
+            price = price_as_at(price_index, units, date)
+            if price is None:
+                sys.stderr.write("No price for '%s' on %s.\nExiting.\n" % (units, date or "the last date"))
+                sys.exit(-1)
+            amount = amount_at_price({'units': units, 'quantity': quantity}, price)
+            (units, quantity) = (amount['units'], amount['quantity'])
+        value[units] = value.get(units, 0) + quantity
+    return value
+
+def load_price_index(prices_fname, prices):
+    "Return price index of (date, commodity, price amount) list prices and those in the file prices_fname (if any)."
+    prices = list(prices)
+    if prices_fname:
+        with open(prices_fname) as infile:
+            try:
+                prices += read_prices(infile)
+            except ParseError, e:
+                sys.stderr.write("%s: %s\nExiting.\n" % (prices_fname, e))
+                sys.exit(-1)
+    return build_price_index(prices)
+
+# }}}
+
 def root_account_name(account_string):
     """Return regularised version of root account's name'.
 
@@ -268,9 +421,8 @@ def balance_amounts(transaction):
     balances = defaultdict(int)
     for posting in transaction['postings']:
         sign = sign_account(posting['account'])
-        units = posting['amount']['units']
-        quantity = posting['amount']['quantity']
-        balances[units] += quantity * sign
+        amount = posting_value(posting)
+        balances[amount['units']] += amount['quantity'] * sign
     for unit in balances.keys():
         result += [{'units': unit, 'quantity': balances[unit]}]
     return result
@@ -290,13 +442,20 @@ def print_transactions(transactions):
     for transaction in transactions:
         print transaction['date'], transaction['description']
         for posting in transaction['postings']:
-            print ' ', posting['account'], ' ', format_amount(posting['amount'])
+            if posting.has_key('price'):
+                print ' ', posting['account'], ' ', format_amount(posting['amount']), '@', format_amount(posting['price'])
+            else:
+                print ' ', posting['account'], ' ', format_amount(posting['amount'])
         print
 
 def ensure_balanced(transactions):
     "Complain and exit if transaction isn't balanced."
     problem_found = False
     for transaction in transactions:
+        ## Pruned transactions had their balance checked before
+        ## postings were dropped (see parse_transactions).
+        if transaction.get('pruned'):
+            continue
         if (not is_balanced(transaction)):
             problem_found = True
             sys.stderr.write("Line %d: Transaction does not balance. Date: '%s', description: %s.\n" %
@@ -355,6 +514,13 @@ def filter_by_account(transactions_or_postings, account_string):
 
 # {{{ journal file parsing
 
+class ParseError(ValueError):
+    "A line of a journal file that can't be parsed."
+    def __init__(self, line_number, problem):
+        ValueError.__init__(self, "Line %d: %s" % (line_number, problem))
+        self.line_number = line_number
+        self.problem = problem
+
 def is_valid_date(date_string):
     "Does date_string represent a valid date?"
     try:
@@ -378,28 +544,28 @@ def parse_first_line(line_number, line):
     description_string = line[len(date_string):].strip()
 
     if not is_valid_date(date_string):
-        ## XXX: Should throw an exception rather than exiting completely.
-        sys.stderr.write("Line %d: Invalid date: '%s' in transaction '%s'\n" %
-                         (line_number, date_string, line))
-        sys.stderr.write("Exiting.\n")
-        sys.exit(-1)
+        raise ParseError(line_number, "Invalid date: '%s' in transaction '%s'" % (date_string, line))
     return {'line': line_number,
             'date': reformat_date(date_string),
             'description': description_string}
 
 
 def verify_balance(verification, account_tree, verbose):
-    account_string = verification['account']
-    amount = verification['amount']
-    actual_balances  = find_account(account_string, account_tree).balances
+    "Check verification against balances in account_tree. Return True if it holds."
+    actual_balances = find_account(verification['account'], account_tree).balances
+    return _report_verification(verification, actual_balances, verbose)
 
-    if (extract_single_unit_amount(actual_balances) == amount):
+def _report_verification(verification, actual_balances, verbose):
+    "Internal. Report whether verification holds for actual_balances, and return True if it does."
+    amount = verification['amount']
+    if (len(actual_balances) == 1 and extract_single_unit_amount(actual_balances) == amount):
         if (verbose):
             print "Verified:", verification['date'], verification['account'], format_amount(amount)
-    else:
-        verify_failed = True
-        sys.stderr.write("FAILED: verify-balance for account '%s' at %s. Expected balance: %s. Actual balance: %s.\n" %
-                         (account_string, verification['date'], format_amount(amount), format_single_unit_amount(actual_balances)))
+        return True
+    sys.stderr.write("FAILED: verify-balance for account '%s' at %s. Expected balance: %s. Actual balance: %s.\n" %
+                     (verification['account'], verification['date'], format_amount(amount),
+                      format_amounts(actual_balances)))
+    return False
 
 def verify_balances(transactions, verifications, verbose, exit_on_failure):
     """Check that all assertions re account balances in verifications
@@ -418,7 +584,8 @@ def verify_balances(transactions, verifications, verbose, exit_on_failure):
     for transaction in transactions:
         while len(verifications) > 0 and transaction['date'] > verifications[0]['date']:
 
-            verify_balance(verifications[0], account_tree, verbose)
+            if not verify_balance(verifications[0], account_tree, verbose):
+                verify_failed = True
             verifications = verifications[1:]
 
         for posting in transaction['postings']:
@@ -430,7 +597,8 @@ def verify_balances(transactions, verifications, verbose, exit_on_failure):
                          account_tree)
 
     while len(verifications) > 0:
-        verify_balance(verifications[0], account_tree, verbose)
+        if not verify_balance(verifications[0], account_tree, verbose):
+            verify_failed = True
         verifications = verifications[1:]
 
     if exit_on_failure and verify_failed:
@@ -446,78 +614,109 @@ def parse_balance_verify(line_number, line, adjust_sign):
       VERIFY-BALANCE <date> <account> <amount>
 
     For example:
-      "VERIFY-BALANCE 2012-12-31 Assets:Cash $10"."""
+      "VERIFY-BALANCE 2012-12-31 Assets:Cash $10".
+
+    As in postings, amounts of other commodities name the commodity
+    after the quantity, e.g. "VERIFY-BALANCE 2012-12-31 Assets:Shares
+    10 BHP"."""
 
     line = line.strip()
     split = line.split()
 
-    if len(split) <> 4:
-        sys.stderr.write("Line %d: Invalid VERIFY-BALANCE operation:\n  %s\n" %
-                         (line_number, line))
-        sys.stderr.write("It should look like this:\n  VERIFY-BALANCE <date> <account> <amount>\nbut line %d contains %d elements (not 4).\n"%
-                         (line_number, len(split)))
-        sys.stderr.write("Exiting.\n")
-        sys.exit(-1)
+    units = DEFAULT_UNITS
+    if len(split) == 5 and not split[3].startswith(("$", "-$")) and is_commodity(split[4]):
+        units = split[4]
+    elif len(split) <> 4:
+        raise ParseError(line_number,
+                         "Invalid VERIFY-BALANCE operation:\n  %s\n"
+                         "It should look like this:\n  VERIFY-BALANCE <date> <account> <amount>\n"
+                         "but line %d contains %d elements (not 4)." % (line, line_number, len(split)))
 
     date_string = split[1]
     account_string = split[2]
     amount_string = split[3].translate(None, "$")
 
     if not is_valid_account_string(account_string):
-        sys.stderr.write("Line %d: invalid account string: '%s'.\n" %
-                         (line_number, account_string))
-        sys.stderr.write("Exiting.\n")
-        sys.exit(-1)
+        raise ParseError(line_number, "invalid account string: '%s'." % account_string)
 
     if not is_valid_date(date_string):
-            sys.stderr.write("Invalid date: '%s'.\nExiting.\n" % date_string)
-            sys.exit(-1)
+        raise ParseError(line_number, "Invalid date: '%s'." % date_string)
 
-    if adjust_sign:
-        amount = parse_amount_adjusting_sign(account_string, amount_string)
-    else:
-        amount = parse_amount(amount_string)
+    amount = _parse_line_amount(line_number, account_string, amount_string, adjust_sign, units)
 
-    return {'date': date_string,
+    return {'line': line_number,
+            'date': date_string,
             'account': account_string,
             'amount': amount}
 
+def _parse_line_amount(line_number, account_string, amount_string, adjust_sign, units=DEFAULT_UNITS):
+    """Internal. Parse amount_string found on line_number, raising ParseError if it's not an amount.
+
+    Quantities of commodities other than DEFAULT_UNITS with more
+    decimal places than are kept (hundredths) are rejected rather than
+    rounded."""
+    if units <> DEFAULT_UNITS and len(amount_string.partition(".")[2]) > 2:
+        raise ParseError(line_number, "'%s %s' has more than two decimal places." % (amount_string, units))
+    try:
+        if adjust_sign:
+            return parse_amount_adjusting_sign(account_string, amount_string, units)
+        return parse_amount(amount_string, units)
+    except ValueError:
+        raise ParseError(line_number, "invalid amount: '%s'." % amount_string)
+
 def parse_posting(line_number, line, adjust_sign):
     """parse string containing a posting.
 
     Format is account-name amount-with-unit/ccy.
-    For example: "Expenses:Petrol $10"."""
+    For example: "Expenses:Petrol $10".
+
+    Amounts of other commodities name the commodity after the
+    quantity, optionally followed by the price of each unit, e.g.
+    "Assets:Shares 10 BHP @ $45.20". A posting with a price balances
+    the rest of the transaction at that price."""
     line = line.strip()
     split = line.split()
+    if len(split) < 2:
+        raise ParseError(line_number, "posting needs an account and an amount: '%s'." % line)
     account_string = split[0]
     amount_string = split[1].translate(None, "$")
 
     if not is_valid_account_string(account_string):
-        sys.stderr.write("Line %d: invalid account string: '%s'.\n" %
-                         (line_number, account_string))
-        sys.stderr.write("Exiting.\n")
-        sys.exit(-1)
-
-    if adjust_sign:
-        amount = parse_amount_adjusting_sign(account_string, amount_string)
-    else:
-        amount = parse_amount(amount_string)
-
-    return {'line': line_number,
-            'account': account_string,
-            'amount': amount}
+        raise ParseError(line_number, "invalid account string: '%s'." % account_string)
+
+    units = DEFAULT_UNITS
+    if len(split) > 2 and not split[1].startswith(("$", "-$")) and is_commodity(split[2]):
+        units = split[2]
+    amount = _parse_line_amount(line_number, account_string, amount_string, adjust_sign, units)
+
+    posting = {'line': line_number,
+               'account': account_string,
+               'amount': amount}
+    if units <> DEFAULT_UNITS and len(split) > 3 and split[3] == "@":
+        if len(split) < 5:
+            raise ParseError(line_number, "missing price after '@': '%s'." % line)
+        price = _parse_line_amount(line_number, account_string, split[4].translate(None, "$"), False)
+        if price['quantity'] < 0:
+            raise ParseError(line_number, "invalid price: '%s'." % split[4])
+        posting['price'] = price
+    return posting
 
 def is_balance_verify_line(line):
     "Does line contain a balance-verification assertion?"
     items = line.strip().split()
     return (len(items) > 0) and (items[0].upper() == "VERIFY-BALANCE")
 
-def parse_transactions(lines, adjust_signs):
-    "Convert list of lines from journal file to list of transactions."
-    transactions = []
-    verify_balances = []
+def iter_journal(lines, adjust_signs):
+    """Generate contents of journal file lines one item at a time.
+
+    Yields ('transaction', transaction), ('verify-balance',
+    verification) and ('error', ParseError) pairs in file order, so
+    callers can stream through a journal without holding it in
+    memory. After an error in the first line of a transaction, the
+    rest of that transaction is skipped."""
     transaction = {}
     postings = []
+    skipping = False
     line_count = 0
     for line in lines:
         line = line.strip()
@@ -531,27 +730,523 @@ def parse_transactions(lines, adjust_signs):
             ## A blank line - possibly after a transaction
             if transaction:
                 transaction['postings'] = postings
-                transactions += [transaction]
+                yield ('transaction', transaction)
                 transaction = {}
                 postings = []
-        else:
-            ## non-blank line
-            if is_balance_verify_line(line):
-                verify_balances += [parse_balance_verify(line_count, line, adjust_signs)]
-            elif not transaction:
-                transaction = parse_first_line(line_count, line)
+            skipping = False
+        elif is_balance_verify_line(line):
+            try:
+                verification = parse_balance_verify(line_count, line, adjust_signs)
+            except ParseError, e:
+                yield ('error', e)
             else:
-                postings += [parse_posting(line_count, line, adjust_signs)]
+                yield ('verify-balance', verification)
+        elif skipping:
+            pass
+        elif not transaction:
+            try:
+                transaction = parse_first_line(line_count, line)
+            except ParseError, e:
+                skipping = True
+                yield ('error', e)
+        else:
+            try:
+                postings.append(parse_posting(line_count, line, adjust_signs))
+            except ParseError, e:
+                yield ('error', e)
     if transaction:
         transaction['postings'] = postings
-        transactions += [transaction]
+        yield ('transaction', transaction)
+
+def iter_verifications(lines, line_count, adjust_signs):
+    """Generate ('verify-balance', verification) and ('error', ParseError) pairs for lines.
+
+    Everything but balance verifications is skipped without being
+    parsed. line_count is the number of lines read before lines."""
+    for line in lines:
+        line_count += 1
+        line = line.strip()
+        if is_balance_verify_line(line):
+            try:
+                verification = parse_balance_verify(line_count, line, adjust_signs)
+            except ParseError, e:
+                yield ('error', e)
+            else:
+                yield ('verify-balance', verification)
+
+def _write_sorted_chunk(chunk):
+    "Internal. Sort chunk of (key, transaction) pairs into a temporary file, returned rewound."
+    chunk_file = tempfile.TemporaryFile()
+    pickler = cPickle.Pickler(chunk_file, cPickle.HIGHEST_PROTOCOL)
+    for item in sorted(chunk):
+        pickler.dump(item)
+    chunk_file.seek(0)
+    return chunk_file
+
+def _read_chunk(chunk_file):
+    "Internal. Generate (key, transaction) pairs written by _write_sorted_chunk."
+    unpickler = cPickle.Unpickler(chunk_file)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+def sort_journal(entries, chunk_size=None):
+    """Re-order entries from iter_journal so transactions come in date order.
+
+    The sort is stable: transactions on the same date stay in file
+    order. Errors and verifications are passed on as they are read,
+    before any transactions. If chunk_size is given, at most that many
+    transactions are held in memory: sorted runs are written to
+    temporary files and merged."""
+    chunk = []
+    chunk_files = []
+    sequence = 0
+    try:
+        for (kind, item) in entries:
+            if kind != 'transaction':
+                yield (kind, item)
+                continue
+            ## sequence makes keys unique, so transactions are never compared.
+            chunk.append(((item['date'], sequence), item))
+            sequence += 1
+            if chunk_size and len(chunk) >= chunk_size:
+                chunk_files.append(_write_sorted_chunk(chunk))
+                chunk = []
+        if chunk_files:
+            if chunk:
+                chunk_files.append(_write_sorted_chunk(chunk))
+                chunk = []
+            runs = [_read_chunk(chunk_file) for chunk_file in chunk_files]
+        else:
+            runs = [sorted(chunk)]
+        for (key, transaction) in heapq.merge(*runs):
+            yield ('transaction', transaction)
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+## The parts of a journal a report will look at. Any of the fields
+## may be None, meaning "no restriction".
+ParseScope = namedtuple('ParseScope', ['first_date', 'last_date', 'account_strings'])
+
+def _in_scope_accounts(account_string, scope, cache):
+    "Internal. Is account_string one of scope's accounts, or a sub-account of one?"
+    if not cache.has_key(account_string):
+        cache[account_string] = any([contains_account(scope_account, account_string)
+                                     for scope_account in scope.account_strings])
+    return cache[account_string]
+
+def _day_before(date_string):
+    "Internal. Return iso-formatted date of day before date_string."
+    return (dateutil.parser.parse(date_string) - datetime.timedelta(days=1)).isoformat()[:10]
+
+def fold_posting(posting, totals, account_spellings):
+    """Add posting's amount to totals, keyed by (account, units).
+
+    Accounts are keyed using the spelling in account_spellings (regular
+    name -> account string) which remembers the first one seen."""
+    account_string = account_spellings.setdefault(regular_account_string(posting['account']), posting['account'])
+    totals[(account_string, posting['amount']['units'])] += posting['amount']['quantity']
+
+def _opening_balances_transaction(opening, first_line, first_date, pruned):
+    "Internal. Build transaction bringing forward balances folded by parse_transactions."
+    postings = []
+    for (account_string, units) in sorted(opening.keys()):
+        postings += [{'line': first_line,
+                      'account': account_string,
+                      'amount': {'units': units,
+                                 'quantity': opening[(account_string, units)]}}]
+    return {'line': first_line,
+            'date': _day_before(first_date),
+            'description': 'Opening balances brought forward',
+            'postings': postings,
+            'pruned': pruned}
+
+def parse_transactions(lines, adjust_signs, scope=None, sort=False, sort_chunk_size=None):
+    """Convert list of lines from journal file to list of transactions.
+
+    If sort is True, transactions are sorted by date (see sort_journal).
+
+    If scope is given, only keep what a report restricted to scope
+    needs:
+
+    * Transactions stop being read at the first one after
+      scope.last_date, so the journal must be date sorted. The rest
+      of the file is only scanned for balance verifications, which
+      may be written anywhere.
+    * Transactions before scope.first_date are folded into a single
+      opening balances transaction dated the day before.
+    * Only postings to scope.account_strings (or their sub-accounts)
+      are kept. Transactions are checked for balance before their
+      other postings are dropped, and marked as 'pruned'.
+    * Only balance verifications within the dates and accounts of
+      scope are kept."""
+    transactions = []
+    verify_balances = []
+    if scope:
+        first_date = scope.first_date and reformat_date(scope.first_date)
+        last_date = scope.last_date and reformat_date(scope.last_date)
+        account_cache = {}
+        opening = defaultdict(int)  # (account, units) -> quantity
+        opening_accounts = {}       # regular account name -> account as first written
+        opening_line = []           # line of first folded transaction
+
+    def finish_transaction(transaction):
+        "Add transaction to transactions, if it's in scope. Return False once past scope."
+        if not scope:
+            transactions.append(transaction)
+            return True
+        if last_date and transaction['date'] > last_date:
+            return False
+        if scope.account_strings or (first_date and transaction['date'] < first_date):
+            ensure_balanced([transaction])
+        kept_postings = transaction['postings']
+        if scope.account_strings:
+            kept_postings = [posting for posting in kept_postings
+                             if _in_scope_accounts(posting['account'], scope, account_cache)]
+        if first_date and transaction['date'] < first_date:
+            if not opening_line:
+                opening_line.append(transaction['line'])
+            for posting in kept_postings:
+                fold_posting(posting, opening, opening_accounts)
+            return True
+        if kept_postings:
+            transaction['postings'] = kept_postings
+            transaction['pruned'] = bool(scope.account_strings)
+            transactions.append(transaction)
+        return True
+
+    def add_verification(kind, item):
+        "Add verification to verify_balances, exiting on parse errors."
+        if kind == 'error':
+            sys.stderr.write("%s\nExiting.\n" % item)
+            sys.exit(-1)
+        verify_balances.append(item)
+
+    line_count = [0]
+    def counted_lines(lines):
+        "Generate lines, counting those read so far in line_count."
+        for line in lines:
+            line_count[0] += 1
+            yield line
+
+    if scope and last_date and not sort:
+        lines = counted_lines(lines)
+    entries = iter_journal(lines, adjust_signs)
+    if sort:
+        entries = sort_journal(entries, sort_chunk_size)
+    for (kind, item) in entries:
+        if kind <> 'transaction':
+            add_verification(kind, item)
+        elif not finish_transaction(item):
+            if not sort:
+                entries = iter_verifications(lines, line_count[0], adjust_signs)
+            for (kind, item) in entries:
+                if kind <> 'transaction':
+                    add_verification(kind, item)
+            break
+    if scope:
+        if opening_line:
+            transactions.insert(0, _opening_balances_transaction(opening, opening_line[0], first_date,
+                                                                 bool(scope.account_strings)))
+        verify_balances = [verification for verification in verify_balances
+                           if (((not first_date) or reformat_date(verification['date']) >= first_date) and
+                               ((not last_date) or reformat_date(verification['date']) <= last_date) and
+                               ((not scope.account_strings) or
+                                _in_scope_accounts(verification['account'], scope, account_cache)))]
     return {'transactions' : transactions,
             'verify-balances' : verify_balances}
 
-def parse_file(fname, adjust_signs):
+## Journals can be gzip, bzip2 or xz compressed. They're recognised by
+## their first few bytes, whatever their names, and decompressed as
+## they're read.
+JOURNAL_BUFFER_SIZE = 1 << 20
+COMPRESSION_MAGIC = [('gzip', "\x1f\x8b"),
+                     ('bzip2', "BZh"),
+                     ('xz', "\xfd7zXZ\x00")]
+
+def _compression_of(start):
+    "Internal. Return name of the compression whose magic bytes start start, or None."
+    for (compression, magic) in COMPRESSION_MAGIC:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def journal_compression(fname):
+    "Return name of the compression used for journal fname, or None if it isn't compressed."
+    with open(fname, "rb") as infile:
+        return _compression_of(infile.read(max(len(magic) for (compression, magic) in COMPRESSION_MAGIC)))
+
+def _ensure_lzma(name):
+    "Internal. Exit if xz compressed journal name can't be read."
+    if lzma is None:
+        sys.stderr.write("Can't read xz compressed journal '%s' without the lzma module "
+                         "(pip install backports.lzma).\nExiting.\n" % name)
+        sys.exit(-1)
+
+def open_journal(fname):
+    "Open journal fname for reading lines, decompressing it if necessary."
+    compression = journal_compression(fname)
+    if compression == 'gzip':
+        return io.BufferedReader(gzip.GzipFile(fname, "rb"), JOURNAL_BUFFER_SIZE)
+    if compression == 'bzip2':
+        return bz2.BZ2File(fname, "r", JOURNAL_BUFFER_SIZE)
+    if compression == 'xz':
+        _ensure_lzma(fname)
+        return io.BufferedReader(lzma.LZMAFile(fname, "rb"), JOURNAL_BUFFER_SIZE)
+    return open(fname, "r", JOURNAL_BUFFER_SIZE)
+
+def decompress_journal(data, name):
+    """Return text of journal data, decompressing it if necessary.
+
+    Like open_journal, but for a journal already read into memory (a
+    git blob, say) called name in error messages."""
+    compression = _compression_of(data)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+    if compression == 'bzip2':
+        return bz2.decompress(data)
+    if compression == 'xz':
+        _ensure_lzma(name)
+        return lzma.decompress(data)
+    return data
+
+def parse_file(fname, adjust_signs, scope=None, sort=False, sort_chunk_size=None):
     "convert text in fname into list of transactions."
-    with open(fname) as infile:
-        return parse_transactions(infile.readlines(), adjust_signs)
+    with open_journal(fname) as infile:
+        return parse_transactions(infile, adjust_signs, scope, sort, sort_chunk_size)
+
+# }}}
+
+# {{{ Checking a journal in a single pass
+
+JournalProblem = namedtuple('JournalProblem', ['line', 'kind', 'message'])
+
+def _format_balances(balances):
+    "Internal. Format units -> quantity dictionary as text."
+    if len(balances) == 0:
+        return "-"
+    return ", ".join([format_amount({'units': units, 'quantity': balances[units]})
+                      for units in sorted(balances.keys())])
+
+def _check_verification(verification, totals):
+    "Internal. Return JournalProblem if verification doesn't match running totals, else None."
+    account_string = account_string_and_parents(verification['account'])[-1]
+    actual = totals.get(account_string, {})
+    amount = verification['amount']
+    if len(actual) == 1 and actual.get(amount['units']) == amount['quantity']:
+        return None
+    return JournalProblem(verification['line'], 'verify-balance-failed',
+                          "verify-balance for account '%s' at %s. Expected balance: %s. Actual balance: %s." %
+                          (verification['account'], verification['date'], format_amount(amount), _format_balances(actual)))
+
+def _late_verification_problems(verifications, lines, adjust_signs):
+    """Internal. Generate JournalProblem for each of verifications that fails.
+
+    Postings in lines are totalled for each verification's account
+    up to its date, whatever their order in the file."""
+    by_account = defaultdict(list)  # account -> [(date, line)]
+    for verification in verifications:
+        by_account[account_string_and_parents(verification['account'])[-1]].append(
+            (reformat_date(verification['date']), verification['line']))
+    totals = dict((verification['line'], defaultdict(int)) for verification in verifications)
+    parents_cache = {}
+    for (kind, item) in iter_journal(lines, adjust_signs):
+        if kind <> 'transaction':
+            continue
+        for posting in item['postings']:
+            account_string = posting['account']
+            if not parents_cache.has_key(account_string):
+                parents_cache[account_string] = [parent for parent in account_string_and_parents(account_string)
+                                                 if by_account.has_key(parent)]
+            for parent in parents_cache[account_string]:
+                for (date, line) in by_account[parent]:
+                    if item['date'] <= date:
+                        totals[line][posting['amount']['units']] += posting['amount']['quantity']
+    for verification in verifications:
+        account_string = account_string_and_parents(verification['account'])[-1]
+        problem = _check_verification(verification, {account_string: totals[verification['line']]})
+        if problem:
+            yield problem
+
+def check_journal(lines, adjust_signs, sort=False, sort_chunk_size=None, reread_lines=None):
+    """Check journal lines in one streaming pass, generating a JournalProblem for each problem found.
+
+    Parsing, date order, transaction balance and verify-balance
+    assertions are all checked. Only running totals for each account
+    and its parents are kept, so a verification is checked when the
+    first transaction after its date is reached. A verification
+    written after transactions later than its date is checked in a
+    second pass over reread_lines() (or lines again, if it's a list),
+    once the first pass is done. Without one, it's reported as
+    'verify-balance-unchecked'. If sort is True, transactions are
+    checked in date order (see sort_journal)."""
+    totals = defaultdict(lambda: defaultdict(int))  # account and parents -> units -> quantity
+    parents_cache = {}
+    pending = []                                     # heap of (date, line, verification)
+    late = []                                        # verifications following later transactions
+    latest_date = None
+    entries = iter_journal(lines, adjust_signs)
+    if sort:
+        entries = sort_journal(entries, sort_chunk_size)
+    for (kind, item) in entries:
+        if kind == 'error':
+            yield JournalProblem(item.line_number, 'parse-error', " ".join(item.problem.split()))
+        elif kind == 'verify-balance':
+            date = reformat_date(item['date'])
+            if latest_date and date < latest_date:
+                late.append((item, latest_date))
+            else:
+                heapq.heappush(pending, (date, item['line'], item))
+        else:
+            while pending and pending[0][0] < item['date']:
+                problem = _check_verification(heapq.heappop(pending)[2], totals)
+                if problem:
+                    yield problem
+            if latest_date and item['date'] < latest_date:
+                yield JournalProblem(item['line'], 'not-date-sorted',
+                                     "date: '%s' description: '%s' is not in date order." % (item['date'], item['description']))
+            else:
+                latest_date = item['date']
+            if not is_balanced(item):
+                yield JournalProblem(item['line'], 'not-balanced',
+                                     "Transaction does not balance. Date: '%s', description: %s. Imbalance: %s." %
+                                     (item['date'], item['description'],
+                                      ", ".join([format_amount(amount) for amount in balance_amounts(item)
+                                                 if amount['quantity'] != 0])))
+            for posting in item['postings']:
+                account_string = posting['account']
+                if not parents_cache.has_key(account_string):
+                    parents_cache[account_string] = account_string_and_parents(account_string)
+                for parent in parents_cache[account_string]:
+                    totals[parent][posting['amount']['units']] += posting['amount']['quantity']
+    while pending:
+        problem = _check_verification(heapq.heappop(pending)[2], totals)
+        if problem:
+            yield problem
+    if late and reread_lines is None and isinstance(lines, list):
+        reread_lines = lambda: lines
+    if late and reread_lines is None:
+        for (verification, following_date) in late:
+            yield JournalProblem(verification['line'], 'verify-balance-unchecked',
+                                 "verify-balance dated %s follows transactions dated %s." %
+                                 (reformat_date(verification['date']), following_date))
+    elif late:
+        for problem in _late_verification_problems([verification for (verification, _) in late],
+                                                   reread_lines(), adjust_signs):
+            yield problem
+
+def _journal_lines(fname):
+    "Internal. Generate lines of journal fname, closing it once they've all been read."
+    with open_journal(fname) as infile:
+        for line in infile:
+            yield line
+
+def check_journal_file(fname, adjust_signs, sort=False, sort_chunk_size=None):
+    """Check journal in fname, printing each problem as 'FILE:LINE: KIND: MESSAGE'.
+
+    Return number of problems found."""
+    problem_count = 0
+    with open_journal(fname) as infile:
+        for problem in check_journal(infile, adjust_signs, sort, sort_chunk_size,
+                                     reread_lines=lambda: _journal_lines(fname)):
+            print "%s:%d: %s: %s" % (fname, problem.line, problem.kind, problem.message)
+            problem_count += 1
+    return problem_count
+
+# }}}
+
+# {{{ Searching transaction descriptions
+
+DescriptionIndex = namedtuple('DescriptionIndex', ['tokens', 'transaction_ids'])
+
+def description_tokens(description):
+    "Split description into the lower-cased words used to index it."
+    return re.findall(r"\w+", description.lower())
+
+def build_description_index(transactions):
+    """Build inverted index from description tokens to transaction ids.
+
+    Transaction ids are positions in transactions, as used for
+    'txn:N:' in the excel report. tokens is a sorted list of every
+    token, so prefix searches can bisect it."""
+    transaction_ids = defaultdict(list)
+    for txn_id in range(len(transactions)):
+        for token in set(description_tokens(transactions[txn_id]['description'])):
+            transaction_ids[token].append(txn_id)
+    return DescriptionIndex(tokens=sorted(transaction_ids.keys()),
+                            transaction_ids=dict(transaction_ids))
+
+def _ids_for_search_term(index, term):
+    "Internal. Return set of transaction ids matching one search term."
+    term = term.lower()
+    if not term.endswith("*"):
+        return set(index.transaction_ids.get(term, []))
+    # else prefix search
+    prefix = term[:-1]
+    result = set()
+    position = bisect.bisect_left(index.tokens, prefix)
+    while position < len(index.tokens) and index.tokens[position].startswith(prefix):
+        result.update(index.transaction_ids[index.tokens[position]])
+        position += 1
+    return result
+
+def search_description_index(index, terms):
+    """Return sorted ids of transactions whose descriptions match all terms.
+
+    A term ending in '*' matches any word starting with the rest of
+    the term. Matching is case-insensitive."""
+    result = None
+    for term in terms:
+        words = description_tokens(term)
+        if term.endswith("*") and words:
+            words[-1] += "*"
+        for word in words:
+            matches = _ids_for_search_term(index, word)
+            if result is None:
+                result = matches
+            else:
+                result &= matches
+    if not result:
+        return []
+    return sorted(result)
+
+## Indexes over a journal can be saved next to it, in a file named by
+## adding a suffix to the journal's name. They are tagged with the
+## journal's size and modification time, and ignored once it changes.
+
+DESCRIPTION_INDEX_SUFFIX = ".description-index"
+
+def _journal_signature(journal_fname):
+    "Internal. Cheap signature that changes when the journal file is edited."
+    stat = os.stat(journal_fname)
+    return (stat.st_size, stat.st_mtime)
+
+def save_journal_index(index, journal_fname, suffix):
+    "Write index next to journal_fname, tagged with the journal's signature."
+    with open(journal_fname + suffix, "wb") as outfile:
+        cPickle.dump((_journal_signature(journal_fname), index), outfile, cPickle.HIGHEST_PROTOCOL)
+
+def load_journal_index(journal_fname, suffix):
+    "Return index saved next to journal_fname, or None if missing or out of date."
+    try:
+        with open(journal_fname + suffix, "rb") as infile:
+            signature, index = cPickle.load(infile)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+    if signature != _journal_signature(journal_fname):
+        return None
+    return index
+
+def description_index_for_file(journal_fname, transactions):
+    "Load persisted description index for journal_fname, rebuilding and saving it if stale."
+    index = load_journal_index(journal_fname, DESCRIPTION_INDEX_SUFFIX)
+    if index is None:
+        index = build_description_index(transactions)
+        save_journal_index(index, journal_fname, DESCRIPTION_INDEX_SUFFIX)
+    return index
 
 # }}}
 
@@ -688,10 +1383,8 @@ def find_original_prefix(account_string, account_tree):
         while len(components) > 1:
             components = components[1:]
             account_name = components[0]
-            result += account_tree.original_name
+            result += account_tree.original_name + ":"
             account_tree = account_tree.sub_accounts[account_name]
-        if len(result) > 0:
-            result += ":"
         return result
     except KeyError:
         raise ValueError("Account not found: '%s'"%account_string)
@@ -734,18 +1427,258 @@ def account_string_and_parents(account_string):
         result += [this_result]
     return result
 
+# {{{ Sharing indexes between batch jobs
+
+## A batch (see run_batch) parses the journal once and runs many
+## reports on it. While it runs, indexes built from the parsed
+## journal are kept and shared by the reports.
+
+_journal_indexes = None
+
+## Running balances for limited registers (see calculate_register),
+## keyed on (id of transactions, account).
+_register_running_balances = None
+
+def journal_index(build_index, transactions):
+    """Return build_index(transactions).
+
+    During a batch, the index is only built once for each list of
+    transactions."""
+    if _journal_indexes is None:
+        return build_index(transactions)
+    key = (build_index, id(transactions))
+    if not _journal_indexes.has_key(key):
+        ## Keep transactions too, so its id isn't reused while the index is kept.
+        _journal_indexes[key] = (transactions, build_index(transactions))
+    return _journal_indexes[key][1]
+
+# }}}
+
+# {{{ Account index
+
+## Accounts are numbered in depth-first order, so each account and all
+## of its sub-accounts have a contiguous range of ids. "Is this
+## posting in account X or one of its children?" is then an integer
+## range check, and the postings for X's subtree are a contiguous slice
+## of a list of postings sorted by account id.
+
+AccountIndex = namedtuple('AccountIndex',
+                          ['account_ids',     # account string as written -> id
+                           'subtree_ranges',  # regular account string -> (first id, last id)
+                           'posting_keys',    # account id of each entry in postings
+                           'postings'])       # sorted (account id, transaction id, posting #)
+
+def regular_account_string(account_string):
+    "Return regularised version of account_string, e.g. 'EXPENSES:FOOD' for 'expense:Food'."
+    return ":".join(account_string_components(account_string)['regular'])
+
+def build_account_index(transactions):
+    "Number accounts used in transactions depth-first, and sort postings by account."
+    account_paths = {}
+    for transaction in transactions:
+        for posting in transaction['postings']:
+            if not account_paths.has_key(posting['account']):
+                account_paths[posting['account']] = tuple(account_string_components(posting['account'])['regular'])
+    all_paths = set()
+    for path in account_paths.values():
+        for length in range(1, len(path)+1):
+            all_paths.add(path[:length])
+    ## Sorting tuples of components puts parents immediately before
+    ## their children, i.e. in depth-first order.
+    all_paths = sorted(all_paths)
+    path_ids = {}
+    subtree_ranges = {}
+    open_paths = []
+    for path_id in range(len(all_paths)):
+        path = all_paths[path_id]
+        while open_paths and not is_prefix_of(open_paths[-1], path):
+            closed = open_paths.pop()
+            subtree_ranges[":".join(closed)] = (path_ids[closed], path_id - 1)
+        path_ids[path] = path_id
+        open_paths.append(path)
+    for closed in open_paths:
+        subtree_ranges[":".join(closed)] = (path_ids[closed], len(all_paths) - 1)
+    account_ids = dict((account_string, path_ids[path]) for (account_string, path) in account_paths.items())
+    postings = []
+    for txn_id in range(len(transactions)):
+        postings_in_txn = transactions[txn_id]['postings']
+        for posting_number in range(len(postings_in_txn)):
+            postings.append((account_ids[postings_in_txn[posting_number]['account']], txn_id, posting_number))
+    postings.sort()
+    return AccountIndex(account_ids=account_ids,
+                        subtree_ranges=subtree_ranges,
+                        posting_keys=[entry[0] for entry in postings],
+                        postings=postings)
+
+def account_subtree_range(account_index, account_string):
+    "Return (first, last) ids of account_string and its sub-accounts, or None if it has no postings."
+    return account_index.subtree_ranges.get(regular_account_string(account_string))
+
+def in_account_subtree(account_index, subtree_range, account_string):
+    "Is account_string (used in a posting) inside the subtree with ids subtree_range?"
+    account_id = account_index.account_ids[account_string]
+    return subtree_range[0] <= account_id <= subtree_range[1]
+
+def subtree_postings(account_index, account_string):
+    "Return sorted (transaction id, posting #) pairs for postings to account_string or its sub-accounts."
+    subtree_range = account_subtree_range(account_index, account_string)
+    if subtree_range is None:
+        return []
+    first = bisect.bisect_left(account_index.posting_keys, subtree_range[0])
+    last = bisect.bisect_right(account_index.posting_keys, subtree_range[1])
+    return sorted(entry[1:] for entry in account_index.postings[first:last])
+
+def transactions_restricted_to_accounts(transactions, account_strings, account_index):
+    """Return copies of transactions affecting the named accounts, containing only their postings.
+
+    Transactions are returned in their original order."""
+    entries = set()
+    for account_string in account_strings:
+        entries.update(subtree_postings(account_index, account_string))
+    result = []
+    for txn_id, txn_entries in groupby(sorted(entries), key=lambda entry: entry[0]):
+        transaction = dict(transactions[txn_id])
+        transaction['postings'] = [transactions[txn_id]['postings'][posting_number]
+                                   for (_, posting_number) in txn_entries]
+        result.append(transaction)
+    return result
+
+# }}}
+
+# {{{ Account patterns
+
+## Reports can name accounts with shell-style patterns, matched one
+## component at a time against regularised account names, e.g.
+## 'Expenses:*:Fuel' or 'assets:bank*'. Accounts are kept in a trie
+## keyed by regularised component, so components without wildcards
+## are dictionary lookups, and all of a report's patterns are matched
+## together in a single walk of the trie.
+
+AccountTrieNode = namedtuple('AccountTrieNode', ['original_name', 'children'])
+
+def build_account_trie(account_strings):
+    "Return root AccountTrieNode of a trie holding account_strings and their parents."
+    root = AccountTrieNode(original_name='', children={})
+    for account_string in set(account_strings):
+        components = account_string_components(account_string)
+        node = root
+        for (original, regular) in zip(components['original'], components['regular']):
+            if not node.children.has_key(regular):
+                node.children[regular] = AccountTrieNode(original_name=original, children={})
+            node = node.children[regular]
+    return root
+
+def account_trie_from_transactions(transactions):
+    "Return trie of the accounts used in transactions."
+    return build_account_trie(posting['account'] for transaction in transactions for posting in transaction['postings'])
+
+def is_account_pattern(account_string):
+    "Does account_string contain wildcards?"
+    return any(character in account_string for character in "*?[")
+
+def _pattern_components(pattern):
+    "Internal. Split pattern into regularised components, leaving a root component with wildcards upper-cased."
+    components = pattern.split(':')
+    if is_account_pattern(components[0]):
+        root = components[0].upper()
+    else:
+        root = root_account_name(pattern)
+    return [root] + [component.upper() for component in components[1:]]
+
+def _match_account_patterns(trie, patterns):
+    """Internal. Match patterns against accounts in trie, in one walk of the trie.
+
+    Returns (matches, matched) where matches[n] are the accounts first
+    matched by the nth pattern, and matched[n] says whether the nth
+    pattern matched anything."""
+    compiled = [_pattern_components(pattern) for pattern in patterns]
+    matches = [[] for pattern in patterns]
+    matched = [False for pattern in patterns]
+    ## Stack entries are (node, account string, depth, indices of patterns matching so far)
+    stack = [(trie, "", 0, range(len(compiled)))]
+    while stack:
+        (node, account_string, depth, alive) = stack.pop()
+        if any(is_account_pattern(compiled[index][depth]) for index in alive):
+            keys = sorted(node.children.keys())
+        else:
+            keys = sorted(set(compiled[index][depth] for index in alive) & set(node.children.keys()))
+        children = []
+        for key in keys:
+            child = node.children[key]
+            child_string = account_string + child.original_name
+            matching = [index for index in alive if fnmatch.fnmatchcase(key, compiled[index][depth])]
+            complete = [index for index in matching if len(compiled[index]) == depth + 1]
+            if complete:
+                matches[complete[0]].append(child_string)
+                for index in complete:
+                    matched[index] = True
+            continuing = [index for index in matching if len(compiled[index]) > depth + 1]
+            if continuing:
+                children.append((child, child_string + ":", depth + 1, continuing))
+        stack.extend(reversed(children))
+    return (matches, matched)
+
+def match_account_patterns(trie, patterns):
+    """Return accounts in trie matching any of patterns, spelled as in the trie.
+
+    Accounts matching the first pattern come first, then new matches
+    for the second pattern and so on, each in account order."""
+    (matches, _) = _match_account_patterns(trie, patterns)
+    return [account_string for pattern_matches in matches for account_string in pattern_matches]
+
+def complete_account(trie, prefix):
+    "Return accounts in trie whose names start with prefix, ignoring case."
+    components = prefix.split(':')
+    node = trie
+    account_string = ""
+    if len(components) > 1:
+        for component in _pattern_components(":".join(components[:-1])):
+            if not node.children.has_key(component):
+                return []
+            node = node.children[component]
+            account_string += node.original_name + ":"
+    last = components[-1].upper()
+    return [account_string + node.children[key].original_name
+            for key in sorted(node.children.keys()) if key.startswith(last)]
+
+def expand_account_patterns(trie, account_strings):
+    """Return account_strings with each pattern replaced by the accounts it matches.
+
+    Account names without wildcards are left alone. Complains and
+    exits if a pattern matches nothing."""
+    patterns = [account_string for account_string in account_strings if is_account_pattern(account_string)]
+    (matches, matched) = _match_account_patterns(trie, patterns)
+    for index in range(len(patterns)):
+        if not matched[index]:
+            sys.stderr.write("No accounts match '%s'.\nExiting.\n" % patterns[index])
+            sys.exit(-1)
+    expanded = []
+    pattern_matches = iter(matches)
+    for account_string in account_strings:
+        if is_account_pattern(account_string):
+            expanded.extend(next(pattern_matches))
+        else:
+            expanded.append(account_string)
+    return expanded
+
+# }}}
+
 def book_posting(posting, account_tree):
     "Update balances in account_tree using account & amount from posting."
 
     amount = posting.amount
-    units = amount['units']
-    quantity = amount['quantity']
     account_string = posting.account
 
     leaf_account = find_account(account_string, account_tree)
     if not posting in leaf_account.postings:
         leaf_account.postings.append(posting)
 
+    book_amount(account_string, amount, account_tree)
+
+def book_amount(account_string, amount, account_tree):
+    "Add amount to balances of account_string and its parents in account_tree."
+    units = amount['units']
+    quantity = amount['quantity']
     for account in account_and_parents(account_string, account_tree):
         balances = account.balances
         if balances.has_key(units):
@@ -769,82 +1702,348 @@ def calculate_balances(transactions, as_at_date):
         txn_count+=1
     return account_tree
 
-def single_unit_balances_helper(accounts_dict, account_names, prefix= "", indent=0, print_stars_for_org_mode=False):
-    """Internal.
+# {{{ Account tree snapshots
 
-    Return list of (amount, account-name) string pairs showing a/c structure."""
+## calculate_balances books postings into an account tree in place, so
+## each as-at date needs a tree of its own. Booking into a snapshot
+## instead copies just the accounts on the path from the root to the
+## posting's account, and shares every other account (and all postings
+## lists) with the snapshot it came from. Keeping the snapshot current
+## at each of several dates then costs memory proportional to the
+## accounts booked to in between, not to the whole tree.
 
-    result = []
+def _add_to_balances(balances, amount):
+    "Internal. Return copy of balances with amount added, leaving balances alone."
+    units = amount['units']
+    result = dict(balances)
+    if result.has_key(units):
+        result[units] = {'units': units, 'quantity': result[units]['quantity'] + amount['quantity']}
+    else:
+        result[units] = dict(amount)
+    return result
 
-    if len(account_names) > 0:
-        for account_name in account_names:
-            account = find_account(account_name, accounts_dict)
-            result += single_unit_balances_helper({account['name']: account}, [],
-                                                  prefix=find_original_prefix(account_name, accounts_dict),
-                                                  indent=indent,
-                                                  print_stars_for_org_mode=print_stars_for_org_mode)
-        return result
-    ## else account_names = [] => print for all accounts
-    accounts =  accounts_dict.keys()
-    accounts.sort()
-
-    for account in accounts:
-        account_name = accounts_dict[account].original_name
-        sub_accounts = accounts_dict[account].sub_accounts.keys()
-        balances  = accounts_dict[account].balances
-        postings = accounts_dict[account].postings
-        amount_string = format_nil_or_single_unit_amount(balances)
+def book_amount_to_snapshot(account_string, amount, accounts_dict):
+    """Return a new snapshot of accounts_dict with amount added to account_string and its parents.
+
+    accounts_dict isn't changed. Accounts not on the path to
+    account_string are shared between the old and new snapshots.
+    Accounts that don't exist yet are added."""
+    components = account_string_components(account_string)
+    result = dict(accounts_dict)
+    sub_accounts = result
+    for (original, component) in zip(components['original'], components['regular']):
+        account = sub_accounts.get(component) or _make_account(original)
+        account = account._replace(sub_accounts=dict(account.sub_accounts),
+                                   balances=_add_to_balances(account.balances, amount))
+        sub_accounts[component] = account
+        sub_accounts = account.sub_accounts
+    return result
+
+def account_tree_snapshots(transactions, dates):
+    """Return dictionary of date -> account tree with balances from transactions as at that date.
+
+    The trees are snapshots sharing unchanged accounts, built in one
+    pass over transactions (in date order). Their postings are all
+    those of transactions, as for calculate_balances. The snapshots
+    must not be changed in place."""
+    account_tree = account_tree_from_transactions(transactions)
+    transactions = sorted(transactions, key=lambda transaction: transaction['date'])
+    snapshots = {}
+    txn_index = 0
+    for date in sorted(dates):
+        while txn_index < len(transactions) and transactions[txn_index]['date'] <= date:
+            for posting in transactions[txn_index]['postings']:
+                account_tree = book_amount_to_snapshot(posting['account'], posting['amount'], account_tree)
+            txn_index += 1
+        snapshots[date] = account_tree
+    return snapshots
+
+# }}}
+
+def single_unit_balances_helper(accounts_dict, account_names, print_stars_for_org_mode=False, depth=None,
+                                price_index=None, as_at_date=None):
+    """Internal.
+
+    Return list of (stars, amount, account-name) string triples showing a/c structure.
+    If price_index is given, amounts are market values as at as_at_date."""
+    result = []
+    for line in account_tree_lines(accounts_dict, account_names, depth):
         if print_stars_for_org_mode:
-            stars = ("*"*(indent+1))
+            stars = ("*"*(line.indent+1))
         else:
-            stars=""
-        if len(sub_accounts) == 0:
-            result += [(stars, amount_string, (" " * (indent*2)) + prefix + account_name)]
-        elif (len(sub_accounts) == 1 and not postings):
-            result += single_unit_balances_helper(accounts_dict[account].sub_accounts, [], prefix+account_name+":", indent, print_stars_for_org_mode)
+            stars = ""
+        if price_index is None:
+            amount_text = format_amounts(line.account.balances)
         else:
-            result += [(stars, amount_string, (" " * (indent*2)) + prefix + account_name)]
-            result += single_unit_balances_helper(accounts_dict[account].sub_accounts, [], "", indent+1, print_stars_for_org_mode)
+            amount_text = _format_quantities(market_value(_balance_quantities(line.account.balances),
+                                                          price_index, as_at_date))
+        result.append((stars,
+                       amount_text,
+                       (" " * (line.indent*2)) + line.name))
     return result
 
+def _report_balance(balances, price_index, as_at_date):
+    "Internal. Return units -> quantity dictionary of balances, or of their market value as at as_at_date if price_index is given."
+    if price_index is None:
+        return _balance_quantities(balances)
+    return market_value(_balance_quantities(balances), price_index, as_at_date)
+
 BalanceReportLine = namedtuple('BalanceReportLine', ['account_name', 'balance', 'indent', 'postings'])
 
-def single_unit_report_helper(accounts_dict, account_names=None, prefix= "", indent=0):
+def single_unit_report_helper(accounts_dict, account_names=None, depth=None, price_index=None, as_at_date=None):
     """Internal.
-    Return list of (amount, account-name) string pairs showing a/c structure."""
-    result = []
+    Return list of BalanceReportLines showing a/c structure, with
+    balances as units -> quantity dictionaries. If price_index is
+    given, balances are market values as at as_at_date."""
+    return [BalanceReportLine(account_name=line.name,
+                              balance=_report_balance(line.account.balances, price_index, as_at_date),
+                              indent=line.indent,
+                              postings=line.account.postings)
+            for line in account_tree_lines(accounts_dict, account_names, depth)]
+
+AccountTreeLine = namedtuple('AccountTreeLine', ['account', 'name', 'indent', 'account_string'])
+
+def account_tree_lines(accounts_dict, account_names=None, depth=None):
+    """Generate a line for each account shown in a balance report.
+
+    An account with a single sub-account and no postings of its own
+    shares a line with its sub-account. If account_names are given,
+    only those accounts (and their sub-accounts) are shown. If depth is
+    given, accounts more than depth levels deep aren't shown; their
+    balances are included in their parents'. Each line also carries
+    the regularised account string of its account.
+
+    Works from an explicit stack rather than recursion, so each
+    account is visited once and lines are generated as they are
+    reached."""
+    ## Stack entries are (account, prefix of name, indent, regularised account string, level)
+    stack = []
     if account_names:
-        ## XXX: Fix this, so it does something useful....
-        for account_name in account_names:
-            account = find_account(account_name, accounts_dict)
-            result += single_unit_report_helper({account['name']: account}, [],
-                                                  prefix=find_original_prefix(account_name, accounts_dict),
-                                                  indent=indent)
-        return result
-    ## else account_names = [] => print for all accounts
-    accounts =  accounts_dict.keys()
-    accounts.sort()
-    for account in accounts:
-        account_name = accounts_dict[account].original_name
-        sub_accounts = accounts_dict[account].sub_accounts.keys()
-        balances  = accounts_dict[account].balances
-        postings = accounts_dict[account].postings
-        balance = extract_single_unit_quantity(balances)
-        if len(sub_accounts) == 0:
-            result.append(BalanceReportLine(account_name = prefix + account_name,
-                                            balance = balance,
-                                            indent = indent,
-                                            postings=postings))
-        elif (len(sub_accounts) == 1 and not postings):
-            result += single_unit_report_helper(accounts_dict[account].sub_accounts, [], prefix+account_name+":", indent)
+        for account_name in reversed(account_names):
+            path = account_and_parents(account_name, accounts_dict)
+            stack.append((path[-1],
+                          "".join(account.original_name + ":" for account in path[:-1]),
+                          0,
+                          ":".join(account_string_components(account_name)['regular']),
+                          len(path)))
+    else:
+        for key in sorted(accounts_dict.keys(), reverse=True):
+            stack.append((accounts_dict[key], "", 0, key, 1))
+    while stack:
+        (account, prefix, indent, account_string, level) = stack.pop()
+        name = prefix + account.original_name
+        if len(account.sub_accounts) == 0 or (depth is not None and level >= depth):
+            yield AccountTreeLine(account, name, indent, account_string)
+        elif (len(account.sub_accounts) == 1 and not account.postings):
+            (key, sub_account) = account.sub_accounts.items()[0]
+            stack.append((sub_account, name + ":", indent, account_string + ":" + key, level + 1))
+        else:
+            yield AccountTreeLine(account, name, indent, account_string)
+            for key in sorted(account.sub_accounts.keys(), reverse=True):
+                stack.append((account.sub_accounts[key], "", indent + 1, account_string + ":" + key, level + 1))
+
+def _balance_quantities(balances):
+    "Internal. Copy balances as a units -> quantity dictionary."
+    return dict((units, amount['quantity']) for (units, amount) in balances.items())
+
+def balance_columns(transactions, account_names, dates, depth=None):
+    """Return report lines and each line's balances at each of dates, in one pass over transactions.
+
+    Returns (lines, columns) where lines are AccountTreeLines and
+    columns[n][i] is the units -> quantity balance of lines[i] at the
+    nth (sorted) date."""
+    dates = sorted(dates)
+    transactions = filter_by_date(transactions, last_date = dates[-1])
+    if account_names:
+        transactions = transactions_restricted_to_accounts(transactions, account_names,
+                                                           build_account_index(transactions))
+    account_tree = account_tree_from_transactions(transactions)
+    lines = list(account_tree_lines(account_tree, account_names, depth))
+    transactions = sorted(transactions, key=lambda transaction: transaction['date'])
+    columns = []
+    txn_index = 0
+    for date in dates:
+        while txn_index < len(transactions) and transactions[txn_index]['date'] <= date:
+            for posting in transactions[txn_index]['postings']:
+                book_amount(posting['account'], posting['amount'], account_tree)
+            txn_index += 1
+        columns.append([_balance_quantities(line.account.balances) for line in lines])
+    return (lines, columns)
+
+def database_balance_columns(db, account_names, dates, depth=None):
+    "Return same (lines, columns) as balance_columns, using SQL aggregates from journal database db."
+    dates = sorted(dates)
+    lines = None
+    columns = []
+    for date in dates:
+        date_lines = list(account_tree_lines(database_account_tree(db, date, account_names, accounts_as_at=dates[-1]),
+                                             account_names, depth))
+        lines = lines or date_lines
+        columns.append([_balance_quantities(line.account.balances) for line in date_lines])
+    return (lines, columns)
+
+def _format_quantities(quantities):
+    "Internal. Format units -> quantity dictionary."
+    return format_amounts(dict((units, {'units': units, 'quantity': quantity})
+                               for (units, quantity) in quantities.items()))
+
+def _quantities_change(earlier, later):
+    "Internal. Return later - earlier, where both are units -> quantity dictionaries."
+    change = dict(later)
+    for (units, quantity) in earlier.items():
+        change[units] = change.get(units, 0) - quantity
+    return change
+
+def _format_change(earlier, later):
+    "Internal. Format later - earlier, where both are units -> quantity dictionaries."
+    return _format_quantities(_quantities_change(earlier, later))
+
+def print_multi_date_balances(lines, columns, dates, print_stars_for_org_mode):
+    """Print balances at each of dates, then changes between them.
+
+    With more than two dates, the change since the previous date is
+    shown for each date after the first, followed by the total change."""
+    dates = sorted(dates)
+    header = list(dates)
+    if len(dates) > 2:
+        header += ["Change to " + date for date in dates[1:]]
+    rows = []
+    for line_index in range(len(lines)):
+        line = lines[line_index]
+        if print_stars_for_org_mode:
+            stars = "*" * (line.indent + 1)
         else:
-            result.append(BalanceReportLine(account_name = prefix + account_name,
-                                            balance = balance,
-                                            indent = indent,
-                                            postings=postings))
-            result += single_unit_report_helper(accounts_dict[account].sub_accounts, [], "", indent+1)
+            stars = ""
+        row = [stars] + [_format_quantities(column[line_index]) for column in columns]
+        if len(dates) > 2:
+            row += [_format_change(columns[n-1][line_index], columns[n][line_index]) for n in range(1, len(dates))]
+        row += [_format_change(columns[0][line_index], columns[-1][line_index]),
+                (" " * (line.indent*2)) + line.name]
+        rows.append(row)
+    ## Header is marked like the first line, so org-mode folds it with the report.
+    if rows:
+        header_stars = rows[0][0]
+    else:
+        header_stars = ""
+    rows.insert(0, [header_stars] + header + ["Change", "Account"])
+    for line in join_columns(justify_columns(rows, "L" + "R" * (len(rows[0]) - 2) + "L")):
+        print line
+
+# {{{ Account statistics
+
+## Each posting is summarised once, in a single pass over the
+## transactions, into its own account's statistics. Sub-account
+## statistics are then combined up the tree in one post-order walk.
+
+AccountStatistics = namedtuple('AccountStatistics',
+                               ['units', 'count', 'turnover', 'minimum', 'maximum', 'first_date', 'last_date', 'net'])
+
+def _posting_statistics(date, amount):
+    "Internal. Return AccountStatistics for a single posting of amount on date."
+    return AccountStatistics(units=amount['units'],
+                             count=1,
+                             turnover=abs(amount['quantity']),
+                             minimum=amount['quantity'],
+                             maximum=amount['quantity'],
+                             first_date=date,
+                             last_date=date,
+                             net=amount['quantity'])
+
+def _combine_statistics(statistics1, statistics2):
+    "Internal. Return AccountStatistics covering the postings of both, either of which may be None."
+    if statistics1 is None:
+        return statistics2
+    if statistics2 is None:
+        return statistics1
+    if statistics1.units <> statistics2.units:
+        raise ValueError("_combine_statistics: different units:", statistics1.units, statistics2.units)
+    return AccountStatistics(units=statistics1.units,
+                             count=statistics1.count + statistics2.count,
+                             turnover=statistics1.turnover + statistics2.turnover,
+                             minimum=min(statistics1.minimum, statistics2.minimum),
+                             maximum=max(statistics1.maximum, statistics2.maximum),
+                             first_date=min(statistics1.first_date, statistics2.first_date),
+                             last_date=max(statistics1.last_date, statistics2.last_date),
+                             net=statistics1.net + statistics2.net)
+
+def _combine_unit_statistics(statistics1, statistics2):
+    "Internal. Return units -> AccountStatistics covering the postings of both units -> AccountStatistics."
+    result = dict(statistics1)
+    for (units, statistics) in statistics2.items():
+        result[units] = _combine_statistics(result.get(units), statistics)
+    return result
+
+def _rolled_up_statistics(accounts_dict, prefix, own_statistics, result):
+    "Internal. Add statistics of accounts in accounts_dict, including their sub-accounts, to result."
+    for key in accounts_dict.keys():
+        account_string = prefix + key
+        sub_accounts = accounts_dict[key].sub_accounts
+        _rolled_up_statistics(sub_accounts, account_string + ":", own_statistics, result)
+        statistics = own_statistics.get(account_string, {})
+        for sub_key in sub_accounts.keys():
+            statistics = _combine_unit_statistics(statistics, result[account_string + ":" + sub_key])
+        result[account_string] = statistics
+
+def account_statistics(transactions, accounts_dict):
+    """Return regularised account string -> units -> AccountStatistics for accounts in accounts_dict.
+
+    accounts_dict is the account tree of transactions (see
+    account_tree_from_transactions). Statistics for an account include
+    its sub-accounts' postings, and are kept separately for each
+    unit/ccy, so a journal of several commodities never mixes them."""
+    own_statistics = defaultdict(dict)
+    for transaction in transactions:
+        for posting in transaction['postings']:
+            amount = posting['amount']
+            statistics = own_statistics[regular_account_string(posting['account'])]
+            statistics[amount['units']] = _combine_statistics(statistics.get(amount['units']),
+                                                              _posting_statistics(transaction['date'], amount))
+    result = {}
+    _rolled_up_statistics(accounts_dict, "", own_statistics, result)
     return result
 
+def months_spanned(first_date, last_date):
+    "Number of calendar months from first_date's month to last_date's month, inclusive."
+    return ((int(last_date[:4]) * 12 + int(last_date[5:7])) -
+            (int(first_date[:4]) * 12 + int(first_date[5:7])) + 1)
+
+def print_account_statistics(transactions, account_names, print_stars_for_org_mode, first_date, last_date, depth=None):
+    """Print posting statistics for accounts and their sub-accounts.
+
+    Accounts with postings in several units/ccys get a line for each.
+    Average monthly flow is the net change spread over the months from
+    the account's first to last posting."""
+    transactions = filter_by_date(transactions, first_date, last_date)
+    account_tree = account_tree_from_transactions(transactions)
+    statistics = account_statistics(transactions, account_tree)
+    rows = [["", "Postings", "Turnover", "Minimum", "Maximum", "First", "Last", "Monthly flow", "Account"]]
+    for line in account_tree_lines(account_tree, account_names, depth):
+        if print_stars_for_org_mode:
+            stars = "*" * (line.indent + 1)
+        else:
+            stars = ""
+        unit_statistics = statistics[line.account_string]
+        for units in sorted(unit_statistics.keys()):
+            line_statistics = unit_statistics[units]
+            def amount(quantity):
+                return format_amount({'units': units, 'quantity': quantity})
+            rows.append([stars,
+                         str(line_statistics.count),
+                         amount(line_statistics.turnover),
+                         amount(line_statistics.minimum),
+                         amount(line_statistics.maximum),
+                         line_statistics.first_date,
+                         line_statistics.last_date,
+                         amount(int(round(float(line_statistics.net) /
+                                          months_spanned(line_statistics.first_date, line_statistics.last_date)))),
+                         (" " * (line.indent*2)) + line.name])
+    if len(rows) > 1:
+        rows[0][0] = rows[1][0]
+    for line in join_columns(justify_columns(rows, "LRRRRLLRL")):
+        print line
+
+# }}}
+
 def validate_one_date_or_two(as_at_date, first_date, last_date):
     if (as_at_date):
         # If you specify as-at-date, you can't specify first or last dates
@@ -869,7 +2068,13 @@ def validate_one_date_or_two(as_at_date, first_date, last_date):
                              "Exiting."%(last_date))
             sys.exit(-1)
 
-def write_excel_report(transactions, dates, output_filename):
+def excel_report_filename(output_filename):
+    "Return name of the file the Excel report named output_filename is written to."
+    if not output_filename.endswith('.xls'):
+        output_filename += '.xls'
+    return output_filename
+
+def write_excel_report(transactions, dates, output_filename, price_index=None):
     TXN_COLOUR = 7
     ## XXX: Should allow list of accounts to be named.
     dates = sorted(dates)
@@ -882,10 +2087,19 @@ def write_excel_report(transactions, dates, output_filename):
         sys.exit(-1)
     input_transactions = transactions
     transactions = filter_by_date(transactions, last_date = dates[-1])
+    def posting_value_as_at(posting, date):
+        "Units -> quantity value of posting as at date: nothing before it was made, and its market value with price_index."
+        if posting.date > date:
+            return {}
+        quantities = {posting.amount['units']: posting.amount['quantity']}
+        if price_index is None:
+            return quantities
+        return market_value(quantities, price_index, date)
     ## Get sorted list of dates/accounts/balances for each date
+    snapshots = account_tree_snapshots(transactions, dates)
     balances_at = {}
     for date in dates:
-        balances_at[date] = single_unit_report_helper(calculate_balances(transactions, date))
+        balances_at[date] = single_unit_report_helper(snapshots[date], price_index=price_index, as_at_date=date)
         max_indent = max([line.indent for line in balances_at[date]])
     num_lines = len(balances_at[dates[0]])
     ## Create Sheet
@@ -899,6 +2113,36 @@ def write_excel_report(transactions, dates, output_filename):
     txn_value_font.pattern.pattern_fore_colour = TXN_COLOUR
     txn_text_font = xlwt.easyxf('pattern: pattern solid;')
     txn_text_font.pattern.pattern_fore_colour = TXN_COLOUR
+    ## Commodities get their units in place of the $
+    commodity_fonts = {}
+    def value_style(units, in_transaction):
+        "Style for quantities of units, shaded like txn_value_font if in_transaction."
+        if units == DEFAULT_UNITS:
+            return txn_value_font if in_transaction else value_font
+        if not commodity_fonts.has_key((units, in_transaction)):
+            number_format = '_-* #,##0.00 "{0}"_-;[Red]-* #,##0.00 "{0}"_-;_-* "-"?? "{0}"_-;_-@_-'.format(units)
+            style = xlwt.easyxf('pattern: pattern solid;' if in_transaction else '', number_format)
+            if in_transaction:
+                style.pattern.pattern_fore_colour = TXN_COLOUR
+            commodity_fonts[(units, in_transaction)] = style
+        return commodity_fonts[(units, in_transaction)]
+    def write_quantities(row, col, quantities, in_transaction=False):
+        "Write units -> quantity dictionary to a cell: as a number if there's one unit, as text if there are several."
+        units_held = [units for units in quantities.keys() if quantities[units] != 0]
+        if len(units_held) > 1:
+            text = _format_quantities(dict((units, quantities[units]) for units in units_held))
+            if in_transaction:
+                ws.write(row, col, text, txn_text_font)
+            else:
+                ws.write(row, col, text)
+            return
+        if units_held:
+            units = units_held[0]
+        elif len(quantities) == 1:
+            units = quantities.keys()[0]
+        else:
+            units = DEFAULT_UNITS
+        ws.write(row, col, quantities.get(units, 0) * 0.01, value_style(units, in_transaction))
     ## Like heading, but right-aligned
     column_heading_style = xlwt.easyxf("font: bold on")
     alignment = xlwt.Alignment()
@@ -937,7 +2181,7 @@ def write_excel_report(transactions, dates, output_filename):
     account_names_dict = {}       # acc_idx -> account-name
     row_dict = defaultdict(int)   # acc_idx-> row_num
     indent_dict = {}              # row_num -> line indentation
-    values_dict = defaultdict(int)# date_idx x row_num -> value
+    values_dict = defaultdict(dict)# date_idx x row_num -> units -> quantity
     ##
     for date_index in range(len(dates)):
         date = dates[date_index]
@@ -969,17 +2213,19 @@ def write_excel_report(transactions, dates, output_filename):
                  account_names_dict[acc_index])
         ## Write balance at date
         for date_index in range(num_dates):
-            ws.write(row_dict[acc_index], date_index, values_dict[(date_index, row_dict[acc_index])] * 0.01, value_font)
+            write_quantities(row_dict[acc_index], date_index, values_dict[(date_index, row_dict[acc_index])])
         ## Write balance differences
         for date_index in range(1, num_dates):
-            ws.write(row_dict[acc_index],
-                     date_index+num_dates,
-                     (values_dict[(date_index, row_dict[acc_index])]-values_dict[(date_index-1, row_dict[acc_index])]) * 0.01, value_font)
+            write_quantities(row_dict[acc_index],
+                             date_index+num_dates,
+                             _quantities_change(values_dict[(date_index-1, row_dict[acc_index])],
+                                                values_dict[(date_index, row_dict[acc_index])]))
         ## Write total difference
         ## last-date - date[0]
-        ws.write(row_dict[acc_index],
-                 2*num_dates,
-                 (values_dict[(num_dates-1, row_dict[acc_index])]-values_dict[(0, row_dict[acc_index])]) * 0.01, value_font)
+        write_quantities(row_dict[acc_index],
+                         2*num_dates,
+                         _quantities_change(values_dict[(0, row_dict[acc_index])],
+                                            values_dict[(num_dates-1, row_dict[acc_index])]))
         ## For the postings at the final date:
         postings = balances_at[dates[-1]][acc_index].postings
         for p_index in range(len(postings)):
@@ -1008,34 +2254,20 @@ def write_excel_report(transactions, dates, output_filename):
                      postings[p_index].comment,
                      txn_text_font)
             ## Write total amount for each date
+            values = [posting_value_as_at(postings[p_index], date) for date in dates]
             for date_index in range(len(dates)):
-                if postings[p_index].date <= dates[date_index]:
-                    ws.write(row, date_index, postings[p_index].amount['quantity'] * 0.01, txn_value_font)
-                else:
-                    ws.write(row, date_index, 0, txn_value_font)
+                write_quantities(row, date_index, values[date_index], True)
             ## Write difference amount for each date after first
             for date_index in range(1, num_dates):
-                if postings[p_index].date > dates[date_index-1] and postings[p_index].date <= dates[date_index]:
-                    ws.write(row,
-                             date_index+num_dates,
-                             postings[p_index].amount['quantity'] * 0.01,
-                             txn_value_font)
-                else:
-                    ws.write(row,
-                             date_index+num_dates,
-                             0,
-                             txn_value_font)
+                write_quantities(row,
+                                 date_index+num_dates,
+                                 _quantities_change(values[date_index-1], values[date_index]),
+                                 True)
             ## Write "Total Difference" for final date
-            if postings[p_index].date > dates[0] and postings[p_index].date <= dates[-1]:
-                ws.write(row,
-                         2*num_dates,
-                         postings[p_index].amount['quantity'] * 0.01,
-                         txn_value_font)
-            else:
-                ws.write(row,
-                         2*num_dates,
-                         0,
-                         txn_value_font)
+            write_quantities(row,
+                             2*num_dates,
+                             _quantities_change(values[0], values[-1]),
+                             True)
     ## Set line indent
     for row in sorted(indent_dict.keys()):
         ws.row(row).level = indent_dict[row]
@@ -1057,7 +2289,7 @@ def write_excel_report(transactions, dates, output_filename):
         ws.write(row, 3, transaction['description'])
         for p in transaction['postings']:
             row += 1
-            ws.write(row, 2, p['amount']['quantity'] * 0.01, value_font)
+            write_quantities(row, 2, {p['amount']['units']: p['amount']['quantity']})
             ws.write(row, 3, p['account'])
         row += 1
     ## Chart of accounts
@@ -1066,86 +2298,198 @@ def write_excel_report(transactions, dates, output_filename):
     for line in chart_of_accounts(account_tree_from_transactions(input_transactions)):
          ws.write(row, line.indent, line.name)
          row+=1
-    if not output_filename.endswith('.xls'):
-        output_filename += '.xls'
+    output_filename = excel_report_filename(output_filename)
     wb.save(output_filename)
     sys.stderr.write("Wrote excel output to '{}'.\n".format(os.path.abspath(output_filename)))
 
-def print_single_unit_balances(transactions, account_names, print_stars_for_org_mode, as_at_date, first_date, last_date):
-    """Print balances of accounts. Assumes only 1 unit/ccy per account.
+def balance_report_dates(as_at_date, first_date, last_date, dates):
+    """Return dates a balance report should show balances at, or None for one balance as at as_at_date.
+
+    Exits if the dates given don't make sense together."""
+    if dates:
+        if as_at_date or first_date or last_date:
+            sys.stderr.write("Error: dates: %s specified in addition to as-at-date, first-date or last-date.\n"
+                             "Exiting.\n" % " ".join(dates))
+            sys.exit(-1)
+        return [reformat_date(date) for date in dates]
+    validate_one_date_or_two(as_at_date, first_date, last_date)
+    if first_date and last_date:
+        return [first_date, last_date]
+    return None
+
+def balances_as_at(transactions, account_names, as_at_date, database=None):
+    "Return account tree with balances of account_names (or all accounts) as at as_at_date."
+    if database:
+        return database_account_tree(database, as_at_date, account_names)
+    if account_names:
+        ## Only the named accounts' postings can affect the balances.
+        transactions = transactions_restricted_to_accounts(transactions, account_names,
+                                                           journal_index(build_account_index, transactions))
+    transactions = filter_by_date(transactions, last_date = as_at_date)
+    return calculate_balances(transactions, as_at_date)
+
+def print_single_unit_balances(transactions, account_names, print_stars_for_org_mode, as_at_date, first_date, last_date,
+                               database=None, dates=None, depth=None, price_index=None):
+    """Print balances of accounts. Accounts holding several units/ccys list each of them.
 
     If account_names = [], assume all accounts, otherwise just the specified accounts.
+    If dates are given, or first_date and last_date, print balances at each date and the changes between them.
+    If database is given, balances come from it instead of transactions.
+    If depth is given, only show accounts down to that many levels deep.
+    If price_index is given, print market values at each date instead.
     """
 
-    validate_one_date_or_two(as_at_date, first_date, last_date)
+    dates = balance_report_dates(as_at_date, first_date, last_date, dates)
+    if dates:
+        if database:
+            (lines, columns) = database_balance_columns(database, account_names, dates, depth)
+        else:
+            (lines, columns) = balance_columns(transactions, account_names, dates, depth)
+        if price_index is not None:
+            columns = [[market_value(quantities, price_index, date) for quantities in column]
+                       for (column, date) in zip(columns, sorted(dates))]
+        print_multi_date_balances(lines, columns, dates, print_stars_for_org_mode)
+        return
 
-    if (not first_date) and (not last_date):
+    account_tree = balances_as_at(transactions, account_names, as_at_date, database)
+    balance_text = single_unit_balances_helper(account_tree,
+                                               account_names,
+                                               print_stars_for_org_mode=print_stars_for_org_mode,
+                                               depth=depth,
+                                               price_index=price_index,
+                                               as_at_date=as_at_date)
+    for line in join_columns(justify_columns(balance_text, "LRL")):
+        print line
 
-        transactions = filter_by_date(transactions, last_date = as_at_date)
-        balance_text = single_unit_balances_helper(calculate_balances(transactions, as_at_date),
-                                                   account_names,
-                                                   print_stars_for_org_mode=print_stars_for_org_mode)
-        for line in join_columns(justify_columns(balance_text, "LRL")):
-            print line
-    if first_date and last_date:
-        transactions = filter_by_date(transactions, last_date = last_date)
-        first_text = single_unit_balances_helper(calculate_balances(transactions, first_date),
-                                                 account_names,
-                                                 print_stars_for_org_mode=print_stars_for_org_mode)
-        last_text = single_unit_balances_helper(calculate_balances(transactions, last_date),
-                                                account_names,
-                                                print_stars_for_org_mode=False)
-
-        new_text = [(first_text[0][0], first_date, last_date, "Change","Account")]
-        for i in range(len(first_text)):
-            new_text += [tuple(list(first_text[i][:2]) + [last_text[i][1]]
-                               + [format_amount(difference_nil_or_single_unit_amount(parse_amount(last_text[i][1]),
-                                                                                     parse_amount(first_text[i][1])))]
-                               + [last_text[i][2]])]
-
-        for line in join_columns(justify_columns(new_text , "LRRRL")):
-            print line
-            format_amount(difference_nil_or_single_unit_amount(parse_amount("-$1,900.00"), parse_amount("$1,900.00")))
-
-def calculate_register(transactions, account_string, include_related_postings, first_date, last_date):
-    "Calculate text showing effect of transactions on relevant account."
-    result = []
-    transactions = filter_by_account(transactions, account_string)
-    account_tree = account_tree_from_transactions(transactions)
-    for transaction in transactions:
+def _register_postings(transactions_and_relevant_postings, include_related_postings, first_date, last_date, balances,
+                       shown=None):
+    """Internal. Generate register entries for (transaction, relevant posting #s) pairs.
+
+    Entries are (transaction, posting, shows transaction?, balance),
+    where balance is the account's units -> amount balance after a
+    relevant posting, and None for related postings. balances holds the account's
+    balance before the first transaction, and is updated as postings
+    are booked. If shown is given, only transactions whose id() is in
+    it get entries, but every transaction counts towards balances."""
+    for (transaction, relevant) in transactions_and_relevant_postings:
         first_posting_output = False
-        for posting in transaction['postings']:
-            if affects(posting, account_string):
-                book_posting(Posting(date=transaction['date'],
-                                         amount=posting['amount'],
-                                         account=posting['account'],
-                                         comment=transaction['description'],
-                                         transaction_id=None),
-                             account_tree)
-            if (((not first_date) or (transaction['date'] >= first_date)) and
-                ((not last_date) or (transaction['date'] <= last_date))):
-                if not first_posting_output or (affects(posting, account_string) and not include_related_postings):
-                    date_string = transaction['date']
-                    description_string = transaction['description']
-                else:
-                    date_string = ""
-                    description_string = ""
-                if affects(posting, account_string):
-                    balance_string = format_single_unit_amount(find_account(account_string, account_tree).balances)
+        for posting_number in range(len(transaction['postings'])):
+            posting = transaction['postings'][posting_number]
+            affects_account = posting_number in relevant
+            if affects_account:
+                units = posting['amount']['units']
+                if balances.has_key(units):
+                    balances[units]['quantity'] += posting['amount']['quantity']
                 else:
-                    balance_string = ""
-                if affects(posting, account_string) or include_related_postings:
+                    balances[units] = dict(posting['amount'])
+            if (((not first_date) or (transaction['date'] >= first_date)) and
+                ((not last_date) or (transaction['date'] <= last_date)) and
+                (shown is None or id(transaction) in shown)):
+                if affects_account or include_related_postings:
+                    shows_transaction = not first_posting_output or (affects_account and not include_related_postings)
+                    if affects_account:
+                        balance = dict((units, dict(amount)) for (units, amount) in balances.items())
+                    else:
+                        balance = None
                     first_posting_output = True
-                    result += [(date_string,
-                                balance_string,
-                                format_amount(posting['amount']),
-                                posting['account'],
-                                description_string)]
+                    yield (transaction, posting, shows_transaction, balance)
 
+def _register_lines(register_postings):
+    "Internal. Return register lines for entries from _register_postings."
+    result = []
+    for (transaction, posting, shows_transaction, balance) in register_postings:
+        if shows_transaction:
+            date_string = transaction['date']
+            description_string = transaction['description']
+        else:
+            date_string = ""
+            description_string = ""
+        if balance is not None:
+            balance_string = format_amounts(balance)
+        else:
+            balance_string = ""
+        result += [(date_string,
+                    balance_string,
+                    format_amount(posting['amount']),
+                    posting['account'],
+                    description_string)]
     return result
 
-def print_register(transactions, account_string, include_related_postings, reverse_print_order, first_date, last_date):
-    data = calculate_register(transactions, account_string, include_related_postings, first_date, last_date)
+def _transactions_and_relevant_postings(transactions, entries):
+    "Internal. Group sorted (transaction id, posting #) entries by transaction."
+    return [(transactions[txn_id], set(posting_number for (_, posting_number) in txn_entries))
+            for txn_id, txn_entries in groupby(entries, key=lambda entry: entry[0])]
+
+def calculate_register(transactions, account_string, include_related_postings, first_date, last_date, account_index=None,
+                       limit=None, tail=None, formatted=True, shown_transactions=None):
+    """Calculate text showing effect of transactions on relevant account.
+
+    If shown_transactions is given, only postings of those of
+    transactions are shown, with balances still coming from all of
+    them. With limit (or tail), only the first (or last) that many
+    postings to the account between first_date and last_date are
+    shown. The balance before them is the sum of earlier postings to the account
+    (or, during a batch, is looked up in its running-balance index, see
+    register_running_balances), without calculating register lines
+    for them, so the account's postings must be in date order. Unless formatted, generate entries from
+    _register_postings instead of text."""
+    if account_index is None:
+        account_index = journal_index(build_account_index, transactions)
+    entries = subtree_postings(account_index, account_string)
+    shown = None
+    if shown_transactions is not None:
+        ## Transactions are dictionaries, so they're identified by id().
+        shown = set(id(transaction) for transaction in shown_transactions)
+    if limit is None and tail is None:
+        register_postings = _register_postings(_transactions_and_relevant_postings(transactions, entries),
+                                               include_related_postings, first_date, last_date, {}, shown)
+        if not formatted:
+            return register_postings
+        return _register_lines(register_postings)
+    running_balances = None
+    if _register_running_balances is not None:
+        running_balances = register_running_balances(transactions, account_string, account_index)
+        dates = running_balances.dates
+    else:
+        dates = register_dates(transactions, account_string, entries)
+    first = bisect.bisect_left(dates, first_date) if first_date else 0
+    last = bisect.bisect_right(dates, last_date) if last_date else len(entries)
+    if shown is not None:
+        ## Count only the postings that are shown, booking those between them.
+        positions = [position for position in range(first, last) if id(transactions[entries[position][0]]) in shown]
+        if tail is not None:
+            positions = positions[max(0, len(positions) - tail):]
+        if limit is not None:
+            positions = positions[:limit]
+        if positions:
+            (first, last) = (positions[0], positions[-1] + 1)
+        else:
+            last = first
+    else:
+        if tail is not None:
+            first = max(first, last - tail)
+        if limit is not None:
+            last = min(last, first + limit)
+    if running_balances is not None:
+        opening_balance = running_balances.balances[first]
+    else:
+        opening_balance = balance_before(transactions, entries, first)
+    balances = dict((units, {'units': units, 'quantity': quantity})
+                    for (units, quantity) in opening_balance.items())
+    register_postings = _register_postings(_transactions_and_relevant_postings(transactions, entries[first:last]),
+                                           include_related_postings, None, None, balances, shown)
+    if not formatted:
+        return register_postings
+    return _register_lines(register_postings)
+
+def print_register(transactions, account_string, include_related_postings, reverse_print_order, first_date, last_date,
+                   database=None, limit=None, tail=None, shown_transactions=None):
+    if database:
+        data = database_register(database, account_string, include_related_postings, first_date, last_date,
+                                 limit=limit, tail=tail)
+    else:
+        data = calculate_register(transactions, account_string, include_related_postings, first_date, last_date,
+                                  limit=limit, tail=tail, shown_transactions=shown_transactions)
     data = rjust_column(data, 0)
     data = rjust_column(data, 1)
     data = rjust_column(data, 2)
@@ -1157,21 +2501,1616 @@ def print_register(transactions, account_string, include_related_postings, rever
     for line in data:
         print line
 
-def main():
-    "Program that runs if invoked as a script."
-    parser = argparse.ArgumentParser(description='Command-line, double-entry accounting in python.')
-    parser.add_argument('file', metavar='FILE',
-                        help='the input journal file to read from')
-    parser.add_argument('--tweak-signs-of-input-amounts',
-                        default=False,
-                        action="store_true",
-                        help="negate amounts from input file for equity/liabilities/income")
-    parser.add_argument('--verbose',
-                        default=False,
-                        action="store_true",
-                        help="print extra information while running")
-    parser.add_argument('--show-balance-verifications',
-                        default=False,
+# {{{ Diagnosing failed balance verifications
+
+## A running-balance index for one account (with its sub-accounts)
+## holds the balance after each of its postings, so the balance at any
+## date is a binary search away. The account's verifications can then
+## be bisected to find where its balance first goes wrong, instead of
+## rerunning reports with different --as-at dates.
+
+RunningBalances = namedtuple('RunningBalances',
+                             ['dates',      # date of each posting, in date order
+                              'entries',    # (transaction id, posting #) of each posting
+                              'balances'])  # units -> quantity after the first i postings
+
+VerificationDiagnosis = namedtuple('VerificationDiagnosis',
+                                   ['last_passed',   # verification just before first_failed, or None
+                                    'first_failed',  # earliest failing verification, or None if all hold
+                                    'difference',    # units -> actual minus expected quantity at first_failed
+                                    'candidates',    # (transaction id, posting #) dated between the two
+                                    'probes'])       # number of balance lookups made
+
+def build_running_balances(transactions, account_string, account_index):
+    "Return RunningBalances for account_string and its sub-accounts. Transactions must be date sorted."
+    entries = subtree_postings(account_index, account_string)
+    dates = []
+    balances = [{}]
+    for (txn_id, posting_number) in entries:
+        amount = transactions[txn_id]['postings'][posting_number]['amount']
+        balance = dict(balances[-1])
+        balance[amount['units']] = balance.get(amount['units'], 0) + amount['quantity']
+        dates.append(transactions[txn_id]['date'])
+        balances.append(balance)
+    return RunningBalances(dates=dates, entries=entries, balances=balances)
+
+def register_dates(transactions, account_string, entries):
+    "Return dates of entries (postings to account_string), exiting if they aren't in date order."
+    dates = [transactions[txn_id]['date'] for (txn_id, posting_number) in entries]
+    for position in range(1, len(dates)):
+        if dates[position] < dates[position - 1]:
+            transaction = transactions[entries[position][0]]
+            sys.stderr.write("Line %d: date: '%s' description: '%s' is not in date order.\n"
+                             "--limit and --tail need postings to '%s' in date order.\nExiting.\n" %
+                             (transaction['line'], transaction['date'], transaction['description'], account_string))
+            sys.exit(-1)
+    return dates
+
+def balance_before(transactions, entries, position):
+    "Return units -> quantity sum of the amounts of the first position entries."
+    balance = {}
+    for (txn_id, posting_number) in entries[:position]:
+        amount = transactions[txn_id]['postings'][posting_number]['amount']
+        balance[amount['units']] = balance.get(amount['units'], 0) + amount['quantity']
+    return balance
+
+def register_running_balances(transactions, account_string, account_index):
+    """Return RunningBalances for account_string, checking its postings are in date order.
+
+    During a batch they're kept in _register_running_balances, so
+    they're built once for each account and later registers of the
+    account only bisect them."""
+    key = (id(transactions), regular_account_string(account_string))
+    if not _register_running_balances.has_key(key):
+        running_balances = build_running_balances(transactions, account_string, account_index)
+        register_dates(transactions, account_string, running_balances.entries)
+        ## Keep transactions too, so its id isn't reused while the balances are kept.
+        _register_running_balances[key] = (transactions, running_balances)
+    return _register_running_balances[key][1]
+
+def running_balance_as_at(running_balances, date):
+    "Return units -> quantity balance after all postings dated on or before date."
+    return running_balances.balances[bisect.bisect_right(running_balances.dates, date)]
+
+def _verification_holds(verification, balance):
+    "Internal. Does verification match units -> quantity balance?"
+    amount = verification['amount']
+    return len(balance) == 1 and balance.get(amount['units']) == amount['quantity']
+
+def diagnose_verifications(transactions, verifications, account_string, account_index=None):
+    """Find where account_string's balance first disagrees with its verifications.
+
+    Like bisecting a history in version control, this assumes that once
+    a verification of the account fails, later ones fail too. Each
+    probe is a binary search of the running balances, so the whole
+    diagnosis takes O(log n) probes once the index is built."""
+    if account_index is None:
+        account_index = build_account_index(transactions)
+    running_balances = build_running_balances(transactions, account_string, account_index)
+    regular_account = regular_account_string(account_string)
+    ## Verification dates may be written in any format reformat_date accepts.
+    dated = sorted([(reformat_date(verification['date']), verification) for verification in verifications
+                    if regular_account_string(verification['account']) == regular_account],
+                   key=lambda entry: entry[0])
+    dates = [date for (date, _) in dated]
+    verifications = [verification for (_, verification) in dated]
+    probes = 0
+    low = 0
+    high = len(verifications)
+    while low < high:
+        middle = (low + high) // 2
+        probes += 1
+        if _verification_holds(verifications[middle], running_balance_as_at(running_balances, dates[middle])):
+            low = middle + 1
+        else:
+            high = middle
+    if low == len(verifications):
+        return VerificationDiagnosis(last_passed=verifications[-1] if verifications else None,
+                                     first_failed=None, difference={}, candidates=[], probes=probes)
+    first_failed = verifications[low]
+    last_passed = verifications[low - 1] if low > 0 else None
+    difference = dict(running_balance_as_at(running_balances, dates[low]))
+    probes += 1
+    expected = first_failed['amount']
+    difference[expected['units']] = difference.get(expected['units'], 0) - expected['quantity']
+    if last_passed is None:
+        first = 0
+    else:
+        first = bisect.bisect_right(running_balances.dates, dates[low - 1])
+    last = bisect.bisect_right(running_balances.dates, dates[low])
+    return VerificationDiagnosis(last_passed=last_passed,
+                                 first_failed=first_failed,
+                                 difference=dict((units, quantity) for (units, quantity) in difference.items() if quantity != 0),
+                                 candidates=running_balances.entries[first:last],
+                                 probes=probes)
+
+def _verification_text(verification):
+    "Internal. Describe verification the way it's written in a journal."
+    return "line %d: VERIFY-BALANCE %s %s %s" % (verification['line'], verification['date'],
+                                                 verification['account'], format_amount(verification['amount']))
+
+def print_verification_diagnosis(transactions, diagnosis):
+    """Print diagnosis from diagnose_verifications.
+
+    Candidate postings whose amount is the discrepancy, or half of it
+    (suggesting a posting with the wrong sign), are marked."""
+    if diagnosis.last_passed:
+        print "# Last passing:", _verification_text(diagnosis.last_passed)
+    if diagnosis.first_failed is None:
+        print "# No failing verifications."
+        return
+    print "# First failing:", _verification_text(diagnosis.first_failed)
+    print "# Discrepancy (actual - expected):", _format_balances(diagnosis.difference)
+    print "# Candidate postings: %d (%d balance probes)" % (len(diagnosis.candidates), diagnosis.probes)
+    suspicious = {}
+    for (units, quantity) in diagnosis.difference.items():
+        for candidate in [quantity, -quantity]:
+            suspicious[(units, candidate)] = "<- discrepancy"
+            if candidate % 2 == 0:
+                suspicious[(units, candidate // 2)] = "<- half discrepancy"
+    data = []
+    for (txn_id, posting_number) in diagnosis.candidates:
+        transaction = transactions[txn_id]
+        amount = transaction['postings'][posting_number]['amount']
+        data += [(transaction['date'],
+                  format_amount(amount),
+                  transaction['postings'][posting_number]['account'],
+                  transaction['description'],
+                  suspicious.get((amount['units'], amount['quantity']), ""))]
+    for line in join_columns(justify_columns(data, "RRLL-"), '\t'):
+        print line.rstrip()
+
+# }}}
+
+# {{{ What-if overlays
+
+## A what-if file holds hypothetical transactions (and VERIFY-BALANCE
+## lines) in journal format. Their amounts are booked into a snapshot
+## of the journal's balances, so the journal itself is booked once and
+## its balances are reported with and without the overlay side by side.
+## Only verifications of accounts the overlay posts to (or their
+## parents), on or after the overlay's first posting, can be affected,
+## so only those are checked again.
+
+WhatIfVerification = namedtuple('WhatIfVerification', ['verification', 'base', 'what_if'])  # balances are units -> quantity
+
+def what_if_balance_columns(transactions, overlay_transactions, account_names, as_at_date, depth=None):
+    """Return (lines, columns) like balance_columns, with balances as at as_at_date without and with the overlay.
+
+    columns[0] holds balances from transactions, and columns[1] the
+    same balances after adding overlay_transactions."""
+    base = calculate_balances(filter_by_date(transactions, last_date = as_at_date), as_at_date)
+    what_if = base
+    for transaction in filter_by_date(overlay_transactions, last_date = as_at_date):
+        for posting in transaction['postings']:
+            what_if = book_amount_to_snapshot(posting['account'], posting['amount'], what_if)
+    lines = list(account_tree_lines(what_if, account_names, depth))
+    base_column = []
+    for line in lines:
+        try:
+            base_column.append(_balance_quantities(find_account(line.account_string, base).balances))
+        except ValueError:
+            ## Account only used in the overlay.
+            base_column.append({})
+    return (lines, [base_column, [_balance_quantities(line.account.balances) for line in lines]])
+
+def what_if_verifications(transactions, verifications, overlay_transactions, overlay_verifications):
+    """Return WhatIfVerification for each verification whose balance the overlay could change.
+
+    verifications are those of transactions, which must be date
+    sorted. The overlay's own verifications are always checked."""
+    overlay_postings = [(transaction['date'], posting)
+                        for transaction in overlay_transactions for posting in transaction['postings']]
+    def overlay_affects(verification):
+        return any(date <= reformat_date(verification['date']) and
+                   contains_account(verification['account'], posting['account'])
+                   for (date, posting) in overlay_postings)
+    account_index = journal_index(build_account_index, transactions)
+    running_balances = {}
+    result = []
+    for verification in sorted([verification for verification in verifications if overlay_affects(verification)] +
+                               list(overlay_verifications),
+                               key=lambda verification: reformat_date(verification['date'])):
+        account = regular_account_string(verification['account'])
+        verification_date = reformat_date(verification['date'])
+        if not running_balances.has_key(account):
+            running_balances[account] = build_running_balances(transactions, account, account_index)
+        base = running_balance_as_at(running_balances[account], verification_date)
+        what_if = dict(base)
+        for (date, posting) in overlay_postings:
+            if date <= verification_date and contains_account(verification['account'], posting['account']):
+                units = posting['amount']['units']
+                what_if[units] = what_if.get(units, 0) + posting['amount']['quantity']
+        result.append(WhatIfVerification(verification=verification, base=base, what_if=what_if))
+    return result
+
+def print_what_if(transactions, verifications, overlay_fname, overlay, account_names, print_stars_for_org_mode,
+                  as_at_date, depth=None):
+    "Print balances without and with the parsed overlay file, then the verifications it affects."
+    overlay_transactions = overlay['transactions']
+    print "# What if the transactions in '%s' were added" % overlay_fname
+    (lines, columns) = what_if_balance_columns(transactions, overlay_transactions, account_names, as_at_date, depth)
+    rows = []
+    for line_index in range(len(lines)):
+        line = lines[line_index]
+        if print_stars_for_org_mode:
+            stars = "*" * (line.indent + 1)
+        else:
+            stars = ""
+        rows.append([stars, _format_quantities(columns[0][line_index]), _format_quantities(columns[1][line_index]),
+                     _format_change(columns[0][line_index], columns[1][line_index]),
+                     (" " * (line.indent*2)) + line.name])
+    if rows:
+        header_stars = rows[0][0]
+    else:
+        header_stars = ""
+    rows.insert(0, [header_stars, "Base", "What-if", "Change", "Account"])
+    for line in join_columns(justify_columns(rows, "LRRRL")):
+        print line
+    checks = what_if_verifications(transactions, verifications, overlay_transactions, overlay['verify-balances'])
+    if checks:
+        print "# Verifications affected"
+        rows = [["Date", "Account", "Expected", "Base", "What-if", ""]]
+        for check in checks:
+            verification = check.verification
+            amount = verification['amount']
+            rows.append([verification['date'], verification['account'], format_amount(amount),
+                         _format_quantities(check.base), _format_quantities(check.what_if),
+                         ["FAILED", "ok"][_verification_holds(verification, check.what_if)]])
+        for line in join_columns(justify_columns(rows, "LLRRRL")):
+            print line.rstrip()
+
+# }}}
+
+# {{{ Machine-readable output
+
+## Reports can also be written as CSV or newline-delimited JSON, one
+## record at a time as the report is calculated. Amounts are integer
+## quantities of minor units (e.g. cents), with their units in a
+## separate field.
+
+OUTPUT_FORMATS = ['text', 'ndjson', 'csv']
+
+def record_writer(output_format, fields, outfile=None):
+    """Return function writing a record (sequence of values for fields) to outfile.
+
+    CSV output starts with a row of field names."""
+    if outfile is None:
+        outfile = sys.stdout
+    if output_format == 'csv':
+        writer = csv.writer(outfile, lineterminator="\n")
+        writer.writerow(fields)
+        return writer.writerow
+    def write_json(record):
+        outfile.write(json.dumps(OrderedDict(zip(fields, record))) + "\n")
+    return write_json
+
+def iter_accounts(accounts_dict, account_names=None, depth=None):
+    """Generate (original account string, account) for accounts and their sub-accounts, depth first.
+
+    If account_names are given, only those accounts (and their
+    sub-accounts) are included. If depth is given, accounts more than
+    depth levels deep are left out."""
+    stack = []    # (account string, account)
+    if account_names:
+        for account_name in reversed(account_names):
+            path = account_and_parents(account_name, accounts_dict)
+            stack.append((":".join(account.original_name for account in path), path[-1]))
+    else:
+        for key in sorted(accounts_dict.keys(), reverse=True):
+            stack.append((accounts_dict[key].original_name, accounts_dict[key]))
+    while stack:
+        (account_string, account) = stack.pop()
+        yield (account_string, account)
+        if depth is None or account_string.count(":") + 1 < depth:
+            for key in sorted(account.sub_accounts.keys(), reverse=True):
+                sub_account = account.sub_accounts[key]
+                stack.append((account_string + ":" + sub_account.original_name, sub_account))
+
+def write_chart_records(transactions, output_format):
+    "Write a record for each account used in transactions."
+    write = record_writer(output_format, ['account', 'depth'])
+    for (account_string, account) in iter_accounts(account_tree_from_transactions(transactions)):
+        write((account_string, account_string.count(":")))
+
+def write_transaction_records(transactions, output_format):
+    "Write a record for each posting in transactions."
+    write = record_writer(output_format, ['transaction', 'line', 'date', 'description', 'account', 'units', 'quantity'])
+    for txn_id in range(len(transactions)):
+        transaction = transactions[txn_id]
+        for posting in transaction['postings']:
+            write((txn_id, transaction['line'], transaction['date'], transaction['description'],
+                   posting['account'], posting['amount']['units'], posting['amount']['quantity']))
+
+def write_balance_records(transactions, account_names, as_at_date, first_date, last_date, output_format,
+                          database=None, dates=None, depth=None):
+    """Write a record for each account's balance in each unit at each report date.
+
+    Dates are chosen as for print_single_unit_balances. Accounts are
+    written depth first, each parent before its sub-accounts."""
+    dates = balance_report_dates(as_at_date, first_date, last_date, dates) or [as_at_date]
+    write = record_writer(output_format, ['date', 'account', 'units', 'quantity'])
+    for date in dates:
+        account_tree = balances_as_at(transactions, account_names, date, database)
+        for (account_string, account) in iter_accounts(account_tree, account_names, depth):
+            for units in sorted(account.balances.keys()):
+                write((date, account_string, units, account.balances[units]['quantity']))
+
+def write_register_records(transactions, account_string, include_related_postings, reverse_print_order,
+                           first_date, last_date, output_format, database=None, limit=None, tail=None,
+                           shown_transactions=None):
+    """Write a record for each posting in the register for account_string.
+
+    balance is the account's balance in the posting's units, and
+    empty (null) for related postings."""
+    if database:
+        register_postings = database_register(database, account_string, include_related_postings, first_date, last_date,
+                                              limit=limit, tail=tail, formatted=False)
+    else:
+        register_postings = calculate_register(transactions, account_string, include_related_postings, first_date, last_date,
+                                               limit=limit, tail=tail, formatted=False, shown_transactions=shown_transactions)
+    if reverse_print_order:
+        register_postings = reversed(list(register_postings))
+    write = record_writer(output_format, ['date', 'description', 'account', 'units', 'quantity', 'balance'])
+    for (transaction, posting, shows_transaction, balance) in register_postings:
+        if balance is None:
+            balance_quantity = None
+        else:
+            balance_quantity = balance[posting['amount']['units']]['quantity']
+        write((transaction['date'], transaction['description'], posting['account'],
+               posting['amount']['units'], posting['amount']['quantity'], balance_quantity))
+
+# }}}
+
+# {{{ SQLite journal database
+
+## A journal can be loaded into an SQLite database, so reports can use
+## SQL aggregation and index range scans instead of re-parsing and
+## re-booking the journal every time. Account names are stored in
+## regularised form (see regular_account_string), so the postings of
+## an account and its sub-accounts are the rows with account equal to
+## 'X' or between 'X:' and 'X;' (';' sorts just after ':').
+
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY,
+                                         hash TEXT NOT NULL,
+                                         position INTEGER NOT NULL,
+                                         line INTEGER,
+                                         date TEXT NOT NULL,
+                                         description TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS postings (transaction_id INTEGER NOT NULL REFERENCES transactions(id),
+                                     position INTEGER NOT NULL,
+                                     line INTEGER,
+                                     account TEXT NOT NULL,
+                                     original_account TEXT NOT NULL,
+                                     date TEXT NOT NULL,
+                                     units TEXT NOT NULL,
+                                     quantity INTEGER NOT NULL,
+                                     price_units TEXT,
+                                     price_quantity INTEGER);
+CREATE INDEX IF NOT EXISTS postings_by_account_date ON postings (account, date);
+CREATE INDEX IF NOT EXISTS postings_by_transaction ON postings (transaction_id);
+CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY,
+                                     original_name TEXT NOT NULL,
+                                     first_position INTEGER NOT NULL,
+                                     first_date TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS verifications (line INTEGER,
+                                          date TEXT NOT NULL,
+                                          account TEXT NOT NULL,
+                                          units TEXT NOT NULL,
+                                          quantity INTEGER NOT NULL);
+"""
+
+## Bumped when imports store more of the journal, so older databases
+## are brought up to date even if their journal hasn't changed.
+DATABASE_VERSION = "2"
+
+def _subtree_condition(column):
+    "Internal. SQL condition selecting rows where column is an account or one of its sub-accounts."
+    return "(%s = ? OR (%s > ? AND %s < ?))" % (column, column, column)
+
+def _subtree_parameters(account_string):
+    "Internal. Parameters for _subtree_condition selecting account_string and its sub-accounts."
+    regular = regular_account_string(account_string)
+    return (regular, regular + ":", regular + ";")
+
+def _accounts_condition(table, account_strings, accounts_as_at):
+    """Internal. Return SQL condition and parameters selecting rows of accounts table.
+
+    Selects accounts in any of account_strings' subtrees (all if
+    None), first used on or before accounts_as_at (any time if None)."""
+    condition = "1"
+    parameters = ()
+    if account_strings:
+        condition = "(" + " OR ".join([_subtree_condition(table + ".name")] * len(account_strings)) + ")"
+        for account_string in account_strings:
+            parameters += _subtree_parameters(account_string)
+    if accounts_as_at:
+        condition += " AND " + table + ".first_date <= ?"
+        parameters += (accounts_as_at,)
+    return (condition, parameters)
+
+def transaction_hash(transaction):
+    "Return a hash identifying the content of transaction (not where it is in the file)."
+    content = repr((transaction['date'], transaction['description'],
+                    [(p['account'], p['amount']['units'], p['amount']['quantity']) +
+                     ((p['price']['units'], p['price']['quantity']) if p.has_key('price') else ())
+                     for p in transaction['postings']]))
+    return hashlib.sha1(content).hexdigest()
+
+def file_hash(fname):
+    "Return sha1 hash of the contents of fname (as stored, so compressed journals aren't decompressed)."
+    digest = hashlib.sha1()
+    with open(fname, "rb") as infile:
+        for block in iter(lambda: infile.read(JOURNAL_BUFFER_SIZE), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def program_hash():
+    "Return sha1 hash of this program's source, so caches of its results go stale when it changes."
+    program_fname = os.path.abspath(__file__)
+    if program_fname.endswith(".pyc"):
+        program_fname = program_fname[:-1]
+    return file_hash(program_fname)
+
+def open_database(db_fname):
+    "Open (creating if necessary) the journal database in db_fname."
+    db = sqlite3.connect(db_fname)
+    ## Journal text is stored and returned as it was read.
+    db.text_factory = str
+    db.executescript(DATABASE_SCHEMA)
+    ## Databases made before postings had prices get the new columns.
+    ## Their journals are imported again (see DATABASE_VERSION).
+    columns = [row[1] for row in db.execute("PRAGMA table_info(postings)")]
+    if 'price_units' not in columns:
+        with db:
+            db.execute("ALTER TABLE postings ADD COLUMN price_units TEXT")
+            db.execute("ALTER TABLE postings ADD COLUMN price_quantity INTEGER")
+    return db
+
+def import_transactions(db, transactions, verifications):
+    """Make the journal database match transactions and verifications.
+
+    Import is incremental: transactions already in the database are
+    matched by content hash, and only moved if their position in the
+    journal changed. Only new transactions are inserted, and only
+    removed ones are deleted."""
+    existing = defaultdict(list)   # hash -> ids of transactions already in db
+    for (txn_id, txn_hash) in db.execute("SELECT id, hash FROM transactions ORDER BY position"):
+        existing[txn_hash].append(txn_id)
+    for txn_hash in existing.keys():
+        existing[txn_hash].reverse()
+    moved = []
+    for position in range(len(transactions)):
+        transaction = transactions[position]
+        txn_hash = transaction_hash(transaction)
+        if existing[txn_hash]:
+            moved.append((position, transaction['line'], existing[txn_hash].pop()))
+            continue
+        txn_id = db.execute("INSERT INTO transactions (hash, position, line, date, description) VALUES (?, ?, ?, ?, ?)",
+                            (txn_hash, position, transaction['line'], transaction['date'],
+                             transaction['description'])).lastrowid
+        db.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(txn_id, posting_number, posting.get('line'),
+                         regular_account_string(posting['account']), posting['account'],
+                         transaction['date'], posting['amount']['units'], posting['amount']['quantity'],
+                         posting.get('price', {}).get('units'), posting.get('price', {}).get('quantity'))
+                        for (posting_number, posting) in enumerate(transaction['postings'])])
+    db.executemany("UPDATE transactions SET position = ?, line = ? WHERE id = ?", moved)
+    removed = [(txn_id,) for txn_ids in existing.values() for txn_id in txn_ids]
+    db.executemany("DELETE FROM postings WHERE transaction_id = ?", removed)
+    db.executemany("DELETE FROM transactions WHERE id = ?", removed)
+    db.execute("DELETE FROM accounts")
+    ## SQLite takes original_account from the row with the MIN(...), so
+    ## each account keeps the spelling it was first used with.
+    db.execute("""INSERT INTO accounts
+                  SELECT p.account, p.original_account, MIN(t.position * 65536 + p.position), MIN(t.date)
+                  FROM postings p JOIN transactions t ON p.transaction_id = t.id
+                  GROUP BY p.account""")
+    db.execute("DELETE FROM verifications")
+    db.executemany("INSERT INTO verifications VALUES (?, ?, ?, ?, ?)",
+                   [(v.get('line'), v['date'], v['account'], v['amount']['units'], v['amount']['quantity'])
+                    for v in verifications])
+
+def sync_database(db_fname, journal_fname, adjust_signs, sort=False, sort_chunk_size=None):
+    """Open journal database in db_fname, first importing journal_fname if it has changed.
+
+    The journal is only parsed if its contents (or the options it's
+    read with) differ from the last import. If sort is True, it's
+    sorted by date as it's read (see sort_journal)."""
+    db = open_database(db_fname)
+    journal_hash = file_hash(journal_fname)
+    settings = [('hash', journal_hash), ('adjust_signs', str(adjust_signs)), ('sort_by_date', str(sort)),
+                ('version', DATABASE_VERSION)]
+    if all(db.execute("SELECT value FROM journal WHERE key = ?", (key,)).fetchone() == (value,)
+           for (key, value) in settings):
+        return db
+    parsed_file = parse_file(journal_fname, adjust_signs, None, sort, sort_chunk_size)
+    ensure_date_sorted(parsed_file['transactions'])
+    ensure_balanced(parsed_file['transactions'])
+    with db:
+        import_transactions(db, parsed_file['transactions'], parsed_file['verify-balances'])
+        db.executemany("INSERT OR REPLACE INTO journal VALUES (?, ?)", settings)
+    return db
+
+def database_prices(db):
+    "Return list of (date, commodity, price amount) paid in postings in the journal database, in journal order."
+    return [(date, units, {'units': price_units, 'quantity': price_quantity})
+            for (date, units, price_units, price_quantity) in db.execute(
+                "SELECT p.date, p.units, p.price_units, p.price_quantity "
+                "FROM postings p JOIN transactions t ON p.transaction_id = t.id "
+                "WHERE p.price_units IS NOT NULL ORDER BY t.position, p.position")]
+
+def _database_balances(db, account_string, date_condition, parameters):
+    "Internal. Return units -> amount dictionary summing postings to account_string's subtree."
+    balances = {}
+    for (units, quantity) in db.execute("SELECT units, SUM(quantity) FROM postings WHERE " +
+                                        _subtree_condition("account") + date_condition + " GROUP BY units",
+                                        _subtree_parameters(account_string) + parameters):
+        balances[units] = {'units': units, 'quantity': quantity}
+    return balances
+
+def database_account_tree(db, as_at_date=None, account_strings=None, accounts_as_at=None):
+    """Return account tree with balances as at as_at_date, calculated by SQL aggregation.
+
+    The tree includes accounts used by accounts_as_at (which defaults
+    to as_at_date). If account_strings are given, it only includes
+    those accounts and their sub-accounts. Each account with postings
+    gets a single placeholder posting, so the tree has the same
+    structure as one built from transactions."""
+    (account_condition, account_parameters) = _accounts_condition("a", account_strings, accounts_as_at or as_at_date)
+    root = _make_account('')
+    for (original_name,) in db.execute("SELECT original_name FROM accounts a WHERE " + account_condition +
+                                       " ORDER BY first_position", account_parameters):
+        _ensure_sub_accounts(Posting(date=None, amount=None, account=original_name, comment=None, transaction_id=None),
+                             root)
+    date_condition = ""
+    date_parameters = ()
+    if as_at_date:
+        date_condition = " AND p.date <= ?"
+        date_parameters = (as_at_date,)
+    for (original_name, units, quantity) in db.execute(
+            "SELECT a.original_name, p.units, SUM(p.quantity) FROM postings p JOIN accounts a ON p.account = a.name "
+            "WHERE " + account_condition + date_condition + " GROUP BY p.account, p.units",
+            account_parameters + date_parameters):
+        book_amount(original_name, {'units': units, 'quantity': quantity}, root.sub_accounts)
+    return root.sub_accounts
+
+def _date_range_condition(column, first_date, last_date):
+    "Internal. Return SQL condition and parameters restricting column to dates between first_date and last_date."
+    condition = ""
+    parameters = ()
+    if first_date:
+        condition += " AND %s >= ?" % column
+        parameters += (first_date,)
+    if last_date:
+        condition += " AND %s <= ?" % column
+        parameters += (last_date,)
+    return (condition, parameters)
+
+def database_register(db, account_string, include_related_postings, first_date, last_date, limit=None, tail=None,
+                      formatted=True):
+    """Return same lines (or entries) as calculate_register, using the journal database.
+
+    The balance before first_date comes from an SQL aggregate, so
+    only postings between first_date and last_date are read. With
+    limit (or tail), SQL picks the first (or last) that many postings
+    to the account, and only their transactions are read."""
+    (date_condition, date_parameters) = _date_range_condition("date", first_date, last_date)
+    relevant = defaultdict(set)   # transaction id -> posting #s in account
+    if limit is None and tail is None:
+        balances = {}
+        if first_date:
+            balances = _database_balances(db, account_string, " AND date < ?", (first_date,))
+        for (txn_id, posting_number) in db.execute("SELECT transaction_id, position FROM postings WHERE " +
+                                                   _subtree_condition("account") + date_condition,
+                                                   _subtree_parameters(account_string) + date_parameters):
+            relevant[txn_id].add(posting_number)
+        transactions_condition = ("SELECT transaction_id FROM postings WHERE " +
+                                  _subtree_condition("account") + date_condition)
+        transactions_parameters = _subtree_parameters(account_string) + date_parameters
+    else:
+        if tail is not None:
+            order = " ORDER BY t.position DESC, p.position DESC LIMIT ?"
+            count = tail
+        else:
+            order = " ORDER BY t.position, p.position LIMIT ?"
+            count = limit
+        window = {}               # units -> quantity posted in the selected postings
+        for (txn_id, posting_number, units, quantity) in db.execute(
+                "SELECT p.transaction_id, p.position, p.units, p.quantity "
+                "FROM postings p JOIN transactions t ON p.transaction_id = t.id WHERE " +
+                _subtree_condition("p.account") + _date_range_condition("p.date", first_date, last_date)[0] + order,
+                _subtree_parameters(account_string) + date_parameters + (count,)):
+            relevant[txn_id].add(posting_number)
+            window[units] = window.get(units, 0) + quantity
+        if tail is not None:
+            ## Balance before the selected postings is everything up
+            ## to last_date, less the selected postings.
+            (last_condition, last_parameters) = _date_range_condition("date", None, last_date)
+            balances = _database_balances(db, account_string, last_condition, last_parameters)
+            for (units, quantity) in window.items():
+                balances[units]['quantity'] -= quantity
+        elif first_date:
+            balances = _database_balances(db, account_string, " AND date < ?", (first_date,))
+        else:
+            balances = {}
+        transactions_condition = ",".join(str(txn_id) for txn_id in relevant.keys())
+        transactions_parameters = ()
+    transactions = {}             # transaction id -> (position, transaction, relevant posting #s)
+    for (txn_id, txn_position, txn_date, description, posting_number, original_account, units, quantity) in db.execute(
+            "SELECT t.id, t.position, t.date, t.description, p.position, p.original_account, p.units, p.quantity "
+            "FROM postings p JOIN transactions t ON p.transaction_id = t.id "
+            "WHERE p.transaction_id IN (" + transactions_condition + ") ORDER BY t.position, p.position",
+            transactions_parameters):
+        if not include_related_postings and not posting_number in relevant[txn_id]:
+            continue
+        if not transactions.has_key(txn_id):
+            transactions[txn_id] = (txn_position, {'date': txn_date, 'description': description, 'postings': []}, set())
+        (_, transaction, relevant_numbers) = transactions[txn_id]
+        if posting_number in relevant[txn_id]:
+            relevant_numbers.add(len(transaction['postings']))
+        transaction['postings'].append({'account': original_account,
+                                        'amount': {'units': units, 'quantity': quantity}})
+    transactions_and_relevant_postings = [transactions[txn_id][1:] for txn_id in
+                                          sorted(transactions.keys(), key=lambda txn_id: transactions[txn_id][0])]
+    register_postings = _register_postings(transactions_and_relevant_postings, include_related_postings, None, None, balances)
+    if not formatted:
+        return register_postings
+    return _register_lines(register_postings)
+
+def verify_database_balances(db, verbose, exit_on_failure):
+    "Check balance verifications stored in the journal database, using SQL aggregates."
+    verify_failed = False
+    for (line, date, account_string, units, quantity) in db.execute(
+            "SELECT line, date, account, units, quantity FROM verifications ORDER BY date"):
+        verification = {'line': line, 'date': date, 'account': account_string,
+                        'amount': {'units': units, 'quantity': quantity}}
+        actual_balances = _database_balances(db, account_string, " AND date <= ?", (reformat_date(verification['date']),))
+        if not _report_verification(verification, actual_balances, verbose):
+            verify_failed = True
+    if exit_on_failure and verify_failed:
+        sys.stderr.write("Verify balance operation failed.\nExiting.\n")
+        sys.exit(-1)
+
+# }}}
+
+# {{{ Closing the books
+
+def journal_amount_string(account_string, amount, adjust_signs):
+    "Format amount for account_string the way it should be written in a journal read using adjust_signs."
+    if adjust_signs:
+        amount = {'units': amount['units'],
+                  'quantity': amount['quantity'] * sign_account(account_string)}
+    return format_amount(amount)
+
+def _transaction_last_line(transaction):
+    "Internal. Return number of last line of journal file containing part of transaction."
+    return max([transaction['line']] + [posting['line'] for posting in transaction['postings']])
+
+def close_books_lines(lines, cutoff_date, archive_fname, adjust_signs):
+    """Split journal lines into archived lines and new live journal lines.
+
+    Transactions and verifications dated on or before cutoff_date (and
+    comments among them) go to the archive. The live journal starts with
+    a single transaction bringing forward each account's balance as at
+    cutoff_date, plus VERIFY-BALANCE lines for those balances, followed
+    by the remaining lines. Accounts emptied by cutoff_date are brought
+    forward with a zero posting, so later lines can still name them.
+    Postings with a price are brought forward at that price (those at
+    the same price combined where that's exact), so the opening
+    transaction balances just as the closed ones did. Exits if the journal doesn't balance or verify. Returns (archive
+    lines, live lines)."""
+    parsed_file = parse_transactions(lines, adjust_signs)
+    transactions = parsed_file['transactions']
+    verifications = parsed_file['verify-balances']
+    ensure_date_sorted(transactions)
+    ensure_balanced(transactions)
+    verify_balances(transactions, verifications, False, True)
+
+    closed_lines = set()
+    kept_lines = set()
+    opening = defaultdict(int)
+    ## (account, units) -> (price units, price quantity, line) -> quantity, with
+    ## line None for lots that can be combined without rounding differently.
+    lots = defaultdict(lambda: defaultdict(int))
+    account_spellings = {}
+    for transaction in transactions:
+        item_lines = set(range(transaction['line'], _transaction_last_line(transaction) + 1))
+        if transaction['date'] <= cutoff_date:
+            closed_lines.update(item_lines)
+            for posting in transaction['postings']:
+                if posting.has_key('price'):
+                    (amount, price) = (posting['amount'], posting['price'])
+                    account_string = account_spellings.setdefault(regular_account_string(posting['account']),
+                                                                  posting['account'])
+                    exact = (amount['quantity'] * price['quantity']) % 100 == 0
+                    lots[(account_string, amount['units'])][(price['units'], price['quantity'],
+                                                              None if exact else posting['line'])] += amount['quantity']
+                else:
+                    fold_posting(posting, opening, account_spellings)
+        else:
+            kept_lines.update(item_lines)
+    for verification in verifications:
+        if reformat_date(verification['date']) <= cutoff_date:
+            closed_lines.add(verification['line'])
+        else:
+            kept_lines.add(verification['line'])
+    if not closed_lines:
+        return ([], list(lines))
+    last_closed_line = max(closed_lines)
+
+    account_tree = calculate_balances(transactions, cutoff_date)
+    description = "Opening balances as at %s. Earlier transactions are in %s." % (cutoff_date, archive_fname)
+    live = ["# Balances brought forward by ledger.py --close-books.\n",
+            "%s %s\n" % (cutoff_date, description)]
+    verify_lines = []
+    for account_lots in lots.values():
+        for (lot, quantity) in account_lots.items():
+            if quantity == 0 and lot[2] is None:
+                del account_lots[lot]
+    open_accounts = set([account_string for ((account_string, units), quantity) in opening.items() if quantity <> 0] +
+                        [account_string for ((account_string, units), account_lots) in lots.items() if account_lots])
+    for (account_string, units) in sorted(set(opening.keys()) | set(lots.keys())):
+        amount = {'units': units, 'quantity': opening.get((account_string, units), 0)}
+        account_lots = lots.get((account_string, units), {})
+        if amount['quantity'] == 0 and account_string in open_accounts and not account_lots:
+            continue
+        if amount['quantity'] <> 0 or account_string not in open_accounts:
+            live.append("  %s  %s\n" % (account_string, journal_amount_string(account_string, amount, adjust_signs)))
+        for (price_units, price_quantity, line) in sorted(account_lots.keys()):
+            lot_amount = {'units': units, 'quantity': account_lots[(price_units, price_quantity, line)]}
+            live.append("  %s  %s @ %s\n" % (account_string, journal_amount_string(account_string, lot_amount, adjust_signs),
+                                             format_amount({'units': price_units, 'quantity': price_quantity})))
+        balances = find_account(account_string, account_tree).balances
+        if len(balances) == 1:
+            verify_lines.append("VERIFY-BALANCE %s %s %s\n" %
+                                (cutoff_date, account_string,
+                                 journal_amount_string(account_string, extract_single_unit_amount(balances), adjust_signs)))
+    live += ["\n"] + verify_lines + ["\n"]
+
+    archive = []
+    for line_number in range(1, len(lines) + 1):
+        line = lines[line_number - 1]
+        if line_number in kept_lines or line_number > last_closed_line:
+            live.append(line)
+        else:
+            archive.append(line)
+    return (archive, live)
+
+def _final_balances(lines, adjust_signs):
+    "Internal. Return sorted list of ((regular account, units), quantity) for non-zero final balances in journal lines."
+    totals = defaultdict(int)
+    for transaction in parse_transactions(lines, adjust_signs)['transactions']:
+        for posting in transaction['postings']:
+            totals[(regular_account_string(posting['account']), posting['amount']['units'])] += posting['amount']['quantity']
+    return sorted([(key, quantity) for (key, quantity) in totals.items() if quantity <> 0])
+
+def close_books(fname, cutoff_date, archive_fname, adjust_signs):
+    """Move transactions up to cutoff_date from journal fname to the end of archive_fname.
+
+    See close_books_lines. The new live journal is checked to give the
+    same final balances as the old one before anything is written."""
+    cutoff_date = reformat_date(cutoff_date)
+    if journal_compression(fname):
+        sys.stderr.write("Can't close the books of compressed journal '%s'. Decompress it first.\nExiting.\n" % fname)
+        sys.exit(-1)
+    with open(fname) as infile:
+        lines = infile.readlines()
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    (archive, live) = close_books_lines(lines, cutoff_date, archive_fname, adjust_signs)
+    if not archive:
+        sys.stderr.write("Nothing on or before %s to close in '%s'.\n" % (cutoff_date, fname))
+        return
+    if _final_balances(lines, adjust_signs) != _final_balances(live, adjust_signs):
+        sys.stderr.write("Closing '%s' would change its balances.\nExiting.\n" % fname)
+        sys.exit(-1)
+    with open(archive_fname, "a") as outfile:
+        outfile.write("# Closed from %s on %s, up to %s.\n" % (fname, datetime.date.today().isoformat(), cutoff_date))
+        outfile.writelines(archive)
+        outfile.write("\n")
+    with open(fname + ".tmp", "w") as outfile:
+        outfile.writelines(live)
+    os.rename(fname + ".tmp", fname)
+    sys.stderr.write("Archived %d lines to '%s'.\n" % (len(archive), os.path.abspath(archive_fname)))
+
+# }}}
+
+# {{{ Importing bank statements
+
+## Rows of a bank statement export are turned into transactions
+## between the bank account and a counter account. A persistent hash
+## index counts the postings already in the journal for each (date,
+## account, amount, description) key, so rows overlapping an earlier
+## import are skipped in constant time per row.
+
+IMPORT_INDEX_SUFFIX = ".import-index"
+
+StatementRow = namedtuple('StatementRow', ['line', 'date', 'description', 'amount_string'])
+
+def normalise_description(description):
+    "Return description with case, punctuation and spacing differences removed."
+    return " ".join(description_tokens(description))
+
+def posting_key(date, account_string, quantity, description):
+    "Return hash identifying a posting for duplicate detection."
+    return hashlib.sha1(repr((date, regular_account_string(account_string), quantity,
+                              normalise_description(description)))).digest()
+
+def build_import_index(transactions):
+    "Count postings in transactions by posting_key."
+    index = defaultdict(int)
+    for transaction in transactions:
+        for posting in transaction['postings']:
+            index[posting_key(transaction['date'], posting['account'],
+                              posting['amount']['quantity'], transaction['description'])] += 1
+    return index
+
+def import_index_for_file(journal_fname, adjust_signs):
+    """Load persisted import index for journal_fname, parsing the journal to rebuild it if stale.
+
+    Exits if the journal can't be read."""
+    try:
+        index = load_journal_index(journal_fname, IMPORT_INDEX_SUFFIX)
+        if index is None:
+            transactions = parse_file(journal_fname, adjust_signs)['transactions']
+    except (IOError, OSError), e:
+        sys.stderr.write("Can't read journal '%s': %s.\nExiting.\n" % (journal_fname, e.strerror))
+        sys.exit(-1)
+    if index is None:
+        index = build_import_index(transactions)
+        save_journal_index(index, journal_fname, IMPORT_INDEX_SUFFIX)
+    return index
+
+def read_statement_rows(infile, columns, day_first):
+    """Generate StatementRows from a csv bank statement.
+
+    columns names the csv columns, e.g. ['date', 'description',
+    'amount']. Columns with other names are ignored. A first row
+    without a valid date is taken to be a heading."""
+    date_column = columns.index('date')
+    description_column = columns.index('description')
+    amount_column = columns.index('amount')
+    line_number = 0
+    for row in csv.reader(infile):
+        line_number += 1
+        if len(row) == 0:
+            continue
+        if len(row) < len(columns):
+            sys.stderr.write("Line %d: expected %d columns, found %d. Skipping.\n" % (line_number, len(columns), len(row)))
+            continue
+        try:
+            date = dateutil.parser.parse(row[date_column], dayfirst=day_first).isoformat()[:10]
+        except ValueError:
+            if line_number > 1:
+                sys.stderr.write("Line %d: invalid date: '%s'. Skipping.\n" % (line_number, row[date_column]))
+            continue
+        amount_string = row[amount_column].strip()
+        try:
+            float(amount_string.translate(None, "$,"))
+        except ValueError:
+            sys.stderr.write("Line %d: invalid amount: '%s'. Skipping.\n" % (line_number, amount_string))
+            continue
+        yield StatementRow(line=line_number,
+                           date=date,
+                           description=" ".join(row[description_column].split()),
+                           amount_string=amount_string)
+
+def statement_transactions(rows, bank_account, counter_account, adjust_signs, import_index):
+    """Generate (row, transaction) for each statement row not already in the journal.
+
+    import_index counts postings already in the journal (see
+    build_import_index), and is decremented as rows are matched, so
+    genuinely repeated rows are only skipped as often as they occur in
+    the journal."""
+    for row in rows:
+        amount = statement_amount(row, bank_account, adjust_signs)
+        key = posting_key(row.date, bank_account, amount['quantity'], row.description)
+        if import_index.get(key, 0) > 0:
+            import_index[key] -= 1
+            continue
+        counter_amount = {'units': amount['units'],
+                          'quantity': -amount['quantity'] * sign_account(bank_account) * sign_account(counter_account)}
+        yield (row, {'line': row.line,
+                     'date': row.date,
+                     'description': row.description,
+                     'postings': [{'account': bank_account, 'amount': amount},
+                                  {'account': counter_account, 'amount': counter_amount}]})
+
+def validate_statement_columns(columns):
+    "Exit unless csv columns include the ones read_statement_rows needs."
+    for column in ['date', 'description', 'amount']:
+        if column not in columns:
+            sys.stderr.write("CSV columns must include '%s'.\nExiting.\n" % column)
+            sys.exit(-1)
+
+def statement_amount(row, account_string, adjust_signs):
+    "Return amount of statement row, as it would be posted to account_string."
+    if adjust_signs:
+        return parse_amount_adjusting_sign(account_string, row.amount_string.translate(None, "$"))
+    return parse_amount(row.amount_string)
+
+def import_statement(csv_fname, journal_fname, bank_account, counter_account, adjust_signs, columns, day_first):
+    "Print transactions for rows of csv_fname not already in journal_fname, in journal format."
+    for account_string in [bank_account, counter_account]:
+        if not is_valid_account_string(account_string):
+            sys.stderr.write("Invalid account string: '%s'.\nExiting.\n" % account_string)
+            sys.exit(-1)
+    validate_statement_columns(columns)
+    import_index = import_index_for_file(journal_fname, adjust_signs)
+    imported = 0
+    with open(csv_fname, "rb") as infile:
+        rows = read_statement_rows(infile, columns, day_first)
+        for (row, transaction) in statement_transactions(rows, bank_account, counter_account, adjust_signs, import_index):
+            print transaction['date'], transaction['description']
+            for posting in transaction['postings']:
+                print ' ', posting['account'], ' ', journal_amount_string(posting['account'], posting['amount'], adjust_signs)
+            print
+            imported += 1
+    sys.stderr.write("Imported %d transactions from '%s'.\n" % (imported, csv_fname))
+
+# }}}
+
+# {{{ Reconciling bank statements
+
+## Statement rows are matched to the journal's postings to an account
+## (and its sub-accounts) by amount and date. The postings are put in a
+## hash index keyed by (units, quantity, date), so each row looks up at
+## most 2 * tolerance + 1 keys, nearest date first, rather than being
+## compared with every posting. Each posting matches at most one row.
+
+Reconciliation = namedtuple('Reconciliation',
+                            ['matched',          # [(StatementRow, amount, (transaction id, posting #)), ...]
+                             'statement_only',   # [(StatementRow, amount), ...]
+                             'journal_only'])    # [(transaction id, posting #), ...]
+
+def _date_offsets(date, tolerance):
+    "Internal. Return date, then the dates up to tolerance days either side of it, nearest first."
+    day = dateutil.parser.parse(date)
+    result = [date]
+    for days in range(1, tolerance + 1):
+        result += [(day - datetime.timedelta(days=days)).isoformat()[:10],
+                   (day + datetime.timedelta(days=days)).isoformat()[:10]]
+    return result
+
+def reconcile_statement(transactions, account_strings, rows, adjust_signs, tolerance):
+    """Match statement rows to postings to account_strings (or their sub-accounts) in transactions.
+
+    A row matches an unmatched posting of the same amount, dated at
+    most tolerance days away. The nearest date wins, then the earliest
+    posting. Postings more than tolerance days outside the statement's
+    dates aren't reported as missing from it."""
+    rows = list(rows)
+    index = defaultdict(list)
+    in_accounts = {}
+    for txn_id in range(len(transactions)):
+        transaction = transactions[txn_id]
+        for posting_number in range(len(transaction['postings'])):
+            posting = transaction['postings'][posting_number]
+            if not in_accounts.has_key(posting['account']):
+                in_accounts[posting['account']] = any(contains_account(account_string, posting['account'])
+                                                      for account_string in account_strings)
+            if in_accounts[posting['account']]:
+                amount = posting['amount']
+                index[(amount['units'], amount['quantity'], transaction['date'])].append((txn_id, posting_number))
+    ## Lists are popped from the end, so reverse them to match the earliest posting first.
+    for entries in index.values():
+        entries.reverse()
+    matched = []
+    statement_only = []
+    offsets = {}
+    for row in rows:
+        amount = statement_amount(row, account_strings[0], adjust_signs)
+        if not offsets.has_key(row.date):
+            offsets[row.date] = _date_offsets(row.date, tolerance)
+        for date in offsets[row.date]:
+            entries = index.get((amount['units'], amount['quantity'], date))
+            if entries:
+                matched.append((row, amount, entries.pop()))
+                break
+        else:
+            statement_only.append((row, amount))
+    journal_only = []
+    if rows:
+        first_date = min(_date_offsets(min(row.date for row in rows), tolerance))
+        last_date = max(_date_offsets(max(row.date for row in rows), tolerance))
+        journal_only = sorted(entry for ((_, _, date), entries) in index.items() if first_date <= date <= last_date
+                              for entry in entries)
+    return Reconciliation(matched=matched, statement_only=statement_only, journal_only=journal_only)
+
+def print_reconciliation(transactions, reconciliation):
+    "Print matched and unmatched statement rows and postings, with the running balance of matched amounts."
+    print "# Matched"
+    balance = {}
+    rows = []
+    for (row, amount, (txn_id, posting_number)) in reconciliation.matched:
+        balance[amount['units']] = balance.get(amount['units'], 0) + amount['quantity']
+        rows.append([row.date, transactions[txn_id]['date'], format_amount(amount), _format_quantities(balance),
+                     row.description, transactions[txn_id]['description']])
+    for line in join_columns(justify_columns(rows, "LLRRLL"), '\t'):
+        print line.rstrip()
+    print "# In statement, not in journal"
+    rows = [[row.date, format_amount(amount), row.description, "statement line %d" % row.line]
+            for (row, amount) in reconciliation.statement_only]
+    for line in join_columns(justify_columns(rows, "LRLL"), '\t'):
+        print line.rstrip()
+    print "# In journal, not in statement"
+    rows = []
+    for (txn_id, posting_number) in reconciliation.journal_only:
+        transaction = transactions[txn_id]
+        posting = transaction['postings'][posting_number]
+        rows.append([transaction['date'], format_amount(posting['amount']), transaction['description'],
+                     posting['account'], "journal line %d" % transaction['line']])
+    for line in join_columns(justify_columns(rows, "LRLLL"), '\t'):
+        print line.rstrip()
+    print "# %d matched, %d only in statement, %d only in journal" % (len(reconciliation.matched),
+                                                                     len(reconciliation.statement_only),
+                                                                     len(reconciliation.journal_only))
+
+# }}}
+
+# {{{ Comparing git revisions of a journal
+
+## Each revision of a journal kept in git is a blob, named by the hash
+## of its content. A summary of each blob (final balances and the
+## transactions it contains) is cached under the repository's git
+## directory, keyed by that hash, so comparing many revisions only
+## parses blobs that haven't been seen before.
+
+REVISION_CACHE_DIRECTORY = "ledger-py-cache"
+
+RevisionSummary = namedtuple('RevisionSummary',
+                             ['balances',       # regularised account string -> (account string, units -> quantity)
+                              'transactions'])  # transaction_hash -> [(date, description), ...]
+
+def _git(directory, arguments):
+    "Internal. Return output of git command run in directory, or None if it fails."
+    process = subprocess.Popen(["git"] + arguments, cwd=directory,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (output, _) = process.communicate()
+    if process.returncode != 0:
+        return None
+    return output
+
+def journal_blob(journal_fname, revision):
+    "Return hash of the blob holding journal_fname in git revision, or None if it isn't there."
+    (directory, basename) = os.path.split(os.path.abspath(journal_fname))
+    output = _git(directory, ["rev-parse", "--verify", "--quiet", "%s:./%s" % (revision, basename)])
+    if output is None:
+        return None
+    return output.strip()
+
+def summarise_journal(lines, adjust_signs):
+    "Return RevisionSummary of journal lines."
+    transactions = parse_transactions(lines, adjust_signs)['transactions']
+    balances = {}
+    for (account_string, account) in iter_accounts(calculate_balances(transactions, None)):
+        balances[regular_account_string(account_string)] = (account_string, _balance_quantities(account.balances))
+    summary_transactions = defaultdict(list)
+    for transaction in transactions:
+        summary_transactions[transaction_hash(transaction)].append((transaction['date'], transaction['description']))
+    return RevisionSummary(balances=balances, transactions=dict(summary_transactions))
+
+def revision_summary(journal_fname, revision, adjust_signs):
+    """Return RevisionSummary of journal_fname as it was in git revision.
+
+    Compressed revisions are decompressed as by open_journal.
+    Summaries are cached in the repository's git directory, keyed by
+    blob hash and the hash of this program, so a changed parser doesn't
+    reuse summaries made by the old one."""
+    blob = journal_blob(journal_fname, revision)
+    if blob is None:
+        sys.stderr.write("Can't find '%s' in revision '%s'.\nExiting.\n" % (journal_fname, revision))
+        sys.exit(-1)
+    directory = os.path.dirname(os.path.abspath(journal_fname))
+    git_directory = _git(directory, ["rev-parse", "--git-dir"]).strip()
+    cache_directory = os.path.join(directory, git_directory, REVISION_CACHE_DIRECTORY)
+    cache_fname = os.path.join(cache_directory, "%s-%d-%s" % (blob, adjust_signs, program_hash()))
+    try:
+        with open(cache_fname, "rb") as infile:
+            return cPickle.load(infile)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        pass
+    text = decompress_journal(_git(directory, ["cat-file", "blob", blob]), "%s:%s" % (revision, journal_fname))
+    summary = summarise_journal(text.splitlines(), adjust_signs)
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    (handle, temporary_fname) = tempfile.mkstemp(dir=cache_directory)
+    with os.fdopen(handle, "wb") as outfile:
+        cPickle.dump(summary, outfile, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_fname, cache_fname)
+    return summary
+
+def compare_summaries(old, new):
+    """Return (balance changes, added transactions, removed transactions) between RevisionSummaries.
+
+    Balance changes are (account string, old units -> quantity, new
+    units -> quantity) for each account whose balance changed, in
+    account order. Transactions are (date, description) in date order."""
+    changes = []
+    for account in sorted(set(old.balances.keys()) | set(new.balances.keys())):
+        (old_name, old_balance) = old.balances.get(account, (None, {}))
+        (new_name, new_balance) = new.balances.get(account, (None, {}))
+        if old_balance != new_balance:
+            changes.append((new_name or old_name, old_balance, new_balance))
+    added = []
+    removed = []
+    for txn_hash in set(old.transactions.keys()) | set(new.transactions.keys()):
+        old_transactions = old.transactions.get(txn_hash, [])
+        new_transactions = new.transactions.get(txn_hash, [])
+        added += new_transactions[len(old_transactions):]
+        removed += old_transactions[len(new_transactions):]
+    return (changes, sorted(added), sorted(removed))
+
+def print_revision_comparison(journal_fname, revisions, adjust_signs):
+    "Print changes in balances and transactions between each of revisions of journal_fname and the next."
+    summaries = [revision_summary(journal_fname, revision, adjust_signs) for revision in revisions]
+    for index in range(1, len(revisions)):
+        (changes, added, removed) = compare_summaries(summaries[index-1], summaries[index])
+        print "# Changes from %s to %s" % (revisions[index-1], revisions[index])
+        rows = [(_format_quantities(old_balance), _format_quantities(new_balance),
+                 _format_change(old_balance, new_balance), account_string)
+                for (account_string, old_balance, new_balance) in changes]
+        if rows:
+            rows.insert(0, (revisions[index-1], revisions[index], "Change", "Account"))
+            for line in join_columns(justify_columns(rows, "RRRL")):
+                print line
+        for (date, description) in added:
+            print "+", date, description
+        for (date, description) in removed:
+            print "-", date, description
+
+# }}}
+
+# {{{ Caching report output
+
+## Report output (and any Excel report written) is saved in the
+## --cache-dir directory, in a file named by a hash of the journal's
+## contents, the normalised arguments and this program. Running the
+## same reports again on an unchanged journal replays the saved output
+## without parsing anything, and any change to the journal gives a new
+## name. Files not used recently are removed when the directory gets
+## too big.
+
+DEFAULT_CACHE_SIZE_MB = 100
+CACHE_ENTRY_SUFFIX = ".output"
+
+CacheEntry = namedtuple('CacheEntry', ['stdout', 'stderr', 'files'])  # files is [(filename, contents), ...]
+
+class _RecordingOutput(object):
+    "Internal. Output stream that also remembers everything written to it."
+    def __init__(self, stream):
+        self.stream = stream
+        self.recording = StringIO()
+
+    def write(self, text):
+        self.stream.write(text)
+        self.recording.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def is_cacheable(args):
+    "Can the output of the reports in args be cached?"
+    return not (args.database or args.close_books or args.import_csv or args.compare_revisions or args.batch)
+
+def normalised_arguments(args):
+    "Return sorted (argument, value) pairs of args that affect report output, with file names made absolute."
+    arguments = dict(vars(args))
+    for argument in ['cache_dir', 'cache_size']:
+        del arguments[argument]
+    arguments['file'] = os.path.abspath(args.file)
+    if args.what_if:
+        arguments['what_if'] = os.path.abspath(args.what_if)
+    if args.reconcile:
+        arguments['reconcile'] = [os.path.abspath(args.reconcile[0]), args.reconcile[1]]
+    if args.prices:
+        arguments['prices'] = os.path.abspath(args.prices)
+    if args.generate_excel_report:
+        arguments['generate_excel_report'] = [os.path.abspath(excel_report_filename(args.generate_excel_report[0]))]
+    return sorted(arguments.items())
+
+def report_cache_key(args):
+    "Return name for the cached output of the reports requested in args."
+    digest = hashlib.sha1()
+    digest.update(file_hash(args.file))
+    if args.what_if:
+        digest.update(file_hash(args.what_if))
+    if args.reconcile:
+        digest.update(file_hash(args.reconcile[0]))
+    if args.prices:
+        digest.update(file_hash(args.prices))
+    digest.update(program_hash())
+    digest.update(repr(normalised_arguments(args)))
+    return digest.hexdigest()
+
+def load_cache_entry(cache_fname):
+    "Return CacheEntry saved in cache_fname, or None if there isn't one."
+    try:
+        with open(cache_fname, "rb") as infile:
+            entry = cPickle.load(infile)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+    ## Mark entry as recently used.
+    os.utime(cache_fname, None)
+    return entry
+
+def save_cache_entry(entry, cache_fname):
+    "Save CacheEntry entry in cache_fname."
+    cache_directory = os.path.dirname(cache_fname)
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    (handle, temporary_fname) = tempfile.mkstemp(dir=cache_directory)
+    with os.fdopen(handle, "wb") as outfile:
+        cPickle.dump(entry, outfile, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_fname, cache_fname)
+
+def evict_cache_entries(cache_directory, max_bytes):
+    "Remove least recently used entries from cache_directory until it holds at most max_bytes."
+    entries = []
+    for fname in os.listdir(cache_directory):
+        if fname.endswith(CACHE_ENTRY_SUFFIX):
+            path = os.path.join(cache_directory, fname)
+            status = os.stat(path)
+            entries.append((status.st_mtime, status.st_size, path))
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, path) in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+def run_cached_reports(args):
+    """Run the reports requested in args, or replay their saved output from args.cache_dir.
+
+    Output is only saved if the reports succeed."""
+    cache_fname = os.path.join(args.cache_dir, report_cache_key(args) + CACHE_ENTRY_SUFFIX)
+    entry = load_cache_entry(cache_fname)
+    if entry:
+        for (fname, contents) in entry.files:
+            with open(fname, "wb") as outfile:
+                outfile.write(contents)
+        sys.stdout.write(entry.stdout)
+        sys.stderr.write(entry.stderr)
+        return
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    (sys.stdout, sys.stderr) = (_RecordingOutput(stdout), _RecordingOutput(stderr))
+    try:
+        run_reports(args)
+        entry = CacheEntry(stdout=sys.stdout.recording.getvalue(), stderr=sys.stderr.recording.getvalue(), files=[])
+    finally:
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+    if args.generate_excel_report:
+        fname = excel_report_filename(args.generate_excel_report[0])
+        with open(fname, "rb") as infile:
+            entry.files.append((os.path.abspath(fname), infile.read()))
+    save_cache_entry(entry, cache_fname)
+    evict_cache_entries(args.cache_dir, args.cache_size * 1024 * 1024)
+
+# }}}
+
+# {{{ Running reports in parallel
+
+## Reports from the same parsed journal don't depend on each other, so
+## with --parallel-reports each runs in a process of its own. The
+## processes are forked once the journal has been parsed, so they
+## share it without pickling it, and don't contend for the GIL. Each
+## report's output is collected, and written in the order the reports
+## were requested.
+
+_report_jobs = []
+
+def _run_report_job(job_index):
+    "Internal. Run _report_jobs[job_index], returning its (stdout, stderr, exit status)."
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    (sys.stdout, sys.stderr) = (StringIO(), StringIO())
+    status = None
+    try:
+        try:
+            _report_jobs[job_index]()
+        except SystemExit as e:
+            status = e.code
+        return (sys.stdout.getvalue(), sys.stderr.getvalue(), status)
+    finally:
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+
+def _run_report_jobs_sequentially(jobs):
+    "Internal. Run each of jobs in turn."
+    for job in jobs:
+        job()
+
+def run_report_jobs(jobs, parallel):
+    """Run jobs (functions printing reports), in a pool of processes if parallel.
+
+    Output is written in the order of jobs either way. Jobs are run one
+    after another if there's only one, or processes can't be forked."""
+    global _report_jobs
+    if not parallel or len(jobs) < 2 or not hasattr(os, 'fork'):
+        _run_report_jobs_sequentially(jobs)
+        return
+    _report_jobs = jobs
+    try:
+        pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+    except (OSError, ImportError):
+        _report_jobs = []
+        _run_report_jobs_sequentially(jobs)
+        return
+    try:
+        for (stdout, stderr, status) in pool.imap(_run_report_job, range(len(jobs))):
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            if status not in (None, 0):
+                sys.exit(status)
+    finally:
+        pool.terminate()
+        pool.join()
+        _report_jobs = []
+
+# }}}
+
+# {{{ Batch jobs
+
+## A job file lists reports to run on the same journal, one per line,
+## as the output file (or '-' for standard output) followed by report
+## options quoted as in a shell, e.g.
+##
+##   fuel.txt --print-register 'Expenses:*:Fuel' --first-date 2013-01-01
+##   -        --print-balances Assets Liabilities --as-at 2013-06-30
+##
+## Blank lines and lines starting with '#' are ignored. The journal is
+## parsed and verified once, and indexes built from it are shared by
+## all the jobs.
+
+BatchJob = namedtuple('BatchJob', ['line', 'output_fname', 'args'])
+
+## Options that don't make sense for a single job in a batch.
+BATCH_JOB_EXCLUDED_OPTIONS = [('batch', '--batch'), ('import_csv', '--import-csv'),
+                              ('compare_revisions', '--compare-revisions'), ('close_books', '--close-books'),
+                              ('check', '--check'), ('database', '--database'),
+                              ('restrict_parsing_to_report', '--restrict-parsing-to-report'),
+                              ('complete_account', '--complete-account'),
+                              ('diagnose_verification', '--diagnose-verification'),
+                              ('tweak_signs_of_input_amounts', '--tweak-signs-of-input-amounts'),
+                              ('sort_by_date', '--sort-by-date'), ('cache_dir', '--cache-dir')]
+
+## Options that apply to the whole batch rather than to its jobs.
+BATCH_OPTIONS = ['file', 'batch', 'tweak_signs_of_input_amounts', 'sort_by_date', 'sort_chunk_size',
+                 'verbose', 'show_balance_verifications', 'ignore_balance_verification_failure']
+
+def check_batch_options(args):
+    "Exit if args give report options alongside --batch, as they belong in the job file."
+    defaults = argument_parser().parse_args([args.file])
+    for (attribute, value) in sorted(vars(args).items()):
+        if attribute not in BATCH_OPTIONS and value != getattr(defaults, attribute):
+            sys.stderr.write("--%s can't be used with --batch. Give report options in the job file.\nExiting.\n" %
+                             attribute.replace("_", "-"))
+            sys.exit(-1)
+
+def read_batch_jobs(job_fname, journal_fname):
+    "Return BatchJobs listed in job_fname, checking their options."
+    parser = argument_parser()
+    jobs = []
+    with open(job_fname) as infile:
+        line_number = 0
+        for line in infile:
+            line_number += 1
+            if line.strip() == "" or line.strip().startswith("#"):
+                continue
+            words = shlex.split(line)
+            try:
+                args = parser.parse_args([journal_fname] + words[1:])
+            except SystemExit:
+                sys.stderr.write("%s:%d: invalid report options.\nExiting.\n" % (job_fname, line_number))
+                sys.exit(-1)
+            for (attribute, option) in BATCH_JOB_EXCLUDED_OPTIONS:
+                if getattr(args, attribute) not in (None, False):
+                    sys.stderr.write("%s:%d: %s can't be used in a batch job.\nExiting.\n" % (job_fname, line_number, option))
+                    sys.exit(-1)
+            jobs.append(BatchJob(line=line_number, output_fname=words[0], args=args))
+    return jobs
+
+def run_batch(args):
+    "Run the jobs in job file args.batch on one parse of the journal args.file."
+    global _journal_indexes, _register_running_balances
+    check_batch_options(args)
+    jobs = read_batch_jobs(args.batch, args.file)
+    for job in jobs:
+        job.args.tweak_signs_of_input_amounts = args.tweak_signs_of_input_amounts
+        validate_report_options(job.args)
+    parsed_file = parse_file(args.file, args.tweak_signs_of_input_amounts, None, args.sort_by_date, args.sort_chunk_size)
+    transactions = parsed_file['transactions']
+    verifications = parsed_file['verify-balances']
+    verify_balances(transactions, verifications,
+                    (args.verbose or args.show_balance_verifications),
+                    not args.ignore_balance_verification_failure)
+    ensure_date_sorted(transactions)
+    ensure_balanced(transactions)
+    _journal_indexes = {}
+    _register_running_balances = {}
+    try:
+        for job in jobs:
+            stdout = sys.stdout
+            if job.output_fname <> "-":
+                sys.stdout = open(job.output_fname, "w")
+            try:
+                validate_report_dates(job.args)
+                run_journal_reports(job.args, transactions, verifications, excel_report_jobs(job.args, transactions))
+            finally:
+                if job.output_fname <> "-":
+                    sys.stdout.close()
+                sys.stdout = stdout
+    finally:
+        _journal_indexes = None
+        _register_running_balances = None
+
+# }}}
+
+def validate_report_dates(args):
+    "Exit if dates in args are invalid, otherwise note them in text output."
+    if (args.as_at):
+        if not is_valid_date(args.as_at):
+            sys.stderr.write("Invalid as-at-date: '%s'.\nExiting.\n" % args.as_at)
+            sys.exit(-1)
+        elif args.output_format == 'text':
+            print "# As at:", args.as_at
+
+    if (args.first_date):
+        if not is_valid_date(args.first_date):
+            sys.stderr.write("Invalid first-date: '%s'.\nExiting.\n" % args.first_date)
+            sys.exit(-1)
+        elif args.output_format == 'text':
+            print "# First date:", args.first_date
+
+    if (args.last_date):
+        if not is_valid_date(args.last_date):
+            sys.stderr.write("Invalid last-date: '%s'.\nExiting.\n" % args.last_date)
+            sys.exit(-1)
+        if args.first_date and (args.first_date > args.last_date):
+            sys.stderr.write("First date '%s' is after last-date: '%s'.\nExiting.\n"
+                             % (args.first_date, args.last_date))
+            sys.exit(-1)
+        if args.first_date and (args.first_date == args.last_date):
+            sys.stderr.write("First date '%s' same as last-date: '%s'.\nExiting.\n"
+                             % (args.first_date, args.last_date))
+            sys.exit(-1)
+        elif args.output_format == 'text':
+            print "# Last date:", args.last_date
+
+def validate_output_format(args):
+    "Exit if the reports requested in args can't be written in the requested output format."
+    if args.output_format == 'text':
+        return
+    if args.print_account_statistics is not None:
+        sys.stderr.write("--print-account-statistics only works with --output-format text.\nExiting.\n")
+        sys.exit(-1)
+    report_count = len([report for report in [args.print_chart_of_accounts, args.print_transactions,
+                                              args.print_balances is not None, args.print_register] if report])
+    if args.output_format == 'csv' and report_count > 1:
+        sys.stderr.write("--output-format csv only works with one report at a time.\nExiting.\n")
+        sys.exit(-1)
+
+def write_records(args, transactions, matching=None):
+    """Write the reports requested in args as records in args.output_format.
+
+    matching holds the transactions found by --search-descriptions (or
+    None), which are the only ones printed and shown in registers."""
+    if (args.print_chart_of_accounts):
+        write_chart_records(transactions, args.output_format)
+    if (args.print_transactions):
+        write_transaction_records(filter_by_date(matching if matching is not None else transactions,
+                                                 args.first_date, args.last_date), args.output_format)
+    trie = journal_index(account_trie_from_transactions, transactions)
+    expand_report_accounts(args, trie)
+    if (args.print_balances <> None):
+        write_balance_records(transactions, args.print_balances, args.as_at, args.first_date, args.last_date,
+                              args.output_format, dates=args.dates, depth=args.depth)
+    if (args.print_register):
+        print_registers(args, transactions, expand_account_patterns(trie, [args.print_register]), shown_transactions=matching)
+
+def expand_report_accounts(args, trie):
+    "Replace account patterns given for balance and statistics reports in args with the accounts they match."
+    if args.print_balances:
+        args.print_balances = expand_account_patterns(trie, args.print_balances)
+    if args.print_account_statistics:
+        args.print_account_statistics = expand_account_patterns(trie, args.print_account_statistics)
+
+def print_registers(args, transactions, account_strings, database=None, shown_transactions=None):
+    """Print the register requested in args for each of account_strings.
+
+    If shown_transactions is given, only their postings are shown."""
+    if args.output_format == 'csv' and len(account_strings) > 1:
+        sys.stderr.write("--output-format csv only works with a register for one account, not %d.\nExiting.\n"
+                         % len(account_strings))
+        sys.exit(-1)
+    for account_string in account_strings:
+        if args.output_format == 'text':
+            if len(account_strings) > 1:
+                print "# Register for", account_string
+            print_register(transactions, account_string, args.include_related_postings, args.reverse_print_order,
+                           args.first_date, args.last_date, database=database, limit=args.limit, tail=args.tail,
+                           shown_transactions=shown_transactions)
+        else:
+            write_register_records(transactions, account_string, args.include_related_postings, args.reverse_print_order,
+                                   args.first_date, args.last_date, args.output_format,
+                                   database=database, limit=args.limit, tail=args.tail,
+                                   shown_transactions=shown_transactions)
+
+def run_database_reports(args):
+    "Run the reports requested in args using the journal database named in args."
+    if (args.generate_excel_report or args.print_chart_of_accounts or args.print_transactions or
+        args.print_account_statistics is not None or
+        args.search_descriptions or args.restrict_parsing_to_report or args.ignore_transactions_outside_dates):
+        sys.stderr.write("--database only works with --print-balances and --print-register.\nExiting.\n")
+        sys.exit(-1)
+    db = sync_database(args.database, args.file, args.tweak_signs_of_input_amounts, args.sort_by_date, args.sort_chunk_size)
+    trie = build_account_trie(original_name for (original_name,) in db.execute("SELECT original_name FROM accounts"))
+    if args.complete_account is not None:
+        for account_string in complete_account(trie, args.complete_account):
+            print account_string
+        return
+    verify_database_balances(db,
+                             (args.verbose or args.show_balance_verifications),
+                             not args.ignore_balance_verification_failure)
+    expand_report_accounts(args, trie)
+    if (args.print_balances <> None):
+        if args.output_format == 'text':
+            print_single_unit_balances([], args.print_balances, args.print_stars_for_org_mode, args.as_at, args.first_date, args.last_date,
+                                       database=db, dates=args.dates, depth=args.depth,
+                                       price_index=report_price_index(args, [], db))
+        else:
+            write_balance_records([], args.print_balances, args.as_at, args.first_date, args.last_date, args.output_format,
+                                  database=db, dates=args.dates, depth=args.depth)
+    if (args.print_register):
+        print_registers(args, [], expand_account_patterns(trie, [args.print_register]), database=db)
+
+def report_parse_scope(args):
+    """Return the ParseScope covering the reports requested in args.
+
+    Only --print-balances and --print-register reports can be
+    restricted like this."""
+    if (args.generate_excel_report or args.print_chart_of_accounts or
+        args.print_transactions or args.search_descriptions or args.print_account_statistics is not None):
+        sys.stderr.write("--restrict-parsing-to-report only works with --print-balances and --print-register.\nExiting.\n")
+        sys.exit(-1)
+    if any(is_account_pattern(account_string) for account_string in (args.print_balances or []) + [args.print_register or ""]):
+        sys.stderr.write("--restrict-parsing-to-report doesn't work with account patterns.\nExiting.\n")
+        sys.exit(-1)
+    account_strings = []
+    if args.print_balances is not None:
+        if len(args.print_balances) == 0:
+            account_strings = None
+        else:
+            account_strings += args.print_balances
+    if args.print_register and (account_strings is not None):
+        if args.include_related_postings:
+            account_strings = None
+        else:
+            account_strings += [args.print_register]
+    first_date = args.first_date
+    last_date = args.last_date
+    if args.as_at and not args.print_register:
+        last_date = args.as_at
+    return ParseScope(first_date=first_date,
+                      last_date=last_date,
+                      account_strings=account_strings)
+
+def argument_parser():
+    "Return parser for command-line arguments."
+    parser = argparse.ArgumentParser(description='Command-line, double-entry accounting in python.')
+    parser.add_argument('file', metavar='FILE',
+                        help='the input journal file to read from')
+    parser.add_argument('--tweak-signs-of-input-amounts',
+                        default=False,
+                        action="store_true",
+                        help="negate amounts from input file for equity/liabilities/income")
+    parser.add_argument('--verbose',
+                        default=False,
+                        action="store_true",
+                        help="print extra information while running")
+    parser.add_argument('--show-balance-verifications',
+                        default=False,
                         action="store_true",
                         help="print details of account verifications")
     parser.add_argument('--ignore-balance-verification-failure',
@@ -1191,9 +4130,16 @@ def main():
                         action="store_true",
                         help="print structure of account hierarchy found in FILE")
     parser.add_argument('--print-balances', nargs='*', metavar='ACCOUNT',
-                        help="print balances or specified accounts. (All accounts if none specified.)")
+                        help="print balances or specified accounts. (All accounts if none specified.) "
+                        "Accounts can be patterns like 'Expenses:*:Fuel' or 'Assets:Bank*'")
     # parser.add_argument('--balance', nargs='*', metavar='ACCOUNT',
     #                     help='show account balances (all accounts if none specified)')
+    parser.add_argument('--print-account-statistics', nargs='*', metavar='ACCOUNT',
+                        help="print posting count, turnover, largest/smallest postings, first/last dates and average "
+                        "monthly flow for specified accounts. (All accounts if none specified.)")
+    parser.add_argument('--depth', metavar='N', type=int,
+                        help="only show accounts down to N levels deep in balance reports. "
+                        "Balances of deeper accounts are included in their parents'")
     parser.add_argument('--print-stars-for-org-mode',
                         default=False,
                         action="store_true",
@@ -1228,75 +4174,330 @@ def main():
     parser.add_argument('--generate-excel-report', metavar='EXCEL-FILENAME', nargs=1,
                         help='Write output to an excel file.')
 
-    args = parser.parse_args()
+    parser.add_argument('--prices', metavar='PRICE-FILE',
+                        help="show market values in balance and Excel reports, using prices in PRICE-FILE "
+                        "(lines like 'P 2013-06-28 BHP $29.87') and prices paid in FILE")
 
-    parsed_file = parse_file(args.file, args.tweak_signs_of_input_amounts)
-    transactions = parsed_file['transactions']
-    verifications = parsed_file['verify-balances']
+    parser.add_argument('--search-descriptions', metavar='TERM', nargs='+',
+                        help="only print transactions (and register postings) whose descriptions contain every TERM "
+                        "(TERM* matches a prefix); balances still include every transaction")
 
-    if args.generate_excel_report:
-        if not args.dates or len(args.dates) < 2:
-            sys.stderr.write("Invalid DATES: '{}'. Need at least *two* dates..\nExiting.\n".format(args.dates))
-            sys.exit(-1)
-        else:
-            write_excel_report(transactions, args.dates, args.generate_excel_report[0])
+    parser.add_argument('--persist-description-index',
+                        default=False,
+                        action="store_true",
+                        help="save the description search index next to FILE and reuse it while FILE is unchanged "
+                        "(this saves building the index, not parsing FILE)")
 
-    #if (args.print_register):
-    #    print_register(transactions, args.print_register, args.include_related_postings, args.reverse_print_order, args.first_date, args.last_date)
+    parser.add_argument('--restrict-parsing-to-report',
+                        default=False,
+                        action="store_true",
+                        help="only parse the dates/accounts needed by --print-balances/--print-register. "
+                        "FILE must be date sorted, and verify-balance checks outside those dates/accounts are skipped")
 
-    if (args.as_at):
-        if not is_valid_date(args.as_at):
-            sys.stderr.write("Invalid as-at-date: '%s'.\nExiting.\n" % args.as_at)
-            sys.exit(-1)
-        else:
-            print "# As at:", args.as_at
+    parser.add_argument('--check',
+                        default=False,
+                        action="store_true",
+                        help="only check FILE, in a single pass, printing every problem found as FILE:LINE: KIND: MESSAGE")
 
-    if (args.first_date):
-        if not is_valid_date(args.first_date):
-            sys.stderr.write("Invalid first-date: '%s'.\nExiting.\n" % args.first_date)
-            sys.exit(-1)
-        else:
-            print "# First date:", args.first_date
+    parser.add_argument('--database', metavar='DB-FILE',
+                        help="load FILE into sqlite database DB-FILE (only re-importing changed transactions) "
+                        "and calculate balances and registers from there")
 
-    if (args.last_date):
-        if not is_valid_date(args.last_date):
-            sys.stderr.write("Invalid last-date: '%s'.\nExiting.\n" % args.last_date)
+    parser.add_argument('--close-books', nargs=2, metavar=('CUTOFF-DATE', 'ARCHIVE-FILE'),
+                        help="move transactions up to CUTOFF-DATE from FILE to ARCHIVE-FILE, "
+                        "replacing them with an opening balances transaction")
+
+    parser.add_argument('--sort-by-date',
+                        default=False,
+                        action="store_true",
+                        help="sort transactions in FILE by date (keeping the order of transactions on the same date)")
+
+    parser.add_argument('--sort-chunk-size', metavar='N', type=int,
+                        help="with --sort-by-date, sort using temporary files holding N transactions at a time")
+
+    parser.add_argument('--import-csv', nargs=3, metavar=('CSV-FILE', 'BANK-ACCOUNT', 'COUNTER-ACCOUNT'),
+                        help="print transactions for rows of bank statement CSV-FILE that aren't already in FILE")
+
+    parser.add_argument('--csv-columns', metavar='NAMES', default="date,description,amount",
+                        help="comma-separated names of the columns in CSV-FILE (default: date,description,amount)")
+
+    parser.add_argument('--reconcile', nargs=2, metavar=('CSV-FILE', 'ACCOUNT'),
+                        help="match rows of bank statement CSV-FILE to postings to ACCOUNT by amount and date, "
+                        "and print the matched and unmatched rows and postings")
+
+    parser.add_argument('--date-tolerance', metavar='DAYS', type=int, default=3,
+                        help="with --reconcile, match postings dated up to DAYS days from statement rows "
+                        "(default: %(default)s)")
+
+    parser.add_argument('--csv-day-first',
+                        default=False,
+                        action="store_true",
+                        help="dates in CSV-FILE are day first, e.g. 31/01/2013")
+
+    register_window = parser.add_mutually_exclusive_group()
+    register_window.add_argument('--limit', metavar='N', type=int,
+                                 help="only print the first N postings of the register "
+                                 "(postings to the account must be in date order)")
+    register_window.add_argument('--tail', metavar='N', type=int,
+                                 help="only print the last N postings of the register "
+                                 "(postings to the account must be in date order)")
+
+    parser.add_argument('--compare-revisions', metavar='REVISION', nargs='+',
+                        help="print balance changes and added/removed transactions between each of these git "
+                        "revisions of FILE and the next")
+
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='text',
+                        help="write chart of accounts, transactions, balances and registers as text (default), "
+                        "newline-delimited JSON or CSV records, with amounts in minor units (e.g. cents)")
+
+    parser.add_argument('--complete-account', metavar='PREFIX',
+                        help="print accounts whose names start with PREFIX, ignoring case")
+
+    parser.add_argument('--what-if', metavar='WHAT-IF-FILE',
+                        help="print balances (of --print-balances accounts, if given) with and without the "
+                        "hypothetical transactions in WHAT-IF-FILE side by side, and the verifications they affect")
+
+    parser.add_argument('--diagnose-verification', metavar='ACCOUNT',
+                        help="find the first failing VERIFY-BALANCE for ACCOUNT and the postings that could explain it")
+
+    parser.add_argument('--batch', metavar='JOB-FILE',
+                        help="parse and verify FILE once, then run each report listed in JOB-FILE, one per line "
+                        "as OUTPUT-FILE (or - for standard output) followed by report options "
+                        "(report options can't be given alongside --batch)")
+
+    parser.add_argument('--parallel-reports',
+                        default=False,
+                        action="store_true",
+                        help="run the requested reports (and Excel report) in parallel processes, "
+                        "printing their output in the usual order")
+
+    parser.add_argument('--cache-dir', metavar='DIRECTORY',
+                        help="reuse report output saved in DIRECTORY while FILE, the arguments and this program "
+                        "are unchanged (not for --database, --close-books, --import-csv, --compare-revisions or --batch)")
+
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help="remove least recently used output from --cache-dir when it holds more than MB megabytes "
+                        "(default: %(default)s)")
+    return parser
+
+def run_reports(args):
+    "Run the reports requested in command-line arguments args."
+    if args.batch:
+        run_batch(args)
+        return
+
+    if args.import_csv:
+        import_statement(args.import_csv[0], args.file, args.import_csv[1], args.import_csv[2],
+                         args.tweak_signs_of_input_amounts, args.csv_columns.split(","), args.csv_day_first)
+        return
+
+    if args.compare_revisions:
+        if len(args.compare_revisions) < 2:
+            sys.stderr.write("--compare-revisions needs at least two revisions.\nExiting.\n")
             sys.exit(-1)
-        if args.first_date and (args.first_date > args.last_date):
-            sys.stderr.write("First date '%s' is after last-date: '%s'.\nExiting.\n"
-                             % (args.first_date, args.last_date))
+        print_revision_comparison(args.file, args.compare_revisions, args.tweak_signs_of_input_amounts)
+        return
+
+    if args.close_books:
+        if not is_valid_date(args.close_books[0]):
+            sys.stderr.write("Invalid cutoff date: '%s'.\nExiting.\n" % args.close_books[0])
             sys.exit(-1)
-        if args.first_date and (args.first_date == args.last_date):
-            sys.stderr.write("First date '%s' same as last-date: '%s'.\nExiting.\n"
-                             % (args.first_date, args.last_date))
+        close_books(args.file, args.close_books[0], args.close_books[1], args.tweak_signs_of_input_amounts)
+        return
+
+    if args.check:
+        problem_count = check_journal_file(args.file, args.tweak_signs_of_input_amounts,
+                                           args.sort_by_date, args.sort_chunk_size)
+        if problem_count > 0:
+            sys.stderr.write("%d problem(s) found.\n" % problem_count)
             sys.exit(-1)
-        else:
-            print "# Last date:", args.last_date
+        return
+
+    validate_report_options(args)
+    validate_report_dates(args)
+
+    if args.database:
+        run_database_reports(args)
+        return
+
+    scope = None
+    if args.restrict_parsing_to_report:
+        scope = report_parse_scope(args)
+    parsed_file = parse_file(args.file, args.tweak_signs_of_input_amounts, scope,
+                             args.sort_by_date, args.sort_chunk_size)
+    transactions = parsed_file['transactions']
+    verifications = parsed_file['verify-balances']
+
+    if args.complete_account is not None:
+        for account_string in complete_account(account_trie_from_transactions(transactions), args.complete_account):
+            print account_string
+        return
+
+    if args.diagnose_verification:
+        ensure_date_sorted(transactions)
+        diagnosis = diagnose_verifications(transactions, verifications, args.diagnose_verification)
+        print_verification_diagnosis(transactions, diagnosis)
+        return
+
+    jobs = excel_report_jobs(args, transactions)
+
+    #if (args.print_register):
+    #    print_register(transactions, args.print_register, args.include_related_postings, args.reverse_print_order, args.first_date, args.last_date)
 
     verify_balances(transactions, verifications,
                     (args.verbose or args.show_balance_verifications),
                     not args.ignore_balance_verification_failure)
     ensure_date_sorted(transactions)
     ensure_balanced(transactions)
+    run_journal_reports(args, transactions, verifications, jobs)
+
+def validate_report_options(args):
+    "Exit if report options in args are invalid or don't work together."
+    for (option, count) in [('--limit', args.limit), ('--tail', args.tail)]:
+        if count is not None and count < 0:
+            sys.stderr.write("Invalid %s: '%d'.\nExiting.\n" % (option, count))
+            sys.exit(-1)
+    if args.depth is not None and args.depth < 1:
+        sys.stderr.write("Invalid --depth: '%d'.\nExiting.\n" % args.depth)
+        sys.exit(-1)
+    if args.date_tolerance < 0:
+        sys.stderr.write("Invalid --date-tolerance: '%d'.\nExiting.\n" % args.date_tolerance)
+        sys.exit(-1)
+
+    if args.reconcile and (args.database or args.restrict_parsing_to_report or args.output_format <> 'text'):
+        sys.stderr.write("--reconcile doesn't work with --database, --restrict-parsing-to-report or --output-format.\n"
+                         "Exiting.\n")
+        sys.exit(-1)
+    if args.what_if and (args.database or args.restrict_parsing_to_report or args.output_format <> 'text' or
+                         args.first_date or args.last_date or args.dates):
+        sys.stderr.write("--what-if doesn't work with --database, --restrict-parsing-to-report, --output-format, "
+                         "--first-date, --last-date or --dates.\nExiting.\n")
+        sys.exit(-1)
+
+    validate_output_format(args)
+
+def excel_report_jobs(args, transactions):
+    """Write the Excel report requested in args from transactions.
+
+    With --parallel-reports, return a job writing it instead, to be run
+    with the other reports."""
+    if not args.generate_excel_report:
+        return []
+    if not args.dates or len(args.dates) < 2:
+        sys.stderr.write("Invalid DATES: '{}'. Need at least *two* dates..\nExiting.\n".format(args.dates))
+        sys.exit(-1)
+    price_index = report_price_index(args, transactions)
+    if args.parallel_reports:
+        return [lambda: write_excel_report(transactions, args.dates, args.generate_excel_report[0], price_index)]
+    write_excel_report(transactions, args.dates, args.generate_excel_report[0], price_index)
+    return []
+
+def report_price_index(args, transactions, database=None):
+    """Return price index for market values in reports if args asks for them, otherwise None.
+
+    Prices paid in transactions (or in the journal database) are included."""
+    if not args.prices:
+        return None
+    if database:
+        return load_price_index(args.prices, database_prices(database))
+    return load_price_index(args.prices, transaction_prices(transactions))
+
+def run_journal_reports(args, transactions, verifications, jobs=None):
+    """Run the reports requested in args on parsed, verified transactions.
+
+    jobs are reports to run along with them (see excel_report_jobs)."""
+    jobs = jobs or []
+    price_index = report_price_index(args, transactions)
+    if args.reconcile or args.what_if or args.output_format <> 'text':
+        ## These reports aren't run as jobs.
+        _run_report_jobs_sequentially(jobs)
+        jobs = []
+
+    if args.reconcile:
+        (csv_fname, account_string) = args.reconcile
+        validate_statement_columns(args.csv_columns.split(","))
+        trie = journal_index(account_trie_from_transactions, transactions)
+        account_strings = expand_account_patterns(trie, [account_string])
+        with open(csv_fname, "rb") as infile:
+            rows = read_statement_rows(infile, args.csv_columns.split(","), args.csv_day_first)
+            reconciliation = reconcile_statement(transactions, account_strings, rows,
+                                                 args.tweak_signs_of_input_amounts, args.date_tolerance)
+        print_reconciliation(transactions, reconciliation)
+        return
+
+    if args.what_if:
+        overlay = parse_file(args.what_if, args.tweak_signs_of_input_amounts)
+        ensure_balanced(overlay['transactions'])
+        account_names = expand_account_patterns(account_trie_from_transactions(transactions + overlay['transactions']),
+                                                args.print_balances or [])
+        print_what_if(transactions, verifications, args.what_if, overlay, account_names, args.print_stars_for_org_mode,
+                      args.as_at, args.depth)
+        return
+
+    ## Matches only limit what's printed by the transaction and
+    ## register reports. Balances still come from every transaction.
+    matching = None
+    if (args.search_descriptions):
+        if args.persist_description_index:
+            index = description_index_for_file(args.file, transactions)
+        else:
+            index = journal_index(build_description_index, transactions)
+        matching = [transactions[txn_id] for txn_id in search_description_index(index, args.search_descriptions)]
+        if args.output_format == 'text':
+            print "# Transactions with descriptions matching:", " ".join(args.search_descriptions)
 
     if (args.ignore_transactions_outside_dates):
-        print "# Ignoring transactions earlier/later than specified dates."
+        if args.output_format == 'text':
+            print "# Ignoring transactions earlier/later than specified dates."
         transactions = filter_by_date(transactions, args.first_date, args.last_date)
 
+    if args.output_format <> 'text':
+        write_records(args, transactions, matching)
+        return
+
+    trie = journal_index(account_trie_from_transactions, transactions)
+    expand_report_accounts(args, trie)
+    run_report_jobs(jobs + text_report_jobs(args, transactions, trie, price_index, matching), args.parallel_reports)
+
+def text_report_jobs(args, transactions, trie, price_index=None, matching=None):
+    """Return functions printing each of the text reports requested in args, in order.
+
+    matching holds the transactions found by --search-descriptions (or
+    None), which are the only ones printed and shown in registers."""
+    jobs = []
+
     if (args.print_chart_of_accounts):
-        for line in chart_of_accounts(account_tree_from_transactions(transactions)):
-            print "  "*line.indent, line.name
+        def print_chart():
+            for line in chart_of_accounts(account_tree_from_transactions(transactions)):
+                print "  "*line.indent, line.name
+        jobs.append(print_chart)
 
     if (args.print_transactions):
-        relevant_transactions = filter_by_date(transactions, args.first_date, args.last_date)
-        print_transactions(relevant_transactions)
-
+        jobs.append(lambda: print_transactions(filter_by_date(matching if matching is not None else transactions,
+                                                              args.first_date, args.last_date)))
 
     if (args.print_balances <> None):
-        print_single_unit_balances(transactions, args.print_balances, args.print_stars_for_org_mode, args.as_at, args.first_date, args.last_date)
+        jobs.append(lambda: print_single_unit_balances(transactions, args.print_balances, args.print_stars_for_org_mode,
+                                                       args.as_at, args.first_date, args.last_date,
+                                                       dates=args.dates, depth=args.depth, price_index=price_index))
+
+    if (args.print_account_statistics <> None):
+        jobs.append(lambda: print_account_statistics(transactions, args.print_account_statistics,
+                                                     args.print_stars_for_org_mode,
+                                                     args.first_date, args.last_date, depth=args.depth))
 
     if (args.print_register):
-        print_register(transactions, args.print_register, args.include_related_postings, args.reverse_print_order, args.first_date, args.last_date)
+        account_strings = expand_account_patterns(trie, [args.print_register])
+        jobs.append(lambda: print_registers(args, transactions, account_strings, shown_transactions=matching))
+    return jobs
+
+def main():
+    "Program that runs if invoked as a script."
+    args = argument_parser().parse_args()
+    if args.cache_dir and is_cacheable(args):
+        run_cached_reports(args)
+    else:
+        run_reports(args)
 
 if __name__ == "__main__":
     main()
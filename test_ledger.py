@@ -1,10 +1,46 @@
 "Unit tests for ledger.py"
 
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from StringIO import StringIO
+
 from ledger import chart_of_accounts, print_accounts, parse_amount, \
                    root_account_name, is_valid_account_string, is_balanced, \
-                   account_string_components, account_tree_from_account_strings, \
+                   account_string_components, \
                    account_string_and_parents, balance_amounts, contains_account, \
                    join_columns, justify_columns, format_amount
+from ledger import description_tokens, build_description_index, search_description_index
+from ledger import build_account_index, account_subtree_range, in_account_subtree, subtree_postings, \
+                   transactions_restricted_to_accounts, calculate_register
+from ledger import parse_transactions, ParseScope, check_journal, JournalProblem
+from ledger import open_database, import_transactions, database_account_tree, database_register, \
+                   single_unit_report_helper, calculate_balances, filter_by_date
+from ledger import close_books_lines, close_books
+from ledger import iter_journal, sort_journal
+from ledger import balance_columns, database_balance_columns
+from ledger import build_import_index, read_statement_rows, statement_transactions
+from ledger import build_running_balances, running_balance_as_at, diagnose_verifications
+from ledger import single_unit_balances_helper, find_original_prefix
+from ledger import summarise_journal, compare_summaries, revision_summary
+from ledger import record_writer, iter_accounts, write_balance_records, write_register_records
+from ledger import account_statistics, AccountStatistics, months_spanned, account_tree_from_transactions, account_tree_lines
+from ledger import build_account_trie, match_account_patterns, complete_account, expand_account_patterns
+from ledger import account_tree_snapshots, book_amount_to_snapshot
+from ledger import parse_file, journal_compression, decompress_journal
+from ledger import argument_parser, run_cached_reports, evict_cache_entries
+from ledger import what_if_balance_columns, what_if_verifications
+from ledger import reconcile_statement, StatementRow
+from ledger import run_report_jobs
+from ledger import run_batch, run_reports
+from ledger import read_prices, transaction_prices, build_price_index, price_as_at, market_value
+from ledger import database_prices, transaction_hash, write_excel_report
+from ledger import sync_database
+import ledger
 
 def test_join_columns():
     assert join_columns([['a','b'], ['c','d']])==['a b', 'c d']
@@ -131,12 +167,24 @@ class TestAccounts:
 
 
 
-    def test_account_tree_from_account_strings(self):
-        assert account_tree_from_account_strings(self.account_strings) == self.account_structure
+    def account_tree(self):
+        return account_tree_from_transactions([{'date': '2013-01-01', 'line': 1, 'description': 'Accounts',
+                                                'postings': [{'account': account_string,
+                                                              'amount': {'units': 'AUD', 'quantity': 0}}
+                                                             for account_string in self.account_strings]}])
+
+    def test_account_tree_from_transactions(self):
+        def structure(accounts_dict):
+            return dict((key, {'has_own_postings': len(account.postings) > 0,
+                               'balances': account.balances,
+                               'name': account.original_name,
+                               'sub_accounts': structure(account.sub_accounts)})
+                        for (key, account) in accounts_dict.items())
+        assert structure(self.account_tree()) == self.account_structure
 
     def test_chart_of_accounts(self):
         "Check account hierarchy is represented correctly in text."
-        assert chart_of_accounts(account_tree_from_account_strings(self.account_strings)) == self.chart_of_accounts
+        assert ["  "*line.indent + line.name for line in chart_of_accounts(self.account_tree())] == self.chart_of_accounts
 
 def test_account_string_and_parents():
     assert account_string_and_parents('expenses:charity:Sponsorship:40HrFamine') == ['EXPENSES',
@@ -157,3 +205,851 @@ def test_balance_amounts():
 def test_contains_account():
     assert contains_account("Income", "Expenses:Phone") == False
     assert contains_account("Income", "Income:Salary") == True
+
+def test_description_tokens():
+    assert description_tokens("Paid Invoice INV-1234, thanks.") == ['paid', 'invoice', 'inv', '1234', 'thanks']
+
+def test_search_description_index():
+    transactions = [{'description': 'Woolworths groceries'},
+                    {'description': 'Caltex petrol'},
+                    {'description': 'Woolworths petrol'}]
+    index = build_description_index(transactions)
+    assert search_description_index(index, ['woolworths']) == [0, 2]
+    assert search_description_index(index, ['Petrol', 'WOOL*']) == [2]
+    assert search_description_index(index, ['pet*']) == [1, 2]
+    assert search_description_index(index, ['coles']) == []
+
+def _sample_transactions():
+    return [{'date': '2013-01-01', 'line': 1, 'description': 'Opening balance',
+             'postings': [{'account': 'Assets:Cash', 'amount': {'units': 'AUD', 'quantity': 10000}},
+                          {'account': 'Equity:OpeningBalances', 'amount': {'units': 'AUD', 'quantity': 10000}}]},
+            {'date': '2013-01-02', 'line': 5, 'description': 'Groceries',
+             'postings': [{'account': 'Expenses:Food', 'amount': {'units': 'AUD', 'quantity': 2500}},
+                          {'account': 'Assets:Cash', 'amount': {'units': 'AUD', 'quantity': -2500}}]},
+            {'date': '2013-01-03', 'line': 9, 'description': 'Petrol',
+             'postings': [{'account': 'expense:Motor:Fuel', 'amount': {'units': 'AUD', 'quantity': 4000}},
+                          {'account': 'Assets:Cash', 'amount': {'units': 'AUD', 'quantity': -4000}}]}]
+
+def test_register_of_search_matches():
+    transactions = _sample_transactions()
+    matching = [transactions[1]]
+    ## Only the matching transaction is shown, with its balance from the whole journal.
+    assert calculate_register(transactions, 'Assets', False, None, None, shown_transactions=matching) == \
+        [('2013-01-02', '$75.00', '-$25.00', 'Assets:Cash', 'Groceries')]
+    for (limit, tail) in [(1, None), (None, 1), (None, 5)]:
+        assert calculate_register(transactions, 'Assets', False, None, None, limit=limit, tail=tail,
+                                  shown_transactions=matching) == \
+            calculate_register(transactions, 'Assets', False, None, None, shown_transactions=matching)
+    assert calculate_register(transactions, 'Assets', False, None, None, tail=0, shown_transactions=matching) == []
+
+def test_account_index_subtrees():
+    index = build_account_index(_sample_transactions())
+    ## ASSETS, ASSETS:CASH, EQUITY, EQUITY:OPENINGBALANCES, EXPENSES, EXPENSES:FOOD, EXPENSES:MOTOR, EXPENSES:MOTOR:FUEL
+    assert account_subtree_range(index, 'Expenses') == (4, 7)
+    assert account_subtree_range(index, 'Expenses:Motor') == (6, 7)
+    assert account_subtree_range(index, 'Income') == None
+    assert in_account_subtree(index, (4, 7), 'expense:Motor:Fuel')
+    assert not in_account_subtree(index, (4, 7), 'Assets:Cash')
+    assert subtree_postings(index, 'Expenses') == [(1, 0), (2, 0)]
+    assert subtree_postings(index, 'Assets') == [(0, 0), (1, 1), (2, 1)]
+
+def test_transactions_restricted_to_accounts():
+    transactions = _sample_transactions()
+    restricted = transactions_restricted_to_accounts(transactions, ['Expenses:Motor'], build_account_index(transactions))
+    assert restricted == [dict(transactions[2], postings=transactions[2]['postings'][:1])]
+
+def test_calculate_register():
+    assert calculate_register(_sample_transactions(), 'Expenses', False, None, None) == \
+        [('2013-01-02', '$25.00', '$25.00', 'Expenses:Food', 'Groceries'),
+         ('2013-01-03', '$65.00', '$40.00', 'expense:Motor:Fuel', 'Petrol')]
+    assert calculate_register(_sample_transactions(), 'Assets', True, '2013-01-03', None) == \
+        [('2013-01-03', '', '$40.00', 'expense:Motor:Fuel', 'Petrol'),
+         ('', '$35.00', '-$40.00', 'Assets:Cash', '')]
+
+JOURNAL_LINES = """2013-01-01 Opening balance
+  Assets:Cash      $100
+  Equity:OpeningBalances      $100
+
+2013-01-02 Groceries
+  Expenses:Food    $25
+  Assets:Cash     -$25
+
+VERIFY-BALANCE 2013-01-02 Assets:Cash $75
+
+2013-01-03 Petrol
+  Expenses:Motor:Fuel    $40
+  Assets:Cash     -$40
+
+2013-01-04 Lunch
+  Expenses:Food    $10
+  Assets:Cash     -$10
+""".splitlines()
+
+def test_parse_transactions_scope_dates():
+    parsed = parse_transactions(JOURNAL_LINES, False, ParseScope('2013-01-03', '2013-01-03', None))
+    transactions = parsed['transactions']
+    assert [t['description'] for t in transactions] == ['Opening balances brought forward', 'Petrol']
+    assert transactions[0]['date'] == '2013-01-02'
+    assert transactions[0]['postings'] == [{'line': 1, 'account': 'Assets:Cash', 'amount': {'units': 'AUD', 'quantity': 7500}},
+                                           {'line': 1, 'account': 'Equity:OpeningBalances', 'amount': {'units': 'AUD', 'quantity': 10000}},
+                                           {'line': 1, 'account': 'Expenses:Food', 'amount': {'units': 'AUD', 'quantity': 2500}}]
+    assert is_balanced(transactions[0])
+    assert parsed['verify-balances'] == []
+
+def test_parse_transactions_scope_keeps_late_verifications():
+    lines = JOURNAL_LINES + ["", "VERIFY-BALANCE 2013-01-03 Assets:Cash $35"]
+    for (sort, extra_lines) in [(True, []),
+                                ## Transactions past the scope aren't parsed at all.
+                                (False, ["", "2013-01-05 Bad", "  Assets:Cash nonsense"])]:
+        parsed = parse_transactions(lines + extra_lines, False, ParseScope(None, '2013-01-03', None), sort)
+        assert [t['description'] for t in parsed['transactions']] == ['Opening balance', 'Groceries', 'Petrol']
+        assert [(v['line'], v['date']) for v in parsed['verify-balances']] == [(9, '2013-01-02'), (19, '2013-01-03')]
+
+def test_parse_transactions_scope_accounts():
+    parsed = parse_transactions(JOURNAL_LINES, False, ParseScope(None, None, ['Expenses:Motor']))
+    transactions = parsed['transactions']
+    assert [t['description'] for t in transactions] == ['Petrol']
+    assert [p['account'] for p in transactions[0]['postings']] == ['Expenses:Motor:Fuel']
+    assert transactions[0]['pruned']
+
+def test_check_journal():
+    assert list(check_journal(JOURNAL_LINES, False)) == []
+    lines = ["VERIFY-BALANCE 2013-01-02 Assets:Cash $60"] + JOURNAL_LINES + \
+            ["",
+             "2013-01-01 Late",
+             "  Assets:Cash $1",
+             "  Equity:OpeningBalances $2",
+             "",
+             "2013-01-05 Bad account",
+             "  Asets:Cash $1"]
+    assert list(check_journal(lines, False)) == \
+        [JournalProblem(1, 'verify-balance-failed',
+                        "verify-balance for account 'Assets:Cash' at 2013-01-02. Expected balance: $60.00. Actual balance: $75.00."),
+         JournalProblem(20, 'not-date-sorted', "date: '2013-01-01' description: 'Late' is not in date order."),
+         JournalProblem(20, 'not-balanced',
+                        "Transaction does not balance. Date: '2013-01-01', description: Late. Imbalance: -$1.00."),
+         JournalProblem(25, 'parse-error', "invalid account string: 'Asets:Cash'.")]
+
+def test_check_journal_late_verifications():
+    lines = JOURNAL_LINES + ["",
+                             "VERIFY-BALANCE 2013-01-02 Assets $75",
+                             "VERIFY-BALANCE 2013-01-03 Assets:Cash $30"]
+    expected = [JournalProblem(20, 'verify-balance-failed',
+                               "verify-balance for account 'Assets:Cash' at 2013-01-03. Expected balance: $30.00. Actual balance: $35.00.")]
+    assert list(check_journal(lines, False)) == expected
+    assert list(check_journal(iter(lines), False, reread_lines=lambda: iter(lines))) == expected
+    assert [problem.kind for problem in check_journal(iter(lines), False)] == ['verify-balance-unchecked'] * 2
+
+def test_database_import_is_incremental():
+    db = open_database(":memory:")
+    transactions = _sample_transactions()
+    import_transactions(db, transactions, [])
+    ids = [row[0] for row in db.execute("SELECT id FROM transactions ORDER BY position")]
+    ## Drop the first transaction, and add a new one at the end.
+    new_transaction = {'date': '2013-01-04', 'line': 13, 'description': 'Lunch',
+                       'postings': [{'account': 'Expenses:Food', 'amount': {'units': 'AUD', 'quantity': 1000}},
+                                    {'account': 'Assets:Cash', 'amount': {'units': 'AUD', 'quantity': -1000}}]}
+    import_transactions(db, transactions[1:] + [new_transaction], [])
+    new_ids = [row[0] for row in db.execute("SELECT id FROM transactions ORDER BY position")]
+    assert new_ids[:2] == ids[1:]
+    assert new_ids[2] not in ids
+    assert db.execute("SELECT COUNT(*) FROM postings").fetchone() == (6,)
+
+def test_database_queries_match_transactions():
+    db = open_database(":memory:")
+    transactions = _sample_transactions()
+    import_transactions(db, transactions, [])
+    for date in [None, '2013-01-02']:
+        from_database = single_unit_report_helper(database_account_tree(db, date))
+        from_transactions = single_unit_report_helper(calculate_balances(filter_by_date(transactions, last_date=date), date))
+        assert [line[:3] for line in from_database] == [line[:3] for line in from_transactions]
+    for (account, related, first_date) in [('Assets', False, None), ('Expenses', True, '2013-01-03')]:
+        assert database_register(db, account, related, first_date, None) == \
+            calculate_register(transactions, account, related, first_date, None)
+
+def test_close_books_lines():
+    lines = [line + "\n" for line in JOURNAL_LINES]
+    (archive, live) = close_books_lines(lines, '2013-01-02', 'archive.transactions', False)
+    assert archive == lines[:9]
+    assert live == ["# Balances brought forward by ledger.py --close-books.\n",
+                    "2013-01-02 Opening balances as at 2013-01-02. Earlier transactions are in archive.transactions.\n",
+                    "  Assets:Cash  $75.00\n",
+                    "  Equity:OpeningBalances  $100.00\n",
+                    "  Expenses:Food  $25.00\n",
+                    "\n",
+                    "VERIFY-BALANCE 2013-01-02 Assets:Cash $75.00\n",
+                    "VERIFY-BALANCE 2013-01-02 Equity:OpeningBalances $100.00\n",
+                    "VERIFY-BALANCE 2013-01-02 Expenses:Food $25.00\n",
+                    "\n"] + lines[9:]
+
+def test_close_books_with_emptied_account():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal")
+        archive_fname = os.path.join(directory, "archive")
+        lines = JOURNAL_LINES + ["",
+                                 "2013-01-04 Changed banks",
+                                 "  Assets:NewBank    $25",
+                                 "  Assets:Cash     -$25",
+                                 "",
+                                 "2013-01-05 Bank fee",
+                                 "  Expenses:Fees    $1",
+                                 "  Assets:NewBank     -$1",
+                                 "",
+                                 "VERIFY-BALANCE 2013-01-05 Assets:Cash $0"]
+        with open(journal_fname, "w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        close_books(journal_fname, '2013-01-04', archive_fname, False)
+        with open(journal_fname) as infile:
+            live = infile.readlines()
+        assert "  Assets:Cash  $0.00\n" in live
+        assert "VERIFY-BALANCE 2013-01-04 Assets:Cash $0.00\n" in live
+        assert live[-5:] == [line + "\n" for line in lines[-5:]]
+    finally:
+        shutil.rmtree(directory)
+
+def test_sort_journal():
+    lines = JOURNAL_LINES[8:] + [""] + JOURNAL_LINES[:8]
+    in_file_order = [(kind, item.get('description')) for (kind, item) in iter_journal(lines, False)]
+    assert in_file_order == [('verify-balance', None), ('transaction', 'Petrol'), ('transaction', 'Lunch'),
+                             ('transaction', 'Opening balance'), ('transaction', 'Groceries')]
+    for chunk_size in [None, 1, 2, 10]:
+        entries = list(sort_journal(iter_journal(lines, False), chunk_size))
+        assert [(kind, item.get('description')) for (kind, item) in entries] == \
+            [('verify-balance', None), ('transaction', 'Opening balance'), ('transaction', 'Groceries'),
+             ('transaction', 'Petrol'), ('transaction', 'Lunch')]
+        assert [item['line'] for (kind, item) in entries] == [1, 11, 15, 3, 7]
+
+def test_balance_columns():
+    (lines, columns) = balance_columns(_sample_transactions(), [], ['2013-01-02', '2013-01-01', '2013-01-03'])
+    assert [(line.name, line.indent) for line in lines] == [('Assets:Cash', 0), ('Equity:OpeningBalances', 0),
+                                                            ('Expenses', 0), ('Food', 1), ('Motor:Fuel', 1)]
+    assert columns == [[{'AUD': 10000}, {'AUD': 10000}, {}, {}, {}],
+                       [{'AUD': 7500}, {'AUD': 10000}, {'AUD': 2500}, {'AUD': 2500}, {}],
+                       [{'AUD': 3500}, {'AUD': 10000}, {'AUD': 6500}, {'AUD': 2500}, {'AUD': 4000}]]
+    db = open_database(":memory:")
+    import_transactions(db, _sample_transactions(), [])
+    (db_lines, db_columns) = database_balance_columns(db, ['Expenses'], ['2013-01-02', '2013-01-03'])
+    assert [(line.name, line.indent) for line in db_lines] == [('Expenses', 0), ('Food', 1), ('Motor:Fuel', 1)]
+    assert db_columns == [column[2:] for column in columns[1:]]
+
+def test_statement_rows():
+    rows = list(read_statement_rows(["Date,Narrative,Debit/Credit\n",
+                                     "02/01/2013,  WOOLWORTHS   1234 ,-25.00\n",
+                                     "\n",
+                                     "03/01/2013,Salary,\"1,000.00\"\n"],
+                                    ['date', 'description', 'amount'], True))
+    assert [tuple(row) for row in rows] == [(2, '2013-01-02', 'WOOLWORTHS 1234', '-25.00'),
+                                            (4, '2013-01-03', 'Salary', '1,000.00')]
+
+def test_statement_transactions_skip_duplicates():
+    transactions = _sample_transactions()
+    transactions[1]['description'] = "Woolworths, 1234"
+    rows = list(read_statement_rows(["2013-01-02,WOOLWORTHS 1234,-25.00\n",
+                                     "2013-01-02,WOOLWORTHS 1234,-25.00\n",
+                                     "2013-01-03,Salary,1000\n"],
+                                    ['date', 'description', 'amount'], False))
+    index = build_import_index(transactions)
+    new = [transaction for (row, transaction) in
+           statement_transactions(rows, 'Assets:Cash', 'Expenses:Food', False, index)]
+    assert [(transaction['line'], transaction['description']) for transaction in new] == \
+        [(2, 'WOOLWORTHS 1234'), (3, 'Salary')]
+    assert [posting['amount']['quantity'] for posting in new[0]['postings']] == [-2500, 2500]
+    assert all(is_balanced(transaction) for transaction in new)
+    income = list(statement_transactions(rows[2:], 'Assets:Cash', 'Income:Salary', False, {}))[0][1]
+    assert [posting['amount']['quantity'] for posting in income['postings']] == [100000, 100000]
+    assert is_balanced(income)
+
+def test_running_balances():
+    transactions = _sample_transactions()
+    running = build_running_balances(transactions, 'Assets', build_account_index(transactions))
+    assert running_balance_as_at(running, '2012-12-31') == {}
+    assert running_balance_as_at(running, '2013-01-02') == {'AUD': 7500}
+    assert running_balance_as_at(running, '2014-01-01') == {'AUD': 3500}
+
+def test_diagnose_verifications():
+    transactions = _sample_transactions()
+    def verification(line, date, quantity):
+        return {'line': line, 'date': date, 'account': 'assets:cash', 'amount': {'units': 'AUD', 'quantity': quantity}}
+    verifications = [verification(20, '2013-01-05', 4500), verification(10, '2013-01-01', 10000),
+                     verification(11, '2013-01-02', 7500), verification(12, '2013-01-04', 4500)]
+    diagnosis = diagnose_verifications(transactions, verifications, 'Assets:Cash')
+    assert diagnosis.last_passed['line'] == 11
+    assert diagnosis.first_failed['line'] == 12
+    assert diagnosis.difference == {'AUD': -1000}
+    assert diagnosis.candidates == [(2, 1)]
+    diagnosis = diagnose_verifications(transactions, verifications[1:3], 'Assets:Cash')
+    assert diagnosis.first_failed is None and diagnosis.last_passed['line'] == 11
+    diagnosis = diagnose_verifications(transactions, [verification(10, '2013-01-02', 10000)], 'Assets:Cash')
+    assert diagnosis.last_passed is None
+    assert diagnosis.candidates == [(0, 0), (1, 1)]
+    ## Dates not written in ISO format are normalised before comparing.
+    diagnosis = diagnose_verifications(transactions, [verification(11, '2013/1/2', 7500), verification(12, '2013-01-04', 4500)],
+                                       'Assets:Cash')
+    assert diagnosis.last_passed['line'] == 11 and diagnosis.first_failed['line'] == 12
+    assert diagnosis.candidates == [(2, 1)]
+
+def test_register_limit_and_tail():
+    transactions = _sample_transactions()
+    db = open_database(":memory:")
+    import_transactions(db, transactions, [])
+    for (first_date, last_date) in [(None, None), ('2013-01-02', None), (None, '2013-01-02')]:
+        full = calculate_register(transactions, 'Assets', False, first_date, last_date)
+        for count in [0, 1, 2, 5]:
+            assert calculate_register(transactions, 'Assets', False, first_date, last_date, limit=count) == full[:count]
+            assert calculate_register(transactions, 'Assets', False, first_date, last_date, tail=count) == \
+                full[len(full)-min(count, len(full)):]
+            assert database_register(db, 'Assets', False, first_date, last_date, limit=count) == full[:count]
+            assert database_register(db, 'Assets', False, first_date, last_date, tail=count) == \
+                full[len(full)-min(count, len(full)):]
+            ## During a batch, opening balances come from kept running balances.
+            ledger._register_running_balances = {}
+            try:
+                assert calculate_register(transactions, 'Assets', False, first_date, last_date, tail=count) == \
+                    full[len(full)-min(count, len(full)):]
+            finally:
+                ledger._register_running_balances = None
+    ## Postings to the account must be in date order.
+    unsorted = [transactions[0], transactions[2], transactions[1]]
+    assert calculate_register(unsorted, 'Expenses:Food', False, None, None, tail=1)[0][0] == '2013-01-02'
+    (stderr, sys.stderr) = (sys.stderr, StringIO())
+    try:
+        calculate_register(unsorted, 'Assets', False, None, None, tail=1)
+        assert False
+    except SystemExit:
+        assert "--limit and --tail need postings to 'Assets' in date order" in sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+
+def test_account_statistics():
+    transactions = _sample_transactions()
+    statistics = account_statistics(transactions, account_tree_from_transactions(transactions))
+    assert statistics['ASSETS:CASH'] == {'AUD': AccountStatistics('AUD', 3, 16500, -4000, 10000,
+                                                                 '2013-01-01', '2013-01-03', 3500)}
+    assert statistics['EXPENSES'] == {'AUD': AccountStatistics('AUD', 2, 6500, 2500, 4000, '2013-01-02', '2013-01-03', 6500)}
+    assert statistics['EXPENSES:MOTOR'] == statistics['EXPENSES:MOTOR:FUEL']
+    assert sorted(statistics.keys()) == ['ASSETS', 'ASSETS:CASH', 'EQUITY', 'EQUITY:OPENINGBALANCES',
+                                         'EXPENSES', 'EXPENSES:FOOD', 'EXPENSES:MOTOR', 'EXPENSES:MOTOR:FUEL']
+    lines = account_tree_lines(account_tree_from_transactions(_sample_transactions()), ['expense:motor'])
+    assert [(line.name, line.account_string) for line in lines] == [('Expenses:Motor:Fuel', 'EXPENSES:MOTOR:FUEL')]
+
+def test_months_spanned():
+    assert months_spanned('2013-01-31', '2013-01-01') == 1
+    assert months_spanned('2012-12-31', '2013-01-01') == 2
+    assert months_spanned('2012-01-15', '2013-06-01') == 18
+
+def test_record_writer():
+    output = StringIO()
+    write = record_writer('csv', ['account', 'quantity'], output)
+    write(('Assets:Cash', -2500))
+    write(('Expenses:Food, etc', None))
+    assert output.getvalue() == 'account,quantity\nAssets:Cash,-2500\n"Expenses:Food, etc",\n'
+    output = StringIO()
+    write = record_writer('ndjson', ['account', 'quantity'], output)
+    write(('Assets:Cash', -2500))
+    write(('Expenses:Food', None))
+    assert output.getvalue() == '{"account": "Assets:Cash", "quantity": -2500}\n{"account": "Expenses:Food", "quantity": null}\n'
+
+def test_iter_accounts():
+    tree = account_tree_from_transactions(_sample_transactions())
+    assert [name for (name, account) in iter_accounts(tree)] == \
+        ['Assets', 'Assets:Cash', 'Equity', 'Equity:OpeningBalances',
+         'Expenses', 'Expenses:Food', 'Expenses:Motor', 'Expenses:Motor:Fuel']
+    assert [name for (name, account) in iter_accounts(tree, ['EXPENSES:motor'])] == \
+        ['Expenses:Motor', 'Expenses:Motor:Fuel']
+
+def _captured_stdout(function, *args, **kwargs):
+    "Return what function writes to stdout."
+    saved = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        function(*args, **kwargs)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = saved
+
+def test_write_balance_and_register_records():
+    transactions = _sample_transactions()
+    output = _captured_stdout(write_balance_records, transactions, ['Expenses'], None, None, None, 'csv',
+                              dates=['2013-01-02', '2013-01-03'])
+    assert output.splitlines() == ['date,account,units,quantity',
+                                   '2013-01-02,Expenses,AUD,2500',
+                                   '2013-01-02,Expenses:Food,AUD,2500',
+                                   '2013-01-03,Expenses,AUD,6500',
+                                   '2013-01-03,Expenses:Food,AUD,2500',
+                                   '2013-01-03,Expenses:Motor,AUD,4000',
+                                   '2013-01-03,Expenses:Motor:Fuel,AUD,4000']
+    output = _captured_stdout(write_register_records, transactions, 'Assets', True, False, '2013-01-02', None, 'csv')
+    assert output.splitlines() == ['date,description,account,units,quantity,balance',
+                                   '2013-01-02,Groceries,Expenses:Food,AUD,2500,',
+                                   '2013-01-02,Groceries,Assets:Cash,AUD,-2500,7500',
+                                   '2013-01-03,Petrol,expense:Motor:Fuel,AUD,4000,',
+                                   '2013-01-03,Petrol,Assets:Cash,AUD,-4000,3500']
+
+def test_balances_helper_named_accounts_and_depth():
+    tree = calculate_balances(_sample_transactions(), None)
+    assert single_unit_balances_helper(tree, ['expenses:MOTOR:fuel', 'Assets']) == \
+        [('', '$40.00', 'Expenses:Motor:Fuel'), ('', '$35.00', 'Assets:Cash')]
+    assert single_unit_balances_helper(tree, [], depth=1) == \
+        [('', '$35.00', 'Assets'), ('', '$100.00', 'Equity'), ('', '$65.00', 'Expenses')]
+    assert single_unit_balances_helper(tree, ['Expenses'], True, depth=2) == \
+        [('*', '$65.00', 'Expenses'), ('**', '$25.00', '  Food'), ('**', '$40.00', '  Motor')]
+    assert find_original_prefix('EXPENSES:motor:FUEL', tree) == 'Expenses:Motor:'
+
+def test_account_tree_lines_deep_tree():
+    account_string = "Assets" + ":Sub" * 3000
+    transactions = [{'date': '2013-01-01', 'line': 1, 'description': 'Deep',
+                     'postings': [{'account': account_string, 'amount': {'units': 'AUD', 'quantity': 100}},
+                                  {'account': 'Assets', 'amount': {'units': 'AUD', 'quantity': -100}}]}]
+    lines = list(account_tree_lines(account_tree_from_transactions(transactions)))
+    assert [(line.name, line.indent) for line in lines] == [('Assets', 0), (account_string[len("Assets:"):], 1)]
+    assert len(list(iter_accounts(account_tree_from_transactions(transactions)))) == 3001
+
+def test_compare_summaries():
+    old = summarise_journal(JOURNAL_LINES[:14], False)
+    new = summarise_journal(JOURNAL_LINES[:4] + JOURNAL_LINES[8:] + ["", "2013-01-05 Opening balance",
+                                                                     "  Assets:Cash      $100",
+                                                                     "  Equity:OpeningBalances      $100"], False)
+    (changes, added, removed) = compare_summaries(old, new)
+    assert changes == [('Assets', {'AUD': 3500}, {'AUD': 15000}),
+                       ('Assets:Cash', {'AUD': 3500}, {'AUD': 15000}),
+                       ('Equity', {'AUD': 10000}, {'AUD': 20000}),
+                       ('Equity:OpeningBalances', {'AUD': 10000}, {'AUD': 20000}),
+                       ('Expenses', {'AUD': 6500}, {'AUD': 5000}),
+                       ('Expenses:Food', {'AUD': 2500}, {'AUD': 1000})]
+    assert added == [('2013-01-04', 'Lunch'), ('2013-01-05', 'Opening balance')]
+    assert removed == [('2013-01-02', 'Groceries')]
+
+def test_revision_summary_is_cached_by_blob():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal.transactions")
+        def commit(lines):
+            with open(journal_fname, "w") as outfile:
+                outfile.write("\n".join(lines) + "\n")
+            subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                                   "commit", "-q", "-a", "-m", "change"], cwd=directory)
+        subprocess.check_call(["git", "init", "-q"], cwd=directory)
+        with open(journal_fname, "w") as outfile:
+            outfile.write("\n".join(JOURNAL_LINES[:8]) + "\n")
+        subprocess.check_call(["git", "add", "journal.transactions"], cwd=directory)
+        commit(JOURNAL_LINES[:8])
+        commit(JOURNAL_LINES)
+        commit(JOURNAL_LINES[:8])
+        summaries = [revision_summary(journal_fname, revision, False) for revision in ["HEAD~2", "HEAD~1", "HEAD"]]
+        assert summaries[0] == summaries[2] == summarise_journal(JOURNAL_LINES[:8], False)
+        assert summaries[1] == summarise_journal(JOURNAL_LINES, False)
+        assert len(os.listdir(os.path.join(directory, ".git", "ledger-py-cache"))) == 2
+        ## A changed program doesn't reuse summaries cached by the old one.
+        program_hash = ledger.program_hash
+        ledger.program_hash = lambda: "changed"
+        try:
+            assert revision_summary(journal_fname, "HEAD", False) == summaries[2]
+        finally:
+            ledger.program_hash = program_hash
+        assert len(os.listdir(os.path.join(directory, ".git", "ledger-py-cache"))) == 3
+    finally:
+        shutil.rmtree(directory)
+
+def test_revision_summary_of_compressed_journal():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal.transactions.gz")
+        subprocess.check_call(["git", "init", "-q"], cwd=directory)
+        revisions = []
+        for (compress, lines) in [(gzip.open, JOURNAL_LINES[:8]), (bz2.BZ2File, JOURNAL_LINES)]:
+            outfile = compress(journal_fname, "wb")
+            outfile.write("\n".join(lines) + "\n")
+            outfile.close()
+            subprocess.check_call(["git", "add", "journal.transactions.gz"], cwd=directory)
+            subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                                   "commit", "-q", "-m", "change"], cwd=directory)
+        assert revision_summary(journal_fname, "HEAD~1", False) == summarise_journal(JOURNAL_LINES[:8], False)
+        assert revision_summary(journal_fname, "HEAD", False) == summarise_journal(JOURNAL_LINES, False)
+        assert decompress_journal("2013-01-01 Plain\n", "plain") == "2013-01-01 Plain\n"
+    finally:
+        shutil.rmtree(directory)
+
+ACCOUNT_STRINGS = ['Assets:Bankwest:Cheque', 'Assets:Cash', 'Expenses:Motor:Fuel', 'Expenses:Boat:Fuel',
+                   'Expenses:Food:Groceries', 'Liabilities:Visa']
+
+def test_match_account_patterns():
+    trie = build_account_trie(ACCOUNT_STRINGS)
+    assert match_account_patterns(trie, ['Expenses:*:Fuel']) == ['Expenses:Boat:Fuel', 'Expenses:Motor:Fuel']
+    assert match_account_patterns(trie, ['assets:ba*', 'ASSETS:*']) == ['Assets:Bankwest', 'Assets:Cash']
+    assert match_account_patterns(trie, ['Expenses:Motor', 'E*:?oo[dx]']) == ['Expenses:Motor', 'Expenses:Food']
+    assert match_account_patterns(trie, ['L*', 'Liabilities:Visa']) == ['Liabilities', 'Liabilities:Visa']
+    assert match_account_patterns(trie, ['Income:*', 'Expenses:Motor:Oil']) == []
+
+def test_complete_account():
+    trie = build_account_trie(ACCOUNT_STRINGS)
+    assert complete_account(trie, 'e') == ['Expenses']
+    assert complete_account(trie, 'expenses:') == ['Expenses:Boat', 'Expenses:Food', 'Expenses:Motor']
+    assert complete_account(trie, 'EXPENSES:motor:f') == ['Expenses:Motor:Fuel']
+    assert complete_account(trie, 'Income:') == []
+    assert complete_account(trie, 'x') == []
+
+def test_expand_account_patterns():
+    trie = build_account_trie(ACCOUNT_STRINGS)
+    assert expand_account_patterns(trie, ['Equity', 'Expenses:*:Fuel', 'assets']) == \
+        ['Equity', 'Expenses:Boat:Fuel', 'Expenses:Motor:Fuel', 'assets']
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        expand_account_patterns(trie, ['Income:*'])
+        assert False
+    except SystemExit:
+        assert sys.stderr.getvalue() == "No accounts match 'Income:*'.\nExiting.\n"
+    finally:
+        sys.stderr = stderr
+
+def test_account_tree_snapshots():
+    transactions = _sample_transactions()
+    dates = ['2012-12-31', '2013-01-02', '2013-01-01', '2013-01-03']
+    snapshots = account_tree_snapshots(transactions, dates)
+    for date in dates:
+        assert single_unit_report_helper(snapshots[date]) == \
+            single_unit_report_helper(calculate_balances(transactions, date))
+    ## Only Expenses:Motor:Fuel and its parents were booked to on the last day.
+    assert snapshots['2013-01-03']['EQUITY'] is snapshots['2013-01-02']['EQUITY']
+    assert snapshots['2013-01-03']['EXPENSES'].sub_accounts['FOOD'] is snapshots['2013-01-02']['EXPENSES'].sub_accounts['FOOD']
+    assert snapshots['2013-01-03']['EXPENSES'] is not snapshots['2013-01-02']['EXPENSES']
+
+def test_book_amount_to_snapshot_leaves_snapshot_alone():
+    before = account_tree_from_transactions(_sample_transactions())
+    after = book_amount_to_snapshot('Expenses:Motor:Fuel', {'units': 'AUD', 'quantity': 100}, before)
+    assert before['EXPENSES'].balances == {}
+    assert before['EXPENSES'].sub_accounts['MOTOR'].sub_accounts['FUEL'].balances == {}
+    assert after['EXPENSES'].sub_accounts['MOTOR'].sub_accounts['FUEL'].balances == {'AUD': {'units': 'AUD', 'quantity': 100}}
+    assert after['EXPENSES'].postings is before['EXPENSES'].postings
+
+def test_parse_compressed_journal():
+    directory = tempfile.mkdtemp()
+    try:
+        text = "\n".join(JOURNAL_LINES) + "\n"
+        plain_fname = os.path.join(directory, "journal")
+        with open(plain_fname, "w") as outfile:
+            outfile.write(text)
+        ## Compression is recognised from the contents, not the name.
+        gzip_fname = os.path.join(directory, "journal.gz.backup")
+        outfile = gzip.GzipFile(gzip_fname, "wb")
+        outfile.write(text)
+        outfile.close()
+        bzip2_fname = os.path.join(directory, "journal.bz2")
+        outfile = bz2.BZ2File(bzip2_fname, "w")
+        outfile.write(text)
+        outfile.close()
+        assert [journal_compression(fname) for fname in [plain_fname, gzip_fname, bzip2_fname]] == [None, 'gzip', 'bzip2']
+        expected = parse_file(plain_fname, False)
+        assert parse_file(gzip_fname, False) == expected
+        assert parse_file(bzip2_fname, False) == expected
+    finally:
+        shutil.rmtree(directory)
+
+def test_cached_reports():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal")
+        with open(journal_fname, "w") as outfile:
+            outfile.write("\n".join(JOURNAL_LINES) + "\n")
+        args = argument_parser().parse_args([journal_fname, "--print-balances", "Assets",
+                                             "--cache-dir", os.path.join(directory, "cache")])
+        def run():
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                run_cached_reports(args)
+                return sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+        output = run()
+        assert "Assets" in output
+        ## The second run replays the saved output without parsing the journal.
+        parse_transactions = ledger.parse_transactions
+        ledger.parse_transactions = None
+        try:
+            assert run() == output
+        finally:
+            ledger.parse_transactions = parse_transactions
+        assert len(os.listdir(args.cache_dir)) == 1
+        ## Changing the journal means it's parsed again.
+        with open(journal_fname, "a") as outfile:
+            outfile.write("\n")
+        assert run() == output
+        assert len(os.listdir(args.cache_dir)) == 2
+    finally:
+        shutil.rmtree(directory)
+
+def test_evict_cache_entries():
+    directory = tempfile.mkdtemp()
+    try:
+        for (name, used) in [("a", 300), ("b", 100), ("c", 200)]:
+            fname = os.path.join(directory, name + ".output")
+            with open(fname, "w") as outfile:
+                outfile.write("x" * 10)
+            os.utime(fname, (used, used))
+        evict_cache_entries(directory, 20)
+        assert sorted(os.listdir(directory)) == ["a.output", "c.output"]
+        evict_cache_entries(directory, 10)
+        assert os.listdir(directory) == ["a.output"]
+    finally:
+        shutil.rmtree(directory)
+
+WHAT_IF_TRANSACTIONS = [{'date': '2013-01-02', 'line': 1, 'description': 'Insurance',
+                         'postings': [{'account': 'Expenses:Motor:Insurance', 'amount': {'units': 'AUD', 'quantity': 1000}},
+                                      {'account': 'Assets:Cash', 'amount': {'units': 'AUD', 'quantity': -1000}}]}]
+
+def test_what_if_balance_columns():
+    transactions = _sample_transactions()
+    (lines, columns) = what_if_balance_columns(transactions, WHAT_IF_TRANSACTIONS, ['Assets', 'Expenses:Motor'], None)
+    assert [line.name for line in lines] == ['Assets:Cash', 'Expenses:Motor', 'Fuel', 'Insurance']
+    assert columns == [[{'AUD': 3500}, {'AUD': 4000}, {'AUD': 4000}, {}],
+                       [{'AUD': 2500}, {'AUD': 5000}, {'AUD': 4000}, {'AUD': 1000}]]
+    ## Overlay transactions after as_at_date aren't included.
+    (lines, columns) = what_if_balance_columns(transactions, WHAT_IF_TRANSACTIONS, ['Assets'], '2013-01-01')
+    assert columns == [[{'AUD': 10000}], [{'AUD': 10000}]]
+
+def test_what_if_verifications():
+    transactions = _sample_transactions()
+    verifications = [{'line': 20, 'date': '2013-01-01', 'account': 'Assets', 'amount': {'units': 'AUD', 'quantity': 10000}},
+                     {'line': 21, 'date': '2013-01-03', 'account': 'Assets', 'amount': {'units': 'AUD', 'quantity': 3500}},
+                     {'line': 22, 'date': '2013-01-03', 'account': 'Equity', 'amount': {'units': 'AUD', 'quantity': 10000}}]
+    overlay_verifications = [{'line': 3, 'date': '2013-01-03', 'account': 'Expenses:Motor',
+                              'amount': {'units': 'AUD', 'quantity': 5000}}]
+    checks = what_if_verifications(transactions, verifications, WHAT_IF_TRANSACTIONS, overlay_verifications)
+    assert [(check.verification['line'], check.base, check.what_if) for check in checks] == \
+        [(21, {'AUD': 3500}, {'AUD': 2500}), (3, {'AUD': 4000}, {'AUD': 5000})]
+
+def test_reconcile_statement():
+    transactions = _sample_transactions()
+    rows = [StatementRow(line=2, date='2013-01-03', description='GROCERIES', amount_string='-25.00'),
+            StatementRow(line=3, date='2013-01-03', description='PETROL', amount_string='-40.00'),
+            StatementRow(line=4, date='2013-01-03', description='PETROL AGAIN', amount_string='-40.00'),
+            StatementRow(line=5, date='2013-01-20', description='FEE', amount_string='-1.00')]
+    reconciliation = reconcile_statement(transactions, ['Assets'], rows, False, 2)
+    assert [(row.line, entry) for (row, amount, entry) in reconciliation.matched] == [(2, (1, 1)), (3, (2, 1))]
+    assert [row.line for (row, amount) in reconciliation.statement_only] == [4, 5]
+    ## The opening balance is within two days of the first row.
+    assert reconciliation.journal_only == [(0, 0)]
+    reconciliation = reconcile_statement(transactions, ['Assets'], rows, False, 0)
+    assert [(row.line, entry) for (row, amount, entry) in reconciliation.matched] == [(3, (2, 1))]
+    assert reconciliation.journal_only == []
+
+def test_run_report_jobs_in_parallel():
+    def report(number):
+        def job():
+            print number, os.getpid()
+            sys.stderr.write("report %d\n" % number)
+        return job
+    def failing_job():
+        sys.stderr.write("Failed.\nExiting.\n")
+        sys.exit(-1)
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    (sys.stdout, sys.stderr) = (StringIO(), StringIO())
+    try:
+        run_report_jobs([report(n) for n in range(4)], True)
+        output = sys.stdout.getvalue().splitlines()
+        assert [line.split()[0] for line in output] == ['0', '1', '2', '3']
+        assert str(os.getpid()) not in [line.split()[1] for line in output]
+        assert sys.stderr.getvalue() == "report 0\nreport 1\nreport 2\nreport 3\n"
+        sys.stdout.truncate(0)
+        try:
+            run_report_jobs([report(0), failing_job, report(2)], True)
+            assert False
+        except SystemExit as e:
+            assert e.code == -1
+        assert sys.stdout.getvalue().split()[0] == '0'
+        assert sys.stderr.getvalue().endswith("report 0\nFailed.\nExiting.\n")
+    finally:
+        (sys.stdout, sys.stderr) = (stdout, stderr)
+
+def test_run_batch():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal")
+        with open(journal_fname, "w") as outfile:
+            outfile.write("\n".join(JOURNAL_LINES) + "\n")
+        job_options = [["--print-balances", "--as-at", "2013-01-02"],
+                       ["--print-register", "Assets:*", "--tail", "1"],
+                       ["--print-balances", "Expenses", "--output-format", "csv"]]
+        job_fname = os.path.join(directory, "jobs")
+        with open(job_fname, "w") as outfile:
+            outfile.write("# Reports\n\n")
+            for index in range(len(job_options)):
+                outfile.write("%s %s\n" % (os.path.join(directory, "out%d" % index),
+                                            " ".join("'%s'" % option for option in job_options[index])))
+        parse_count = []
+        parse_transactions = ledger.parse_transactions
+        def counting_parse_transactions(*arguments):
+            parse_count.append(1)
+            return parse_transactions(*arguments)
+        ledger.parse_transactions = counting_parse_transactions
+        try:
+            run_batch(argument_parser().parse_args([journal_fname, "--batch", job_fname]))
+        finally:
+            ledger.parse_transactions = parse_transactions
+        assert len(parse_count) == 1
+        assert ledger._journal_indexes is None and ledger._register_running_balances is None
+        ## Report options belong in the job file.
+        (stderr, sys.stderr) = (sys.stderr, StringIO())
+        try:
+            run_batch(argument_parser().parse_args([journal_fname, "--batch", job_fname, "--print-balances"]))
+            assert False
+        except SystemExit:
+            assert "--print-balances can't be used with --batch" in sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        stdout = sys.stdout
+        try:
+            for index in range(len(job_options)):
+                sys.stdout = StringIO()
+                run_reports(argument_parser().parse_args([journal_fname] + job_options[index]))
+                with open(os.path.join(directory, "out%d" % index)) as infile:
+                    assert infile.read() == sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(directory)
+
+COMMODITY_JOURNAL_LINES = ["2013-01-05 Bought shares",
+                           "  Assets:Broker    10 BHP @ $45.20",
+                           "  Assets:Cash    -$452.00",
+                           "",
+                           "2013-02-01 Sold shares",
+                           "  Assets:Broker    -4 BHP @ $50.00",
+                           "  Assets:Cash    $200"]
+
+def test_commodity_account_statistics():
+    transactions = parse_transactions(COMMODITY_JOURNAL_LINES + ["", "2013-02-02 Bought US dollars",
+                                                                 "  Assets:USD    100.00 USD @ $1.05",
+                                                                 "  Assets:Cash    -$105.00"], False)['transactions']
+    statistics = account_statistics(transactions, account_tree_from_transactions(transactions))
+    assert statistics['ASSETS:BROKER'] == {'BHP': AccountStatistics('BHP', 2, 1400, -400, 1000,
+                                                                   '2013-01-05', '2013-02-01', 600)}
+    assert sorted(statistics['ASSETS'].keys()) == ['AUD', 'BHP', 'USD']
+    assert statistics['ASSETS']['AUD'] == statistics['ASSETS:CASH']['AUD']
+    assert statistics['ASSETS']['USD'].net == 10000
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        ledger.print_account_statistics(transactions, [], False, None, None)
+        lines = sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = stdout
+    assert [line.split()[-1] for line in lines[1:]] == ['Assets', 'Assets', 'Assets', 'Broker', 'Cash', 'USD']
+
+def test_parse_commodity_postings():
+    transactions = parse_transactions(COMMODITY_JOURNAL_LINES, False)['transactions']
+    posting = transactions[0]['postings'][0]
+    assert posting['amount'] == {'units': 'BHP', 'quantity': 1000}
+    assert posting['price'] == {'units': 'AUD', 'quantity': 4520}
+    assert is_balanced(transactions[0]) and is_balanced(transactions[1])
+    assert format_amount(posting['amount']) == "10.00 BHP"
+
+def test_commodity_verifications_and_precision():
+    verification = ledger.parse_balance_verify(3, "VERIFY-BALANCE 2013-02-01 Assets:Broker 6.00 BHP", False)
+    assert verification['amount'] == {'units': 'BHP', 'quantity': 600}
+    assert list(check_journal(COMMODITY_JOURNAL_LINES + ["", "VERIFY-BALANCE 2013-02-01 Assets:Broker 6 BHP"],
+                              False)) == []
+    ## Quantities are kept in hundredths, so finer commodity amounts are errors, not rounded.
+    problems = list(check_journal(["2013-01-01 Bought bitcoin",
+                                   "  Assets:Wallet    0.125 BTC @ $80.00",
+                                   "  Assets:Cash    -$10.00"], False))
+    assert (problems[0].line, problems[0].kind) == (2, 'parse-error')
+    assert "more than two decimal places" in problems[0].message
+
+def test_close_books_with_commodities():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal")
+        archive_fname = os.path.join(directory, "archive")
+        lines = ["2013-01-01 Opening balance",
+                 "  Assets:Cash    $1,000",
+                 "  Equity:OpeningBalances    $1,000",
+                 "",
+                 "2013-01-03 Bought shares",
+                 "  Assets:Broker    3 BHP @ $33.33",
+                 "  Assets:Cash    -$99.99",
+                 "",
+                 "2013-01-04 Bought half shares",
+                 "  Assets:Broker    0.5 BHP @ $33.33",
+                 "  Assets:Broker    0.5 BHP @ $33.33",
+                 "  Assets:Cash    -$33.34",
+                 ""] + COMMODITY_JOURNAL_LINES + ["", "VERIFY-BALANCE 2013-02-01 Assets:Broker 10.00 BHP"]
+        with open(journal_fname, "w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        for cutoff_date in ['2013-01-05', '2013-02-01']:
+            close_books(journal_fname, cutoff_date, archive_fname, False)
+            with open(journal_fname) as infile:
+                live = infile.readlines()
+            assert "VERIFY-BALANCE %s Assets:Broker %s BHP\n" % (cutoff_date, {'2013-01-05': "14.00",
+                                                                           '2013-02-01': "10.00"}[cutoff_date]) in live
+            assert list(check_journal(live, False)) == []
+            assert ledger._final_balances(live, False) == ledger._final_balances(lines, False)
+        ## Lots whose values were rounded stay apart, so the opening transaction still balances.
+        assert live[2:8] == ["  Assets:Broker  3.00 BHP @ $33.33\n",
+                             "  Assets:Broker  0.50 BHP @ $33.33\n",
+                             "  Assets:Broker  0.50 BHP @ $33.33\n",
+                             "  Assets:Broker  10.00 BHP @ $45.20\n",
+                             "  Assets:Broker  -4.00 BHP @ $50.00\n",
+                             "  Assets:Cash  $614.67\n"]
+    finally:
+        shutil.rmtree(directory)
+
+def test_price_index():
+    prices = read_prices(["# Closing prices", "P 2013/01/31 BHP $48.00", "", "P 2013-01-31 BHP $48.50"])
+    transactions = parse_transactions(COMMODITY_JOURNAL_LINES, False)['transactions']
+    index = build_price_index(transaction_prices(transactions) + prices)
+    assert index['BHP'].dates == ['2013-01-05', '2013-01-31', '2013-01-31', '2013-02-01']
+    assert price_as_at(index, 'BHP', '2013-01-04') is None
+    assert price_as_at(index, 'BHP', '2013-01-30') == {'units': 'AUD', 'quantity': 4520}
+    ## The last price given for a date wins.
+    assert price_as_at(index, 'BHP', '2013-01-31') == {'units': 'AUD', 'quantity': 4850}
+    assert price_as_at(index, 'BHP', None) == {'units': 'AUD', 'quantity': 5000}
+    assert price_as_at(index, 'USD', None) is None
+    assert market_value({'BHP': 600, 'AUD': 1000}, index, '2013-01-31') == {'AUD': 30100}
+
+def test_balances_at_market_value():
+    transactions = parse_transactions(COMMODITY_JOURNAL_LINES, False)['transactions']
+    tree = calculate_balances(transactions, None)
+    assert single_unit_balances_helper(tree, ['Assets:Broker']) == [("", "6.00 BHP", "Assets:Broker")]
+    index = build_price_index(transaction_prices(transactions))
+    assert single_unit_balances_helper(tree, ['Assets:Broker'], price_index=index) == [("", "$300.00", "Assets:Broker")]
+
+def test_commodity_registers_and_reports():
+    transactions = parse_transactions(COMMODITY_JOURNAL_LINES, False)['transactions']
+    register = calculate_register(transactions, 'Assets', False, None, None)
+    assert [line[1] for line in register] == ["10.00 BHP", "-$452.00, 10.00 BHP", "-$452.00, 6.00 BHP", "-$252.00, 6.00 BHP"]
+    assert single_unit_report_helper(calculate_balances(transactions, None), ['Assets'])[0].balance == \
+        {'AUD': -25200, 'BHP': 600}
+    directory = tempfile.mkdtemp()
+    (stderr, sys.stderr) = (sys.stderr, StringIO())
+    try:
+        ## Balances in several units are written without prices, too.
+        for price_index in [None, build_price_index(transaction_prices(transactions))]:
+            write_excel_report(transactions, ['2013-01-31', '2013-02-28'], os.path.join(directory, "report"), price_index)
+            assert os.path.exists(os.path.join(directory, "report.xls"))
+    finally:
+        sys.stderr = stderr
+        shutil.rmtree(directory)
+
+def test_database_keeps_prices():
+    transactions = parse_transactions(COMMODITY_JOURNAL_LINES, False)['transactions']
+    unpriced = dict(transactions[0], postings=[dict(posting) for posting in transactions[0]['postings']])
+    del unpriced['postings'][0]['price']
+    assert transaction_hash(unpriced) != transaction_hash(transactions[0])
+    db = open_database(":memory:")
+    import_transactions(db, transactions, [])
+    assert database_prices(db) == transaction_prices(transactions)
+
+def test_sync_database_sorts_journal():
+    directory = tempfile.mkdtemp()
+    try:
+        journal_fname = os.path.join(directory, "journal")
+        with open(journal_fname, "w") as outfile:
+            outfile.write("\n".join(JOURNAL_LINES[9:] + [""] + JOURNAL_LINES[:8]) + "\n")
+        db = sync_database(os.path.join(directory, "db"), journal_fname, False, True, 1)
+        assert [row[0] for row in db.execute("SELECT date FROM transactions ORDER BY position")] == \
+            ['2013-01-01', '2013-01-02', '2013-01-03', '2013-01-04']
+    finally:
+        shutil.rmtree(directory)